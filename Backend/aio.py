@@ -0,0 +1,529 @@
+"""Asyncio serving mode: `python aio.py` or `uvicorn aio:app`.
+
+The read-heavy and long-lived routes (listing reads, analytics, purchase
+request lists, payment proofs and the SSE feed) are served natively on the
+event loop with asyncpg, so thousands of open dashboards and event streams
+cost coroutines rather than threads. Every other route is passed through to
+the Flask app on a small thread pool. The native routes share their SQL and
+JSON shaping with app.py (see queries.py) and use the same response cache,
+so clients cannot tell the two modes apart.
+"""
+import asyncio
+import os
+import time
+from email.utils import formatdate, parsedate_to_datetime
+
+try:
+    import asyncpg
+    from a2wsgi import WSGIMiddleware
+    from starlette.applications import Starlette
+    from starlette.middleware import Middleware
+    from starlette.middleware.cors import CORSMiddleware
+    from starlette.responses import FileResponse, Response, StreamingResponse
+    from starlette.routing import Mount, Route
+except ImportError as e:
+    raise ImportError(f"Async mode needs asyncpg, starlette, a2wsgi and uvicorn installed ({e})")
+
+import bulk
+import db
+import blobstore
+import encoding
+import events
+import metrics
+import pricing
+import queries
+import sessions
+from cache import CacheEntry, response_cache
+from queries import ListingQuery
+from app import CORS_EXPOSE_HEADERS, app as flask_app, listing_query_tags
+
+ASYNC_DB_POOL_MIN = int(os.environ.get('ASYNC_DB_POOL_MIN', 2))
+ASYNC_DB_POOL_MAX = int(os.environ.get('ASYNC_DB_POOL_MAX', 20))
+ASYNC_WSGI_THREADS = int(os.environ.get('ASYNC_WSGI_THREADS', 16))   # threads for the Flask fallback
+ASYNC_HOST = os.environ.get('ASYNC_HOST', '127.0.0.1')
+ASYNC_PORT = int(os.environ.get('ASYNC_PORT', 5000))
+
+pool = None
+
+# Same SQL as the Flask routes, rewritten to asyncpg's $n placeholders once
+SQL = {name: queries.to_asyncpg(getattr(queries, name)) for name in (
+    'LISTING_BY_ID_SQL', 'FARMER_ANALYTICS_SQL', 'BUYER_ANALYTICS_SQL', 'NGO_CLAIMS_SQL', 'NGO_AVAILABLE_SQL',
+    'NGO_PROFILE_SQL', 'FARMER_REQUESTS_SQL', 'BUYER_REQUESTS_SQL', 'BUYER_SPEND_SQL', 'CROP_PRICES_SQL',
+    'FARMER_ARCHIVED_REQUESTS_SQL', 'BUYER_ARCHIVED_REQUESTS_SQL')}
+REPLAY_SQL = queries.to_asyncpg(events.REPLAY_SQL)
+
+
+class PoolBusy(Exception):
+    pass
+
+
+async def _init_connection(conn):
+    # change_events.payload comes back as a dict, as it does from psycopg2
+    await conn.set_type_codec('jsonb', encoder=lambda v: v, decoder=__import__('json').loads, schema='pg_catalog')
+
+
+async def startup():
+    global pool
+    pool = await asyncpg.create_pool(
+        host=db.DB_HOST, port=int(db.DB_PORT), database=db.DB_NAME, user=db.DB_USER, password=db.DB_PASSWORD,
+        timeout=db.DB_CONNECT_TIMEOUT, min_size=ASYNC_DB_POOL_MIN, max_size=ASYNC_DB_POOL_MAX,
+        max_inactive_connection_lifetime=db.DB_POOL_MAX_IDLE, init=_init_connection)
+
+
+async def shutdown():
+    if pool is not None:
+        await pool.close()
+
+
+async def acquire():
+    start = time.perf_counter()
+    try:
+        conn = await pool.acquire(timeout=db.DB_POOL_TIMEOUT)
+    except asyncio.TimeoutError:
+        raise PoolBusy()
+    metrics.record_db_wait(time.perf_counter() - start)
+    return conn
+
+
+async def fetch(sql, *args, one=False):
+    conn = await acquire()
+    try:
+        start = time.perf_counter()
+        rows = await conn.fetch(sql, *args)
+        metrics.record_statement(sql, time.perf_counter() - start)
+        metrics.record_rows(len(rows))
+    finally:
+        await pool.release(conn)
+    if one:
+        return rows[0] if rows else None
+    return rows
+
+
+def json_response(data, status=200, headers=None):
+    # Serialized exactly like jsonify: compact, trailing newline
+    return Response(encoding.dumps(data) + b'\n', status_code=status, headers=headers, media_type='application/json')
+
+
+def list_response(rows, shape, fmt, next_cursor=None):
+    body, media_type = encoding.encode_rows(rows, shape, fmt)
+    return Response(body, headers={'X-Next-Cursor': next_cursor} if next_cursor else None, media_type=media_type)
+
+
+# ?format=ndjson: rows streamed from a server-side cursor, like app.ndjson_response.
+# The connection is taken up front so a busy pool is still a 503.
+async def ndjson_response(request, sql, args, shape):
+    conn = await acquire()
+
+    async def rows():
+        try:
+            async with conn.transaction():
+                buf = bytearray()
+                async for row in conn.cursor(queries.to_asyncpg(sql), *args, prefetch=bulk.EXPORT_FETCH_SIZE):
+                    buf += encoding.dumps(shape(row))
+                    buf += b'\n'
+                    if len(buf) >= bulk.EXPORT_CHUNK_BYTES:
+                        yield bytes(buf)
+                        buf.clear()
+                if buf:
+                    yield bytes(buf)
+        finally:
+            await pool.release(conn)
+
+    body = rows()
+    headers = {'Vary': 'Accept-Encoding'}
+    coding = encoding.negotiate(request.headers.get('accept-encoding'))
+    if coding:
+        body = _compress_stream(body, coding)
+        headers['Content-Encoding'] = coding
+    return StreamingResponse(body, media_type=encoding.NDJSON_MIMETYPE, headers=headers)
+
+
+async def _compress_stream(chunks, coding):
+    compressor = encoding.StreamCompressor(coding)
+    try:
+        async for chunk in chunks:
+            yield compressor.compress(chunk)
+        yield compressor.finish()
+    finally:
+        await chunks.aclose()
+
+
+def _etag_matches(header, etag):
+    return any(tag.strip().removeprefix('W/').strip('"') in (etag, '*') for tag in header.split(','))
+
+
+def _unmodified_since(header, last_modified):
+    try:
+        return last_modified <= parsedate_to_datetime(header).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def _respond(request, key, entry):
+    headers = dict(entry.headers)
+    body, etag = entry.body, entry.etag
+    if entry.compressible():
+        headers['Vary'] = 'Accept-Encoding'
+        coding = encoding.negotiate(request.headers.get('accept-encoding'))
+        if coding:
+            body, etag = response_cache.encoded(key, entry, coding), f'{entry.etag}-{coding}'
+            headers['Content-Encoding'] = coding
+    headers['ETag'] = f'"{etag}"'
+    headers['Last-Modified'] = formatdate(entry.last_modified, usegmt=True)
+    headers['Cache-Control'] = 'no-cache'
+    # If-None-Match wins over If-Modified-Since, as in werkzeug's make_conditional
+    if_none_match = request.headers.get('if-none-match')
+    if (_etag_matches(if_none_match, etag) if if_none_match is not None
+            else _unmodified_since(request.headers.get('if-modified-since'), entry.last_modified)):
+        response_cache.not_modified += 1
+        headers.pop('Content-Type', None)
+        headers.pop('Content-Encoding', None)
+        return Response(status_code=304, headers=headers)
+    return Response(body, status_code=200, headers=headers)
+
+
+# The async counterpart of cache.cached(): same keys, tags and entries, so the
+# Flask write paths invalidate what the async reads cached
+async def cached(request, tags, build):
+    key = (request.url.path, tuple(sorted(request.query_params.multi_items())))
+    entry = response_cache.get(key)
+    if entry is None:
+        tags = tuple(tags)
+        generation = response_cache.generation()
+        response = await build()
+        if response.status_code != 200 or isinstance(response, StreamingResponse):
+            return response
+        headers = {name: response.headers[name] for name in ('Content-Type', 'X-Next-Cursor')
+                   if name in response.headers}
+        entry = CacheEntry(response.body, headers, tags, response_cache.stamp(key))
+        response_cache.put(key, entry, generation)
+    return _respond(request, key, entry)
+
+
+def _denied(status, message):
+    return json_response({'error': message}, status, {'WWW-Authenticate': 'Bearer'} if status == 401 else None)
+
+
+# sessions.login_required for the native routes: returns the error response,
+# or None when the signed-in user may go ahead
+def authorize(request, roles=(), owner=None, query_token=False):
+    principal = request.state.principal
+    if principal is None and query_token and request.query_params.get('token'):
+        principal = request.state.principal = sessions.cache.verify(request.query_params['token'])
+    denied = sessions.check(principal, roles, owner)
+    return _denied(*denied) if denied else None
+
+
+def endpoint(route, error_message):
+    """Wrap an async view with metrics, the session check of sessions.init_app
+    and the Flask app's error contract."""
+    def decorator(view):
+        async def wrapper(request):
+            start = time.perf_counter()
+            stats, token = metrics.begin_request()
+            try:
+                session_token = sessions.bearer_token(request.headers)
+                request.state.principal = sessions.cache.verify(session_token) if session_token else None
+                if session_token and request.state.principal is None:
+                    response = _denied(401, 'Session expired, please log in again')
+                else:
+                    response = await view(request)
+            except PoolBusy:
+                print("Pool exhausted: no async database connection available")
+                response = json_response({'error': 'Database busy, please retry'}, 503, {'Retry-After': '1'})
+            except (OSError, asyncpg.exceptions.CannotConnectNowError) as e:
+                print(f"Connection error: {e}")
+                response = json_response({'error': 'DB connection failed'}, 500)
+            except Exception as e:
+                print(f"{error_message}: {e}")
+                response = json_response({'error': error_message.replace('Error fetching', 'Failed to fetch')}, 500)
+            elapsed = time.perf_counter() - start
+            size = None if isinstance(response, StreamingResponse) else len(response.body)
+            response.headers['Server-Timing'] = metrics.server_timing(stats, elapsed)
+            path = request.url.path + (f'?{request.url.query}' if request.url.query else '')
+            metrics.end_request(token, stats, request.method, route, path, response.status_code, elapsed, size)
+            return response
+        return wrapper
+    return decorator
+
+
+@endpoint('/api/listings', 'Error fetching listings')
+async def get_listings(request):
+    return await listing_page(request, 'id')
+
+
+@endpoint('/api/listings/search', 'Error fetching listings')
+async def search_listings(request):
+    if not request.query_params.get('q', '').strip():
+        return json_response({'error': 'Missing q'}, 400)
+    return await listing_page(request, 'relevance')
+
+
+async def listing_page(request, default_sort):
+    args = request.query_params
+
+    async def build():
+        try:
+            fmt = encoding.list_format(args)
+            query = ListingQuery(args, default_sort, paginate=fmt != 'ndjson')
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        if fmt == 'ndjson':
+            return await ndjson_response(request, query.sql, query.params, query.shape)
+        rows = await fetch(queries.to_asyncpg(query.sql), *query.params)
+        rows, next_cursor = query.page(rows)
+        return list_response(rows, query.shape, fmt, next_cursor)
+    return await cached(request, listing_query_tags(args), build)
+
+
+@endpoint('/api/listings/<int:id>', 'Error fetching listing')
+async def get_listing(request):
+    try:
+        listing_id = int(request.path_params['id'])
+    except ValueError:
+        return json_response({'error': 'Listing not found'}, 404)
+
+    async def build():
+        row = await fetch(SQL['LISTING_BY_ID_SQL'], listing_id, one=True)
+        if row:
+            return json_response(queries.listing_to_dict(row))
+        return json_response({'error': 'Listing not found'}, 404)
+    return await cached(request, [f'listing:{listing_id}'], build)
+
+
+@endpoint('/api/ngo/profile', 'Error fetching NGO profile')
+async def get_ngo_profile(request):
+    ngo_id = request.query_params.get('ngo_id')
+    denied = authorize(request, ('ngo',), ngo_id)
+    if denied:
+        return denied
+    if not ngo_id:
+        return json_response({'error': 'Missing ngo_id'}, 400)
+
+    async def build():
+        row = await fetch(SQL['NGO_PROFILE_SQL'], ngo_id, one=True)
+        if row:
+            return json_response(queries.ngo_profile(row))
+        return json_response({'message': 'No profile found'}, 404)
+    return await cached(request, [f'ngo_profile:{ngo_id}'], build)
+
+
+@endpoint('/api/ngo/recommended', 'Error fetching recommendations')
+async def get_recommended_donations(request):
+    ngo_id = request.query_params.get('ngo_id')
+    denied = authorize(request, ('ngo',), ngo_id)
+    if denied:
+        return denied
+    if not ngo_id:
+        return json_response({'error': 'Missing ngo_id'}, 400)
+
+    async def build():
+        try:
+            fmt = encoding.list_format(request.query_params)
+            query = queries.RecommendationQuery(ngo_id, request.query_params, paginate=fmt != 'ndjson')
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        if fmt == 'ndjson':
+            return await ndjson_response(request, query.sql, query.params, query.shape)
+        rows = await fetch(queries.to_asyncpg(query.sql), *query.params)
+        rows, next_cursor = query.page(rows)
+        return list_response(rows, query.shape, fmt, next_cursor)
+    return await cached(request, ['listings', f'ngo_profile:{ngo_id}'], build)
+
+
+@endpoint('/api/analytics/farmer/<farmer_id>', 'Error fetching analytics')
+async def get_farmer_analytics(request):
+    farmer_id = request.path_params['farmer_id']
+    denied = authorize(request, ('farmer',), farmer_id)
+    if denied:
+        return denied
+    rows = await fetch(SQL['FARMER_ANALYTICS_SQL'], farmer_id)
+    return json_response(queries.farmer_analytics(rows))
+
+
+@endpoint('/api/analytics/buyer/<buyer_id>', 'Error fetching analytics')
+async def get_buyer_analytics(request):
+    buyer_id = request.path_params['buyer_id']
+    denied = authorize(request, ('buyer',), buyer_id)
+    if denied:
+        return denied
+    rows = await fetch(SQL['BUYER_ANALYTICS_SQL'])
+    spend_rows = await fetch(SQL['BUYER_SPEND_SQL'], buyer_id)
+    price_rows = await fetch(SQL['CROP_PRICES_SQL'], buyer_id, pricing.PRICE_STATS_MAX_CROPS)
+    return json_response(queries.buyer_analytics(rows, spend_rows, price_rows))
+
+
+@endpoint('/api/analytics/ngo/<ngo_id>', 'Error fetching analytics')
+async def get_ngo_analytics(request):
+    ngo_id = request.path_params['ngo_id']
+    denied = authorize(request, ('ngo',), ngo_id)
+    if denied:
+        return denied
+    rows = await fetch(SQL['NGO_CLAIMS_SQL'], ngo_id)
+    available = await fetch(SQL['NGO_AVAILABLE_SQL'], one=True)
+    return json_response(queries.ngo_analytics(rows, available[0]))
+
+
+@endpoint('/api/purchase-requests/farmer/<farmer_id>', 'Error fetching requests')
+async def get_farmer_purchase_requests(request):
+    farmer_id = request.path_params['farmer_id']
+    denied = authorize(request, ('farmer',), farmer_id)
+    if denied:
+        return denied
+
+    async def build():
+        try:
+            fmt = encoding.list_format(request.query_params)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        name = 'FARMER_ARCHIVED_REQUESTS_SQL' if request.query_params.get('archived') == '1' else 'FARMER_REQUESTS_SQL'
+        if fmt == 'ndjson':
+            return await ndjson_response(request, getattr(queries, name), (farmer_id,), queries.farmer_request)
+        rows = await fetch(SQL[name], farmer_id)
+        return list_response(rows, queries.farmer_request, fmt)
+    return await cached(request, [f'purchase_requests:farmer:{farmer_id}'], build)
+
+
+@endpoint('/api/purchase-requests/buyer/<buyer_id>', 'Error fetching requests')
+async def get_buyer_purchase_requests(request):
+    buyer_id = request.path_params['buyer_id']
+    denied = authorize(request, ('buyer',), buyer_id)
+    if denied:
+        return denied
+
+    async def build():
+        try:
+            fmt = encoding.list_format(request.query_params)
+        except ValueError as e:
+            return json_response({'error': str(e)}, 400)
+        name = 'BUYER_ARCHIVED_REQUESTS_SQL' if request.query_params.get('archived') == '1' else 'BUYER_REQUESTS_SQL'
+        if fmt == 'ndjson':
+            return await ndjson_response(request, getattr(queries, name), (buyer_id,), queries.buyer_request)
+        rows = await fetch(SQL[name], buyer_id)
+        return list_response(rows, queries.buyer_request, fmt)
+    return await cached(request, [f'purchase_requests:buyer:{buyer_id}'], build)
+
+
+@endpoint('/api/proofs/<digest>', 'Error fetching proof')
+async def get_proof(request):
+    digest = request.path_params['digest']
+    found = blobstore.open_blob(digest)
+    if found is None:
+        return json_response({'error': 'Proof not found'}, 404)
+    path, mime = found
+    headers = {'Cache-Control': 'private, max-age=31536000, immutable', 'ETag': f'"{digest}"'}
+    if _etag_matches(request.headers.get('if-none-match', ''), digest):
+        return Response(status_code=304, headers=headers)
+    return FileResponse(path, media_type=mime, headers=headers)
+
+
+class AsyncSubscription:
+    """events.Subscription for a coroutine: the broker thread hands events to the loop."""
+
+    def __init__(self, username, role, loop):
+        self.username = username
+        self.role = role
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=events.EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def offer(self, event):
+        if events.event_visible(event, self.username, self.role):
+            self.loop.call_soon_threadsafe(self._put, event)
+
+    def close(self):
+        self.overflowed = True
+        self.loop.call_soon_threadsafe(self._put, None)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.overflowed = True
+            self.queue.put_nowait(None) if self.queue.empty() else None
+
+
+async def _stream(subscription, backlog, last_event_id, truncated):
+    try:
+        yield f"retry: 3000\nid: {last_event_id}\n\n"
+        if truncated:
+            yield "event: reset\ndata: {}\n\n"
+        replayed = set()
+        for event in backlog:
+            replayed.add(event['id'])
+            yield events.format_sse(event)
+        while not subscription.overflowed:
+            try:
+                event = await asyncio.wait_for(subscription.queue.get(), events.EVENTS_HEARTBEAT)
+            except asyncio.TimeoutError:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None or event['id'] in replayed:
+                continue
+            yield events.format_sse(event)
+    finally:
+        events.broker.unsubscribe(subscription)
+
+
+@endpoint('/api/events', 'Error fetching events')
+async def get_events(request):
+    denied = authorize(request, owner=request.query_params.get('username'), query_token=True)
+    if denied:
+        return denied
+    username, role = request.state.principal.username, request.state.principal.role
+    last_event_id = request.headers.get('last-event-id') or request.query_params.get('last_event_id')
+
+    # Subscribe before reading the backlog so nothing falls in between
+    subscription = events.broker.register(AsyncSubscription(username, role, asyncio.get_running_loop()))
+    try:
+        if last_event_id:
+            last_event_id = int(last_event_id)
+            rows = await fetch(REPLAY_SQL, last_event_id, events.EVENTS_REPLAY_LIMIT)
+            backlog, truncated = events.visible_backlog(rows, username, role)
+        else:
+            backlog, truncated = [], False
+            last_event_id = (await fetch(queries.to_asyncpg(events.LATEST_EVENT_SQL), one=True))[0]
+    except ValueError:
+        events.broker.unsubscribe(subscription)
+        return json_response({'error': 'Invalid last_event_id'}, 400)
+    except BaseException:
+        events.broker.unsubscribe(subscription)
+        raise
+
+    return StreamingResponse(_stream(subscription, backlog, last_event_id, truncated),
+                             media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+# Native routes first; anything else (and other methods on these paths) falls
+# through to the Flask app. CORS matches flask_cors's defaults in app.py; the
+# middleware answers preflights itself and overwrites (never duplicates) the
+# headers flask_cors sets on the Flask routes.
+app = Starlette(
+    routes=[
+        Route('/api/listings', get_listings, methods=['GET']),
+        Route('/api/listings/search', search_listings, methods=['GET']),
+        Route('/api/listings/{id:int}', get_listing, methods=['GET']),
+        Route('/api/ngo/profile', get_ngo_profile, methods=['GET']),
+        Route('/api/ngo/recommended', get_recommended_donations, methods=['GET']),
+        Route('/api/analytics/farmer/{farmer_id}', get_farmer_analytics, methods=['GET']),
+        Route('/api/analytics/buyer/{buyer_id}', get_buyer_analytics, methods=['GET']),
+        Route('/api/analytics/ngo/{ngo_id}', get_ngo_analytics, methods=['GET']),
+        Route('/api/purchase-requests/farmer/{farmer_id}', get_farmer_purchase_requests, methods=['GET']),
+        Route('/api/purchase-requests/buyer/{buyer_id}', get_buyer_purchase_requests, methods=['GET']),
+        Route('/api/proofs/{digest}', get_proof, methods=['GET']),
+        Route('/api/events', get_events, methods=['GET']),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=ASYNC_WSGI_THREADS)),
+    ],
+    middleware=[
+        Middleware(CORSMiddleware, allow_origins=['*'], allow_methods=['*'], allow_headers=['*'],
+                   expose_headers=CORS_EXPOSE_HEADERS),
+    ],
+    on_startup=[startup],
+    on_shutdown=[shutdown],
+)
+
+
+if __name__ == '__main__':
+    import uvicorn
+    uvicorn.run(app, host=ASYNC_HOST, port=ASYNC_PORT)
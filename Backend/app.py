@@ -1,124 +1,77 @@
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_file, redirect, g
 from flask_cors import CORS
-import psycopg2
-import bcrypt
 import os
+import io
+import threading
 
-app = Flask(__name__, static_folder='.')
-CORS(app)
+import db
+from db import get_db_connection
+from cache import cached, invalidate, response_cache
+import blobstore
+from blobstore import InvalidBlob
+import rollups
+from validation import parse_quantity
+import events
+import hashing
+import bulk
+import migrations
+import metrics
+import queries
+import purchases
+import pricing
+import proofs
+import idempotency
+import encoding
+import assets
+import sessions
+from queries import ListingQuery
 
-# Hardcoded DB credentials (for trial only)
-DB_HOST = "...."
-DB_PORT = "5432"
-DB_NAME = "harvesthub"
-DB_USER = "HarvestHub"
-DB_PASSWORD = "0000"
+# Response headers the frontend reads; aio.py exposes the same ones
+CORS_EXPOSE_HEADERS = ['X-Next-Cursor', 'ETag', 'Last-Modified', 'Server-Timing', 'Retry-After',
+                       'Idempotent-Replayed']
 
-def get_db_connection():
-    try:
-        conn = psycopg2.connect(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD
-        )
-        return conn
-    except Exception as e:
-        print(f"Connection error: {e}")
-        return None
+app = Flask(__name__, static_folder=None)
+CORS(app, expose_headers=CORS_EXPOSE_HEADERS)
+db.init_app(app)
+hashing.init_app(app)
+metrics.init_app(app)
+encoding.init_app(app)
+sessions.init_app(app)
+metrics.registry.add_collector('db_pool', db.pool.stats)
+metrics.registry.add_collector('db_routing', db.router.stats)
+metrics.registry.add_collector('cache', response_cache.stats)
+metrics.registry.add_collector('hashing', hashing.hash_pool.stats)
+metrics.registry.add_collector('assets', assets.store.stats)
+metrics.registry.add_collector('proofs', proofs.worker.stats)
+metrics.registry.add_collector('sessions', sessions.cache.stats)
+metrics.registry.add_collector('prices', pricing.refresher.stats)
+READY_DB_TIMEOUT = float(os.environ.get('READY_DB_TIMEOUT', 1))
+# Set once a graceful shutdown begins (see serve.py)
+draining = threading.Event()
+# Payment proofs are capped at blobstore.PROOF_MAX_BYTES; leave room for base64/multipart overhead
+app.config['MAX_CONTENT_LENGTH'] = blobstore.PROOF_MAX_BYTES * 2
 
-def init_db():
-    conn = get_db_connection()
-    if conn is None:
-        print("Failed to connect to DB for initialization")
-        return
+# Cheap startup check; schema changes are applied by `python manage.py migrate`
+def check_schema():
     try:
-        cur = conn.cursor()
-        # Create users table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                username VARCHAR(100) PRIMARY KEY,
-                password VARCHAR(100) NOT NULL,
-                role VARCHAR(50) NOT NULL
-            );
-        """)
-        # Create listings table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS listings (
-                id SERIAL PRIMARY KEY,
-                title VARCHAR(100) NOT NULL,
-                quantity VARCHAR(50) NOT NULL,
-                type VARCHAR(50) NOT NULL,
-                farmer_id VARCHAR(100) NOT NULL,
-                farmer_name VARCHAR(100) NOT NULL,
-                available_date DATE,
-                price DECIMAL(10,2)
-            );
-        """)
-        # Add status and claimed_by columns if they don't exist
-        cur.execute("""
-            DO $$ 
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT FROM pg_attribute 
-                    WHERE attrelid = 'listings'::regclass 
-                    AND attname = 'status'
-                ) THEN
-                    ALTER TABLE listings 
-                    ADD COLUMN status VARCHAR(50) DEFAULT 'available';
-                END IF;
-                IF NOT EXISTS (
-                    SELECT FROM pg_attribute 
-                    WHERE attrelid = 'listings'::regclass 
-                    AND attname = 'claimed_by'
-                ) THEN
-                    ALTER TABLE listings 
-                    ADD COLUMN claimed_by VARCHAR(100);
-                END IF;
-            END $$;
-        """)
-        # Create ngo_profiles table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS ngo_profiles (
-                ngo_id VARCHAR(100) PRIMARY KEY,
-                org_name VARCHAR(200) NOT NULL,
-                contact VARCHAR(100) NOT NULL,
-                address TEXT NOT NULL,
-                focus_area TEXT NOT NULL
-            );
-        """)
-        # Create purchase_requests table
-        cur.execute("""
-            CREATE TABLE IF NOT EXISTS purchase_requests (
-                id SERIAL PRIMARY KEY,
-                listing_id INTEGER NOT NULL,
-                buyer_id VARCHAR(100) NOT NULL,
-                farmer_id VARCHAR(100) NOT NULL,
-                crop_title VARCHAR(100) NOT NULL,
-                quantity VARCHAR(50) NOT NULL,
-                price DECIMAL(10,2),
-                payment_proof TEXT,
-                status VARCHAR(50) DEFAULT 'pending',
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            );
-        """)
-        conn.commit()
-        cur.close()
-        print("Tables created or updated successfully")
+        with db.pool.connection() as conn:
+            current, latest = migrations.schema_status(conn)
     except Exception as e:
-        print(f"Error creating or updating tables: {e}")
-    finally:
-        conn.close()
+        print(f"Error checking schema version: {e}")
+        return
+    if current < latest:
+        print(f"Database schema is at version {current}, expected {latest}: run `python manage.py migrate`")
+    elif current > latest:
+        print(f"Database schema version {current} is newer than this code ({latest})")
 
-# Serve static files (HTML, CSS, JS)
+# Serve the Frontend directory (HTML, CSS, JS) from memory; see assets.py
 @app.route('/<path:path>')
 def serve_static(path):
-    return send_from_directory('.', path)
+    return assets.serve(path)
 
 @app.route('/')
 def home():
-    return send_from_directory('.', 'index.html')
+    return assets.serve('index.html')
 
 # Register user
 @app.route('/api/register', methods=['POST'])
@@ -131,11 +84,9 @@ def register():
     if not all([username, password, role]):
         return jsonify({'error': 'Missing fields'}), 400
 
-    hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt()).decode('utf-8')
+    hashed_password = hashing.hash_password(password)
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
         cur.execute("SELECT username FROM users WHERE username = %s;", (username,))
@@ -153,8 +104,6 @@ def register():
     except Exception as e:
         print(f"Error registering user: {e}")
         return jsonify({'error': 'Failed to register'}), 500
-    finally:
-        conn.close()
 
 # Login user
 @app.route('/api/login', methods=['POST'])
@@ -167,29 +116,63 @@ def login():
         return jsonify({'error': 'Missing fields'}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
         cur.execute("SELECT username, password, role FROM users WHERE username = %s;", (username,))
         user = cur.fetchone()
         cur.close()
-        if user and bcrypt.checkpw(password.encode('utf-8'), user[1].encode('utf-8')):
-            return jsonify({
-                'username': user[0],
-                'role': user[2],
-                'message': 'Login successful'
-            }), 200
-        else:
-            return jsonify({'error': 'Invalid username or password'}), 401
+        # Don't hold a transaction open while waiting on the hash pool
+        conn.rollback()
     except Exception as e:
         print(f"Error logging in: {e}")
         return jsonify({'error': 'Failed to login'}), 500
-    finally:
-        conn.close()
+
+    if not (user and hashing.check_password(password, user[1])):
+        return jsonify({'error': 'Invalid username or password'}), 401
+
+    # Work factor changed since this hash was made: upgrade it transparently
+    if hashing.needs_rehash(user[1]):
+        try:
+            new_hash = hashing.hash_password(password)
+            cur = conn.cursor()
+            cur.execute("UPDATE users SET password = %s WHERE username = %s AND password = %s;",
+                        (new_hash, user[0], user[1]))
+            conn.commit()
+            cur.close()
+        except Exception as e:
+            # The login itself succeeded; retry the upgrade next time
+            print(f"Error rehashing password: {e}")
+
+    token, principal = sessions.issue(user[0], user[2])
+    return jsonify({
+        'username': user[0],
+        'role': user[2],
+        'token': token,
+        'expires_at': principal.expires_at,
+        'message': 'Login successful'
+    }), 200
+
+# Logout: revoke this session's token, or with {"all": true} every session
+# of the user
+@app.route('/api/logout', methods=['POST'])
+@sessions.login_required()
+def logout():
+    data = request.get_json(silent=True) or {}
+    principal = g.principal
+    conn = get_db_connection()
+    try:
+        if data.get('all'):
+            sessions.revoke(conn, principal.username)
+        else:
+            sessions.revoke(conn, principal.username, principal.session_id, principal.expires_at)
+        return jsonify({'message': 'Logged out'}), 200
+    except Exception as e:
+        print(f"Error logging out: {e}")
+        return jsonify({'error': 'Failed to logout'}), 500
 
 # Add listing
 @app.route('/api/listings', methods=['POST'])
+@sessions.login_required('farmer', owner=lambda: sessions.claimed('farmer_id'))
 def add_listing():
     data = request.get_json()
     title = data.get('title')
@@ -202,28 +185,99 @@ def add_listing():
 
     if not all([title, quantity, type_, farmer_id, farmer_name]):
         return jsonify({'error': 'Missing required fields'}), 400
+    try:
+        quantity_amount, quantity_unit = parse_quantity(quantity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO listings (title, quantity, type, farmer_id, farmer_name, available_date, price, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, 'available') RETURNING id;
-        """, (title, quantity, type_, farmer_id, farmer_name, available_date, price))
-        listing_id = cur.fetchone()[0]
+        cur.execute(f"""
+            INSERT INTO listings (title, quantity, quantity_amount, quantity_unit, type, farmer_id, farmer_name, available_date, price, status)
+            VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, 'available') RETURNING id, {rollups.STATE_COLUMNS};
+        """, (title, quantity, quantity_amount, quantity_unit, type_, farmer_id, farmer_name, available_date, price))
+        row = cur.fetchone()
+        listing_id = row[0]
+        rollups.apply_listing_change(cur, None, row[1:])
         conn.commit()
         cur.close()
+        invalidate(*listing_tags(listing_id, farmer_id))
         return jsonify({'id': listing_id, 'message': 'Listing added'}), 201
     except Exception as e:
         print(f"Error adding listing: {e}")
         return jsonify({'error': 'Failed to add listing'}), 500
-    finally:
-        conn.close()
+
+BULK_IMPORT_MAX_BYTES = int(os.environ.get('BULK_IMPORT_MAX_BYTES', 100 * 1024 * 1024))
+BULK_CONTENT_TYPES = {'text/csv': 'csv', 'application/x-ndjson': 'ndjson', 'application/ndjson': 'ndjson'}
+
+# Bulk import listings from a CSV (header row) or NDJSON request body, streamed
+# through COPY in batches for the signed-in farmer. ?farmer_name= fills rows
+# that omit it, and rows naming another farmer_id are rejected; with
+# ?atomic=true any invalid row aborts the whole import.
+@app.route('/api/listings/bulk', methods=['POST'])
+@sessions.login_required('farmer', owner=lambda: request.args.get('farmer_id'))
+def bulk_import_listings():
+    fmt = request.args.get('format') or BULK_CONTENT_TYPES.get(request.mimetype)
+    if fmt not in ('csv', 'ndjson'):
+        return jsonify({'error': 'Unsupported format, use CSV or NDJSON'}), 400
+    atomic = request.args.get('atomic', '').lower() in ('1', 'true', 'yes')
+    defaults = {k: request.args[k] for k in ('farmer_id', 'farmer_name') if request.args.get(k)}
+    defaults['farmer_id'] = sessions.current_user()
+
+    request.max_content_length = BULK_IMPORT_MAX_BYTES
+    stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+
+    conn = get_db_connection()
+    try:
+        inserted, errors = bulk.import_listings(
+            conn, bulk.owned_records(bulk.read_records(stream, fmt), defaults['farmer_id']), defaults)
+        if atomic and errors:
+            conn.rollback()
+            return jsonify({'inserted': 0, 'errors': errors}), 400
+        conn.commit()
+    except UnicodeDecodeError:
+        return jsonify({'error': 'Body must be UTF-8'}), 400
+    except Exception as e:
+        print(f"Error importing listings: {e}")
+        return jsonify({'error': 'Failed to import listings'}), 500
+
+    invalidate('listings', *{f'listings:farmer:{farmer_id}' for _, farmer_id in inserted})
+    return jsonify({
+        'inserted': len(inserted),
+        'ids': [listing_id for listing_id, _ in inserted],
+        'errors': errors
+    }), 201 if inserted else 200
+
+EXPORT_MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+# Streaming exports (server-side cursor; memory stays flat)
+@app.route('/api/listings/export', methods=['GET'])
+def export_listings():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({'error': 'Unsupported format'}), 400
+    rows = bulk.export_listings(fmt, request.args.get('farmer_id'), request.args.get('type'), request.args.get('status'))
+    return Response(rows, mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=listings.{fmt}'})
+
+# Farmers export the requests for their listings, buyers their own requests
+@app.route('/api/purchase-requests/export', methods=['GET'])
+@sessions.login_required('farmer', 'buyer', owner=lambda: request.args.get(f'{g.principal.role}_id'))
+def export_purchase_requests():
+    fmt = request.args.get('format', 'csv')
+    if fmt not in EXPORT_MIMETYPES:
+        return jsonify({'error': 'Unsupported format'}), 400
+    scope = {'farmer_id': request.args.get('farmer_id'), 'buyer_id': request.args.get('buyer_id'),
+             f'{g.principal.role}_id': sessions.current_user()}
+    rows = bulk.export_purchase_requests(fmt, scope['farmer_id'], scope['buyer_id'],
+                                         request.args.get('archived') == '1')
+    return Response(rows, mimetype=EXPORT_MIMETYPES[fmt],
+                    headers={'Content-Disposition': f'attachment; filename=purchase_requests.{fmt}'})
 
 # Update listing
 @app.route('/api/listings/<int:id>', methods=['PUT'])
+@sessions.login_required('farmer', owner=lambda id: sessions.claimed('farmer_id'))
 def update_listing(id):
     data = request.get_json()
     title = data.get('title')
@@ -236,145 +290,260 @@ def update_listing(id):
 
     if not all([title, quantity, type_, farmer_id, farmer_name]):
         return jsonify({'error': 'Missing required fields'}), 400
+    try:
+        quantity_amount, quantity_unit = parse_quantity(quantity)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
+        old = rollups.fetch_listing_state(cur, id)
+        cur.execute(f"""
             UPDATE listings
-            SET title = %s, quantity = %s, type = %s, farmer_id = %s, farmer_name = %s, available_date = %s, price = %s
-            WHERE id = %s AND status = 'available' RETURNING id;
-        """, (title, quantity, type_, farmer_id, farmer_name, available_date, price, id))
-        updated_id = cur.fetchone()
+            SET title = %s, quantity = %s, quantity_amount = %s, quantity_unit = %s, type = %s,
+                farmer_id = %s, farmer_name = %s, available_date = %s, price = %s
+            WHERE id = %s AND farmer_id = %s AND status = 'available' RETURNING {rollups.STATE_COLUMNS};
+        """, (title, quantity, quantity_amount, quantity_unit, type_, farmer_id, farmer_name, available_date, price, id,
+              sessions.current_user()))
+        updated = cur.fetchone()
+        if updated:
+            rollups.apply_listing_change(cur, old, updated)
         conn.commit()
         cur.close()
-        if updated_id:
+        if updated:
+            invalidate(*listing_tags(id, farmer_id), *listing_tags(id, old[0]))
             return jsonify({'message': 'Listing updated'}), 200
         else:
             return jsonify({'error': 'Listing not found or already claimed'}), 404
     except Exception as e:
         print(f"Error updating listing: {e}")
         return jsonify({'error': 'Failed to update listing'}), 500
-    finally:
-        conn.close()
 
-# Get all listings
+# Cache tags touched by a write to one listing
+def listing_tags(listing_id, farmer_id, claimed_by=None):
+    tags = ['listings', f'listing:{listing_id}', f'listings:farmer:{farmer_id}']
+    if claimed_by:
+        tags.append(f'listings:claimed:{claimed_by}')
+    return tags
+
+# Cache tags a listing query depends on: farmer- or NGO-scoped queries only
+# need to be dropped when that farmer's or NGO's listings change
+def listing_query_tags(args):
+    if args.get('farmer_id'):
+        return [f"listings:farmer:{args['farmer_id']}"]
+    if args.get('claimed_by'):
+        return [f"listings:claimed:{args['claimed_by']}"]
+    return ['listings']
+
+# Get listings, filtered server-side and paginated by keyset cursor (see
+# queries.ListingQuery for the params). The next page's cursor is returned in
+# the X-Next-Cursor header so the body stays a plain list.
 @app.route('/api/listings', methods=['GET'])
+@cached(lambda: listing_query_tags(request.args))
+@db.replica_read
 def get_listings():
+    return listing_page(request.args, 'id')
+
+# Ranked search over listing title, farmer name and type: ?q= plus the
+# /api/listings filters. Every word matches as a prefix (autocomplete) and
+# near-misses still match through trigram similarity; results come best
+# match first (or in ?sort= order), paginated by X-Next-Cursor.
+@app.route('/api/listings/search', methods=['GET'])
+@cached(lambda: listing_query_tags(request.args))
+@db.replica_read
+def search_listings():
+    if not request.args.get('q', '').strip():
+        return jsonify({'error': 'Missing q'}), 400
+    return listing_page(request.args, 'relevance')
+
+def listing_page(args, default_sort):
+    try:
+        fmt = encoding.list_format(args)
+        query = ListingQuery(args, default_sort, paginate=fmt != 'ndjson')
+    except ValueError as e:  # InvalidQuery or an unsupported format
+        return jsonify({'error': str(e)}), 400
+    if fmt == 'ndjson':
+        return ndjson_response(query.sql, query.params, query.shape)
+
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("SELECT id, title, quantity, type, farmer_id, farmer_name, available_date, price, status, claimed_by FROM listings;")
-        listings = cur.fetchall()
+        cur.execute(query.sql, query.params)
+        rows, next_cursor = query.page(cur.fetchall())
         cur.close()
-        return jsonify([{
-            'id': row[0],
-            'title': row[1],
-            'quantity': row[2],
-            'type': row[3],
-            'farmer_id': row[4],
-            'farmer_name': row[5],
-            'available_date': row[6].isoformat() if row[6] else None,
-            'price': float(row[7]) if row[7] is not None else None,
-            'status': row[8],
-            'claimed_by': row[9]
-        } for row in listings]), 200
+        return list_response(rows, query.shape, fmt, next_cursor), 200
     except Exception as e:
         print(f"Error fetching listings: {e}")
         return jsonify({'error': 'Failed to fetch listings'}), 500
-    finally:
-        conn.close()
+
+# List endpoints take ?format=json (array of objects, the default), columnar
+# (field names once plus one array per field) or ndjson (one object per line,
+# streamed from a server-side cursor with no page limit and not cached)
+def list_response(rows, shape, fmt, next_cursor=None):
+    body, mimetype = encoding.encode_rows(rows, shape, fmt)
+    response = Response(body, mimetype=mimetype)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    return response
+
+def ndjson_response(sql, params, shape):
+    return Response(bulk.export_query(sql, params, None, 'ndjson', shape), mimetype=encoding.NDJSON_MIMETYPE)
+
+# Get single listing
+@app.route('/api/listings/<int:id>', methods=['GET'])
+@cached(lambda id: [f'listing:{id}'])
+def get_listing(id):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(queries.LISTING_BY_ID_SQL, (id,))
+        row = cur.fetchone()
+        cur.close()
+        if row:
+            return jsonify(queries.listing_to_dict(row)), 200
+        else:
+            return jsonify({'error': 'Listing not found'}), 404
+    except Exception as e:
+        print(f"Error fetching listing: {e}")
+        return jsonify({'error': 'Failed to fetch listing'}), 500
 
 # Delete listing
 @app.route('/api/listings/<int:id>', methods=['DELETE'])
+@sessions.login_required('farmer')
 def delete_listing(id):
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("DELETE FROM listings WHERE id = %s RETURNING id;", (id,))
-        deleted_id = cur.fetchone()
+        cur.execute(f"DELETE FROM listings WHERE id = %s AND farmer_id = %s RETURNING {rollups.STATE_COLUMNS};",
+                    (id, sessions.current_user()))
+        deleted = cur.fetchone()
+        if deleted:
+            rollups.apply_listing_change(cur, deleted, None)
         conn.commit()
         cur.close()
-        if deleted_id:
+        if deleted:
+            invalidate(*listing_tags(id, deleted[0], deleted[4]))
             return jsonify({'message': 'Listing deleted'}), 200
         else:
             return jsonify({'error': 'Listing not found'}), 404
     except Exception as e:
         print(f"Error deleting listing: {e}")
         return jsonify({'error': 'Failed to delete listing'}), 500
-    finally:
-        conn.close()
 
-# Claim donation
+# Claim donation. Racing claims for the same donation don't queue: the loser
+# gets 409 with Retry-After, and repeating your own claim is a no-op. Retries
+# may send an Idempotency-Key header.
 @app.route('/api/claim/<int:id>', methods=['POST'])
+@sessions.login_required('ngo', owner=lambda id: sessions.claimed('claimed_by'))
 def claim_donation(id):
     data = request.get_json()
     claimed_by = data.get('claimed_by')
 
     if not claimed_by:
         return jsonify({'error': 'Missing claimed_by'}), 400
+    key = request.headers.get(idempotency.IDEMPOTENCY_HEADER)
+    if key is not None and not idempotency.valid_key(key):
+        return jsonify({'error': 'Invalid Idempotency-Key'}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            UPDATE listings
-            SET status = 'claimed', claimed_by = %s
-            WHERE id = %s AND type = 'donate' AND status = 'available' RETURNING id;
-        """, (claimed_by, id))
-        claimed_id = cur.fetchone()
+        if key:
+            stored = idempotency.begin(cur, 'claim', key, idempotency.fingerprint(id, claimed_by))
+            if stored:
+                conn.rollback()
+                return idempotent_replay(*stored)
+        outcome, farmer_id = purchases.claim(cur, id, claimed_by)
+        if outcome == 'busy':
+            conn.rollback()
+            return retry_later('Donation is being claimed by someone else', purchases.BUSY_RETRY_AFTER)
+        if outcome == 'not_found':
+            body, status = {'error': 'Listing not found, not a donation, or already claimed'}, 404
+        else:
+            body, status = {'message': 'Donation claimed'}, 200
+        if key:
+            idempotency.save(cur, 'claim', key, status, body)
         conn.commit()
         cur.close()
-        if claimed_id:
-            return jsonify({'message': 'Donation claimed'}), 200
-        else:
-            return jsonify({'error': 'Listing not found, not a donation, or already claimed'}), 404
+        if outcome == 'claimed':
+            invalidate(*listing_tags(id, farmer_id, claimed_by))
+        return jsonify(body), status
+    except idempotency.KeyMismatch as e:
+        return jsonify({'error': str(e)}), 422
+    except idempotency.KeyInFlight as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         print(f"Error claiming donation: {e}")
         return jsonify({'error': 'Failed to claim donation'}), 500
-    finally:
-        conn.close()
+
+def retry_later(message, seconds):
+    response = jsonify({'error': message, 'retry_after': seconds})
+    response.headers['Retry-After'] = str(seconds)
+    return response, 409
+
+def idempotent_replay(status, body):
+    response = jsonify(body)
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response, status
 
 # Get NGO profile
 @app.route('/api/ngo/profile', methods=['GET'])
+@sessions.login_required('ngo', owner=lambda: request.args.get('ngo_id'))
+@cached(lambda: [f"ngo_profile:{request.args.get('ngo_id')}"])
+@db.replica_read
 def get_ngo_profile():
     ngo_id = request.args.get('ngo_id')
     if not ngo_id:
         return jsonify({'error': 'Missing ngo_id'}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("SELECT org_name, contact, address, focus_area FROM ngo_profiles WHERE ngo_id = %s;", (ngo_id,))
+        cur.execute(queries.NGO_PROFILE_SQL, (ngo_id,))
         profile = cur.fetchone()
         cur.close()
         if profile:
-            return jsonify({
-                'org_name': profile[0],
-                'contact': profile[1],
-                'address': profile[2],
-                'focus_area': profile[3]
-            }), 200
+            return jsonify(queries.ngo_profile(profile)), 200
         else:
             return jsonify({'message': 'No profile found'}), 404
     except Exception as e:
         print(f"Error fetching NGO profile: {e}")
         return jsonify({'error': 'Failed to fetch profile'}), 500
-    finally:
-        conn.close()
+
+# "Recommended for you": available donations ranked for one NGO by how well
+# they fit its focus area and past claims (see matching.py), paginated by
+# X-Next-Cursor
+@app.route('/api/ngo/recommended', methods=['GET'])
+@sessions.login_required('ngo', owner=lambda: request.args.get('ngo_id'))
+@cached(lambda: ['listings', f"ngo_profile:{request.args.get('ngo_id')}"])
+@db.replica_read
+def get_recommended_donations():
+    ngo_id = request.args.get('ngo_id')
+    if not ngo_id:
+        return jsonify({'error': 'Missing ngo_id'}), 400
+    try:
+        fmt = encoding.list_format(request.args)
+        query = queries.RecommendationQuery(ngo_id, request.args, paginate=fmt != 'ndjson')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if fmt == 'ndjson':
+        return ndjson_response(query.sql, query.params, query.shape)
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(query.sql, query.params)
+        rows, next_cursor = query.page(cur.fetchall())
+        cur.close()
+        return list_response(rows, query.shape, fmt, next_cursor), 200
+    except Exception as e:
+        print(f"Error fetching recommendations: {e}")
+        return jsonify({'error': 'Failed to fetch recommendations'}), 500
 
 # Create/Update NGO profile
 @app.route('/api/ngo/profile', methods=['POST'])
+@sessions.login_required('ngo', owner=lambda: sessions.claimed('ngo_id'))
 def update_ngo_profile():
     data = request.get_json()
     ngo_id = data.get('ngo_id')
@@ -387,8 +556,6 @@ def update_ngo_profile():
         return jsonify({'error': 'Missing fields'}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
         cur.execute("""
@@ -399,296 +566,387 @@ def update_ngo_profile():
         """, (ngo_id, org_name, contact, address, focus_area, org_name, contact, address, focus_area))
         conn.commit()
         cur.close()
+        invalidate(f'ngo_profile:{ngo_id}')
         return jsonify({'message': 'Profile updated'}), 200
     except Exception as e:
         print(f"Error updating NGO profile: {e}")
         return jsonify({'error': 'Failed to update profile'}), 500
-    finally:
-        conn.close()
 
 # Analytics endpoints
 @app.route('/api/analytics/farmer/<farmer_id>', methods=['GET'])
+@sessions.login_required('farmer', owner=lambda farmer_id: farmer_id)
+@db.replica_read
 def get_farmer_analytics(farmer_id):
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT type, quantity, price, status, available_date 
-            FROM listings 
-            WHERE farmer_id = %s;
-        """, (farmer_id,))
-        listings = cur.fetchall()
+        cur.execute(queries.FARMER_ANALYTICS_SQL, (farmer_id,))
+        rows = cur.fetchall()
         cur.close()
-        
-        total_quantity = 0
-        total_earnings = 0
-        sell_count = 0
-        barter_count = 0
-        donate_count = 0
-        monthly_data = {}
-        
-        for listing in listings:
-            type_, qty_str, price, status, date = listing
-            try:
-                qty = float(qty_str.split()[0])
-            except:
-                qty = 0
-            
-            total_quantity += qty
-            
-            if type_ == 'sell' and price:
-                total_earnings += float(price) * qty
-                sell_count += 1
-            elif type_ == 'barter':
-                barter_count += 1
-            elif type_ == 'donate':
-                donate_count += 1
-            
-            if date:
-                month_key = date.strftime('%Y-%m')
-                if month_key not in monthly_data:
-                    monthly_data[month_key] = {'quantity': 0, 'earnings': 0}
-                monthly_data[month_key]['quantity'] += qty
-                if type_ == 'sell' and price:
-                    monthly_data[month_key]['earnings'] += float(price) * qty
-        
-        return jsonify({
-            'total_quantity': total_quantity,
-            'total_earnings': total_earnings,
-            'sell_count': sell_count,
-            'barter_count': barter_count,
-            'donate_count': donate_count,
-            'monthly_data': monthly_data
-        }), 200
+        return jsonify(queries.farmer_analytics(rows)), 200
     except Exception as e:
         print(f"Error fetching farmer analytics: {e}")
         return jsonify({'error': 'Failed to fetch analytics'}), 500
-    finally:
-        conn.close()
 
 @app.route('/api/analytics/buyer/<buyer_id>', methods=['GET'])
+@sessions.login_required('buyer', owner=lambda buyer_id: buyer_id)
+@db.replica_read
 def get_buyer_analytics(buyer_id):
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT title, quantity, price, type 
-            FROM listings 
-            WHERE type IN ('sell', 'barter') AND status = 'available';
-        """)
-        listings = cur.fetchall()
+        cur.execute(queries.BUYER_ANALYTICS_SQL)
+        rows = cur.fetchall()
+        cur.execute(queries.BUYER_SPEND_SQL, (buyer_id,))
+        spend_rows = cur.fetchall()
+        cur.execute(queries.CROP_PRICES_SQL, (buyer_id, pricing.PRICE_STATS_MAX_CROPS))
+        price_rows = cur.fetchall()
         cur.close()
-        
-        total_listings = len(listings)
-        avg_savings = 0
-        crop_types = {}
-        
-        for listing in listings:
-            title, qty_str, price, type_ = listing
-            if type_ == 'sell' and price:
-                retail_price = float(price) * 1.5
-                savings = retail_price - float(price)
-                avg_savings += savings
-                
-                crop_types[title] = crop_types.get(title, 0) + 1
-        
-        return jsonify({
-            'total_listings': total_listings,
-            'avg_savings_per_item': avg_savings / max(total_listings, 1),
-            'crop_types': crop_types
-        }), 200
+        return jsonify(queries.buyer_analytics(rows, spend_rows, price_rows)), 200
     except Exception as e:
         print(f"Error fetching buyer analytics: {e}")
         return jsonify({'error': 'Failed to fetch analytics'}), 500
-    finally:
-        conn.close()
 
 @app.route('/api/analytics/ngo/<ngo_id>', methods=['GET'])
+@sessions.login_required('ngo', owner=lambda ngo_id: ngo_id)
+@db.replica_read
 def get_ngo_analytics(ngo_id):
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT title, quantity, available_date 
-            FROM listings 
-            WHERE type = 'donate' AND claimed_by = %s;
-        """, (ngo_id,))
-        claimed = cur.fetchall()
-        
-        cur.execute("""
-            SELECT title, quantity 
-            FROM listings 
-            WHERE type = 'donate' AND status = 'available';
-        """)
-        available = cur.fetchall()
+        cur.execute(queries.NGO_CLAIMS_SQL, (ngo_id,))
+        rows = cur.fetchall()
+        cur.execute(queries.NGO_AVAILABLE_SQL)
+        available_count = cur.fetchone()[0]
         cur.close()
-        
-        total_claimed_qty = 0
-        monthly_claims = {}
-        crop_types = {}
-        
-        for donation in claimed:
-            title, qty_str, date = donation
-            try:
-                qty = float(qty_str.split()[0])
-            except:
-                qty = 0
-            
-            total_claimed_qty += qty
-            crop_types[title] = crop_types.get(title, 0) + 1
-            
-            if date:
-                month_key = date.strftime('%Y-%m')
-                monthly_claims[month_key] = monthly_claims.get(month_key, 0) + qty
-        
-        return jsonify({
-            'total_claimed_quantity': total_claimed_qty,
-            'claimed_count': len(claimed),
-            'available_count': len(available),
-            'monthly_claims': monthly_claims,
-            'crop_types': crop_types
-        }), 200
+        return jsonify(queries.ngo_analytics(rows, available_count)), 200
     except Exception as e:
         print(f"Error fetching NGO analytics: {e}")
         return jsonify({'error': 'Failed to fetch analytics'}), 500
-    finally:
-        conn.close()
 
-@app.route('/test_db')
-def test_db():
-    conn = get_db_connection()
-    if conn:
-        conn.close()
-        return 'DB Connection Successful!'
-    else:
-        return 'DB Connection Failed!'
+# Liveness: the process is up and serving requests
+@app.route('/api/health/live', methods=['GET'])
+def liveness():
+    return jsonify({'status': 'ok'}), 200
+
+# Readiness, for load balancers and deploys: the database answers and the
+# schema is migrated. Turns 503 as soon as a graceful shutdown starts, so
+# traffic moves to other workers while this one drains.
+@app.route('/api/health/ready', methods=['GET'])
+def readiness():
+    if draining.is_set():
+        return jsonify({'status': 'draining'}), 503
+    try:
+        with db.pool.connection(timeout=READY_DB_TIMEOUT) as conn:
+            current, latest = migrations.schema_status(conn)
+    except Exception as e:
+        print(f"Readiness check failed: {e}")
+        return jsonify({'status': 'unavailable', 'error': 'Database unavailable'}), 503
+    if current < latest:
+        return jsonify({'status': 'unavailable', 'error': 'Schema not migrated',
+                        'schema_version': current, 'expected_schema_version': latest}), 503
+    return jsonify({'status': 'ready', 'schema_version': current}), 200
+
+# Connection pool statistics, for sizing DB_POOL_MIN / DB_POOL_MAX
+@app.route('/api/db/pool', methods=['GET'])
+def get_pool_stats():
+    return jsonify(db.pool.stats()), 200
+
+# Read routing: replica lag and health, primary fallbacks, read-your-writes reroutes
+@app.route('/api/db/routing', methods=['GET'])
+def get_routing_stats():
+    return jsonify(db.router.stats()), 200
+
+# Server-Sent Events feed of listing and purchase request changes for the
+# signed-in user (EventSource can't send headers: ?token=). Reconnects resume
+# from the Last-Event-ID header (or ?last_event_id=).
+@app.route('/api/events', methods=['GET'])
+@sessions.login_required(owner=lambda: request.args.get('username'), query_token=True)
+def get_events():
+    username, role = g.principal.username, g.principal.role
+    last_event_id = request.headers.get('Last-Event-ID') or request.args.get('last_event_id')
+
+    # Subscribe before reading the backlog so nothing falls in between
+    subscription = events.broker.subscribe(username, role)
+    try:
+        with db.pool.connection() as conn:
+            if last_event_id:
+                backlog, truncated = events.replay(conn, int(last_event_id), username, role)
+                last_event_id = int(last_event_id)
+            else:
+                backlog, truncated = [], False
+                last_event_id = events.latest_event_id(conn)
+            conn.rollback()
+    except ValueError:
+        events.broker.unsubscribe(subscription)
+        return jsonify({'error': 'Invalid last_event_id'}), 400
+    except Exception:
+        events.broker.unsubscribe(subscription)
+        raise
+
+    return Response(events.stream(subscription, backlog, last_event_id, truncated),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+# Drop cached reads touched by a change, including ones made by other processes
+def invalidate_for_event(event):
+    payload = event['payload']
+    if event['kind'] == 'listings':
+        invalidate(*listing_tags(payload['id'], payload['farmer_id'], payload.get('claimed_by')))
+    elif event['kind'] == 'purchase_requests' and event['op'] == 'archive':
+        # Months moved to the archive (see partitions.py): every request list may have changed
+        response_cache.clear()
+    elif event['kind'] == 'purchase_requests':
+        invalidate(f"purchase_requests:farmer:{payload['farmer_id']}", f"purchase_requests:buyer:{payload['buyer_id']}")
+
+events.broker.add_listener(invalidate_for_event)
+
+# Password hashing pool statistics
+@app.route('/api/hashing/stats', methods=['GET'])
+def get_hashing_stats():
+    return jsonify(hashing.hash_pool.stats()), 200
+
+# Response cache statistics
+@app.route('/api/cache/stats', methods=['GET'])
+def get_cache_stats():
+    return jsonify(response_cache.stats()), 200
+
+# Prometheus metrics: per-route latency, DB time, rows and response sizes
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
     
 
 
 
 
-# Create purchase request
+# Create purchase request. Accepts multipart/form-data with a `payment_proof`
+# file, or JSON carrying the proof as a base64 data URL (decoded once, here).
+# Takes (or extends) the buyer's hold on the listing: while another buyer
+# holds it, or is submitting right now, responds 409 with Retry-After. A
+# buyer's second request for the same listing returns the pending one, and
+# an Idempotency-Key header makes client retries replay the first response.
 @app.route('/api/purchase-request', methods=['POST'])
+@sessions.login_required('buyer', owner=lambda: sessions.claimed('buyer_id'))
 def create_purchase_request():
-    data = request.get_json()
+    if request.files:
+        data = request.form
+        proof_file = request.files.get('payment_proof')
+        proof_bytes = proof_file.read() if proof_file else None
+    else:
+        data = request.get_json()
+        payment_proof = data.get('payment_proof')  # base64 encoded image
+        proof_bytes = None
+        if payment_proof:
+            try:
+                proof_bytes = blobstore.decode_data_url(payment_proof)
+            except InvalidBlob as e:
+                return jsonify({'error': str(e)}), 400
     listing_id = data.get('listing_id')
     buyer_id = data.get('buyer_id')
-    payment_proof = data.get('payment_proof')  # base64 encoded image
 
-    if not all([listing_id, buyer_id, payment_proof]):
+    if not all([listing_id, buyer_id, proof_bytes]):
         return jsonify({'error': 'Missing required fields'}), 400
+    key = request.headers.get(idempotency.IDEMPOTENCY_HEADER)
+    if key is not None and not idempotency.valid_key(key):
+        return jsonify({'error': 'Invalid Idempotency-Key'}), 400
+
+    try:
+        proofs.validate(proof_bytes)
+        proof_hash, proof_size, _ = blobstore.store_blob(proof_bytes)
+    except InvalidBlob as e:
+        return jsonify({'error': str(e)}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        # Get listing details
-        cur.execute("""
-            SELECT farmer_id, title, quantity, price 
-            FROM listings 
-            WHERE id = %s AND status = 'available';
-        """, (listing_id,))
-        listing = cur.fetchone()
-        
-        if not listing:
-            cur.close()
-            return jsonify({'error': 'Listing not found or not available'}), 404
-        
-        farmer_id, crop_title, quantity, price = listing
-        
-        # Create purchase request
-        cur.execute("""
-            INSERT INTO purchase_requests 
-            (listing_id, buyer_id, farmer_id, crop_title, quantity, price, payment_proof, status)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, 'pending') RETURNING id;
-        """, (listing_id, buyer_id, farmer_id, crop_title, quantity, price, payment_proof))
-        
-        request_id = cur.fetchone()[0]
+        if key:
+            stored = idempotency.begin(cur, 'purchase-request', key,
+                                       idempotency.fingerprint(str(listing_id), buyer_id, proof_hash))
+            if stored:
+                conn.rollback()
+                return idempotent_replay(*stored)
+        outcome, value = purchases.create_request(cur, listing_id, buyer_id, proof_hash, proof_size)
+        if outcome == 'busy':
+            conn.rollback()
+            return retry_later('Listing is being purchased by another buyer', value)
+        if outcome == 'reserved':
+            conn.rollback()
+            return retry_later('Listing is reserved by another buyer', value)
+        if outcome == 'not_found':
+            body, status = {'error': 'Listing not found or not available'}, 404
+        elif outcome == 'existing':
+            body, status = {'id': value[0], 'message': 'Purchase request already submitted'}, 200
+        else:
+            body, status = {'id': value[0], 'message': 'Purchase request submitted'}, 201
+        if outcome == 'created':
+            proofs.enqueue(cur, proof_hash)
+        if key:
+            idempotency.save(cur, 'purchase-request', key, status, body)
         conn.commit()
         cur.close()
-        return jsonify({'id': request_id, 'message': 'Purchase request submitted'}), 201
+        if outcome == 'created':
+            proofs.worker.submit(proof_hash)
+            invalidate(f'purchase_requests:farmer:{value[1]}', f'purchase_requests:buyer:{buyer_id}')
+        return jsonify(body), status
+    except idempotency.KeyMismatch as e:
+        return jsonify({'error': str(e)}), 422
+    except idempotency.KeyInFlight as e:
+        return jsonify({'error': str(e)}), 409
     except Exception as e:
         print(f"Error creating purchase request: {e}")
         return jsonify({'error': 'Failed to create purchase request'}), 500
-    finally:
-        conn.close()
+
+# Reserve a listing for a buyer while they pay: {"buyer_id": ...}. Other
+# buyers get 409 with Retry-After until the hold expires (HOLD_TTL seconds)
+# or the holder's request is rejected. Holding again extends the hold.
+@app.route('/api/listings/<int:id>/hold', methods=['POST'])
+@sessions.login_required('buyer', owner=lambda id: sessions.claimed('buyer_id'))
+def hold_listing(id):
+    data = request.get_json() or {}
+    buyer_id = data.get('buyer_id')
+    if not buyer_id:
+        return jsonify({'error': 'Missing buyer_id'}), 400
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        outcome, seconds = purchases.hold(cur, id, buyer_id)
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        print(f"Error holding listing: {e}")
+        return jsonify({'error': 'Failed to reserve listing'}), 500
+
+    if outcome == 'not_found':
+        return jsonify({'error': 'Listing not found or not available'}), 404
+    if outcome == 'busy':
+        return retry_later('Listing is being purchased by another buyer', seconds)
+    if outcome == 'reserved':
+        return retry_later('Listing is reserved by another buyer', seconds)
+    return jsonify({'listing_id': id, 'expires_in': seconds}), 200
+
+# Serve a stored payment proof. Content-addressed, so it never changes:
+# long-lived caching, Range requests and sendfile via the WSGI file wrapper.
+@app.route('/api/proofs/<digest>', methods=['GET'])
+def get_proof(digest):
+    blob = blobstore.open_blob(digest)
+    if blob is None:
+        return jsonify({'error': 'Proof not found'}), 404
+    path, mime = blob
+    response = send_file(path, mimetype=mime, conditional=True, etag=digest, max_age=31536000)
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+# A proof's thumbnail or recompressed full-size image (see proofs.py), by
+# redirect to its blob; the original until the variants are ready
+@app.route('/api/proofs/<digest>/<variant>', methods=['GET'])
+@db.replica_read
+def get_proof_variant(digest, variant):
+    if variant not in proofs.VARIANTS or not blobstore.DIGEST_RE.match(digest):
+        return jsonify({'error': 'Proof not found'}), 404
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        target, ready = proofs.variant_hash(cur, digest, variant)
+        cur.close()
+    except Exception as e:
+        print(f"Error fetching proof variant: {e}")
+        return jsonify({'error': 'Failed to fetch proof'}), 500
+    response = redirect(f'/api/proofs/{target}', code=302)
+    response.headers['Cache-Control'] = 'private, max-age=86400' if ready else 'no-cache'
+    return response
+
+# Legacy inline proof: move it to the blob store, then redirect there. Only
+# for the request's farmer and buyer (?token= for <img>).
+@app.route('/api/purchase-request/<int:request_id>/proof', methods=['GET'])
+@sessions.login_required('farmer', 'buyer', query_token=True)
+def get_legacy_proof(request_id):
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT farmer_id, buyer_id, proof_hash, payment_proof
+            FROM purchase_requests WHERE id = %s FOR UPDATE;
+        """, (request_id,))
+        row = cur.fetchone()
+        if not row or not (row[2] or row[3]) or sessions.current_user() not in (row[0], row[1]):
+            cur.close()
+            return jsonify({'error': 'Proof not found'}), 404
+        farmer_id, buyer_id, proof_hash, payment_proof = row
+        if not proof_hash:
+            proof_hash, proof_size, _ = blobstore.store_blob(blobstore.decode_data_url(payment_proof))
+            cur.execute("""
+                UPDATE purchase_requests
+                SET proof_hash = %s, proof_size = %s, payment_proof = NULL
+                WHERE id = %s;
+            """, (proof_hash, proof_size, request_id))
+            conn.commit()
+            invalidate(f'purchase_requests:farmer:{farmer_id}', f'purchase_requests:buyer:{buyer_id}')
+        cur.close()
+        return redirect(f'/api/proofs/{proof_hash}', code=301)
+    except InvalidBlob as e:
+        return jsonify({'error': f'Unreadable payment proof: {e}'}), 404
+    except Exception as e:
+        print(f"Error migrating payment proof: {e}")
+        return jsonify({'error': 'Failed to fetch proof'}), 500
 
 # Get purchase requests for farmer
 @app.route('/api/purchase-requests/farmer/<farmer_id>', methods=['GET'])
+@sessions.login_required('farmer', owner=lambda farmer_id: farmer_id)
+@cached(lambda farmer_id: [f'purchase_requests:farmer:{farmer_id}'])
+@db.replica_read
 def get_farmer_purchase_requests(farmer_id):
+    try:
+        fmt = encoding.list_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # ?archived=1: requests older than partitions.ARCHIVE_AFTER_MONTHS
+    sql = queries.FARMER_ARCHIVED_REQUESTS_SQL if request.args.get('archived') == '1' else queries.FARMER_REQUESTS_SQL
+    if fmt == 'ndjson':
+        return ndjson_response(sql, (farmer_id,), queries.farmer_request)
+
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT id, listing_id, buyer_id, crop_title, quantity, price, 
-                   payment_proof, status, created_at 
-            FROM purchase_requests 
-            WHERE farmer_id = %s 
-            ORDER BY created_at DESC;
-        """, (farmer_id,))
-        requests = cur.fetchall()
+        cur.execute(sql, (farmer_id,))
+        response = list_response(cur, queries.farmer_request, fmt)
         cur.close()
-        return jsonify([{
-            'id': row[0],
-            'listing_id': row[1],
-            'buyer_id': row[2],
-            'crop_title': row[3],
-            'quantity': row[4],
-            'price': float(row[5]) if row[5] is not None else None,
-            'payment_proof': row[6],
-            'status': row[7],
-            'created_at': row[8].isoformat() if row[8] else None
-        } for row in requests]), 200
+        return response, 200
     except Exception as e:
         print(f"Error fetching purchase requests: {e}")
         return jsonify({'error': 'Failed to fetch requests'}), 500
-    finally:
-        conn.close()
 
 # Get purchase requests for buyer
 @app.route('/api/purchase-requests/buyer/<buyer_id>', methods=['GET'])
+@sessions.login_required('buyer', owner=lambda buyer_id: buyer_id)
+@cached(lambda buyer_id: [f'purchase_requests:buyer:{buyer_id}'])
+@db.replica_read
 def get_buyer_purchase_requests(buyer_id):
+    try:
+        fmt = encoding.list_format(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # ?archived=1: requests older than partitions.ARCHIVE_AFTER_MONTHS
+    sql = queries.BUYER_ARCHIVED_REQUESTS_SQL if request.args.get('archived') == '1' else queries.BUYER_REQUESTS_SQL
+    if fmt == 'ndjson':
+        return ndjson_response(sql, (buyer_id,), queries.buyer_request)
+
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        cur.execute("""
-            SELECT id, listing_id, farmer_id, crop_title, quantity, price, 
-                   status, created_at 
-            FROM purchase_requests 
-            WHERE buyer_id = %s 
-            ORDER BY created_at DESC;
-        """, (buyer_id,))
-        requests = cur.fetchall()
+        cur.execute(sql, (buyer_id,))
+        response = list_response(cur, queries.buyer_request, fmt)
         cur.close()
-        return jsonify([{
-            'id': row[0],
-            'listing_id': row[1],
-            'farmer_id': row[2],
-            'crop_title': row[3],
-            'quantity': row[4],
-            'price': float(row[5]) if row[5] is not None else None,
-            'status': row[6],
-            'created_at': row[7].isoformat() if row[7] else None
-        } for row in requests]), 200
+        return response, 200
     except Exception as e:
         print(f"Error fetching purchase requests: {e}")
         return jsonify({'error': 'Failed to fetch requests'}), 500
-    finally:
-        conn.close()
 
-# Approve/Reject purchase request
+# Approve/Reject purchase request. Approving sells the listing and rejects
+# the other pending requests for it.
 @app.route('/api/purchase-request/<int:request_id>/status', methods=['PUT'])
+@sessions.login_required('farmer')
 def update_purchase_request_status(request_id):
     data = request.get_json()
     status = data.get('status')  # 'approved' or 'rejected'
@@ -697,48 +955,83 @@ def update_purchase_request_status(request_id):
         return jsonify({'error': 'Invalid status'}), 400
 
     conn = get_db_connection()
-    if conn is None:
-        return jsonify({'error': 'DB connection failed'}), 500
     try:
         cur = conn.cursor()
-        # Get request details
-        cur.execute("""
-            SELECT listing_id FROM purchase_requests WHERE id = %s;
-        """, (request_id,))
-        result = cur.fetchone()
-        
-        if not result:
-            cur.close()
-            return jsonify({'error': 'Request not found'}), 404
-        
-        listing_id = result[0]
-        
-        # Update request status
-        cur.execute("""
-            UPDATE purchase_requests 
-            SET status = %s 
-            WHERE id = %s;
-        """, (status, request_id))
-        
-        # If approved, mark listing as sold
-        if status == 'approved':
-            cur.execute("""
-                UPDATE listings 
-                SET status = 'sold' 
-                WHERE id = %s;
-            """, (listing_id,))
-        
+        approve, reject = ([request_id], []) if status == 'approved' else ([], [request_id])
+        results, changed = purchases.decide(cur, approve, reject, sessions.current_user())
         conn.commit()
         cur.close()
-        return jsonify({'message': f'Request {status}'}), 200
     except Exception as e:
         print(f"Error updating purchase request: {e}")
         return jsonify({'error': 'Failed to update request'}), 500
-    finally:
-        conn.close()
 
-# Initialize DB when app starts
-init_db()
+    invalidate_decisions(changed)
+    outcome = results[0]
+    if outcome['outcome'] == 'not_found':
+        return jsonify({'error': 'Request not found'}), 404
+    if outcome['outcome'] == 'not_pending':
+        return jsonify({'error': f"Request already {outcome['status']}"}), 409
+    if outcome['outcome'] == 'listing_unavailable':
+        return jsonify({'error': 'Listing is no longer available'}), 409
+    return jsonify({'message': f'Request {status}'}), 200
+
+# Approve/reject many of the signed-in farmer's purchase requests in one
+# transaction: {"approve": [ids], "reject": [ids]}. Responds with one outcome
+# per request: approved, rejected, auto_rejected (lost to another approval for
+# the same listing), not_found (including other farmers' requests),
+# not_pending or listing_unavailable. Competing requests auto-rejected by an
+# approval are listed too.
+@app.route('/api/purchase-requests/status', methods=['POST'])
+@sessions.login_required('farmer', owner=lambda: sessions.claimed('farmer_id'))
+def update_purchase_request_statuses():
+    data = request.get_json() or {}
+    try:
+        approve = [int(i) for i in data.get('approve', [])]
+        reject = [int(i) for i in data.get('reject', [])]
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Request ids must be integers'}), 400
+    if not approve and not reject:
+        return jsonify({'error': 'Nothing to update'}), 400
+    if set(approve) & set(reject):
+        return jsonify({'error': 'A request cannot be both approved and rejected'}), 400
+    if len(approve) + len(reject) > purchases.DECISION_BATCH_MAX:
+        return jsonify({'error': f'At most {purchases.DECISION_BATCH_MAX} requests per batch'}), 400
+
+    conn = get_db_connection()
+    try:
+        cur = conn.cursor()
+        results, changed = purchases.decide(cur, approve, reject, sessions.current_user())
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        print(f"Error updating purchase requests: {e}")
+        return jsonify({'error': 'Failed to update requests'}), 500
+
+    invalidate_decisions(changed)
+    return jsonify({'results': results}), 200
+
+def invalidate_decisions(changed):
+    tags = set()
+    for listing_id, farmer_id, buyer_id, sold in changed:
+        tags.update((f'purchase_requests:farmer:{farmer_id}', f'purchase_requests:buyer:{buyer_id}'))
+        if sold:
+            tags.update(listing_tags(listing_id, farmer_id))
+    if tags:
+        invalidate(*tags)
+
+# Per-process startup. Under the preforking server (serve.py) the master only
+# imports the app; each worker runs this after it is forked.
+def start_process():
+    for pool in db.router.pools():
+        pool.open()
+    events.broker.start()
+    sessions.cache.start()
+    proofs.worker.start()
+    pricing.refresher.start()
+
+check_schema()
+if os.environ.get('SERVER_PREFORK') != '1':
+    start_process()
 
 if __name__ == '__main__':
     app.run(debug=True)
\ No newline at end of file
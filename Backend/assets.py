@@ -0,0 +1,142 @@
+import hashlib
+import mimetypes
+import os
+import re
+import threading
+
+from flask import abort, current_app, request
+
+import encoding
+
+# The Frontend directory is loaded into memory once: every file with its
+# compressed variants, so a page load costs a dict lookup per asset, no disk
+# reads and no compression. style.css and the scripts are fingerprinted
+# (style.<hash>.css) and the HTML pages are rewritten to point at those names,
+# which lets browsers cache them forever; a changed file gets a new name.
+FRONTEND_DIR = os.environ.get('FRONTEND_DIR',
+                              os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'Frontend'))
+FINGERPRINTED = ('style.css', 'dashboard.js', 'analytics.js', 'auth.js', 'events.js')
+# Re-read the directory when a file changes (for development; defaults to the app's debug mode)
+ASSETS_WATCH = os.environ.get('ASSETS_WATCH')
+
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+
+
+class Asset:
+    __slots__ = ('body', 'mimetype', 'etag', 'cache_control', 'encoded')
+
+    def __init__(self, body, mimetype, cache_control):
+        self.body = body
+        self.mimetype = mimetype
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.cache_control = cache_control
+        self.encoded = {}               # content coding -> compressed body
+        if encoding.compressible(mimetype, len(body)):
+            self.encoded['gzip'] = encoding.compress(body, 'gzip')
+            if encoding.brotli is not None:
+                self.encoded['br'] = encoding.compress(body, 'br')
+
+
+def _fingerprinted_name(name, body):
+    stem, ext = os.path.splitext(name)
+    return f"{stem}.{hashlib.blake2b(body, digest_size=16).hexdigest()[:12]}{ext}"
+
+
+def _mimetype(name):
+    return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+
+class AssetStore:
+    def __init__(self, directory):
+        self.directory = directory
+        self._lock = threading.Lock()
+        self._assets = None             # URL path -> Asset
+        self._mtime = None
+
+    def _scan_mtime(self):
+        with os.scandir(self.directory) as entries:
+            return max((entry.stat().st_mtime for entry in entries if entry.is_file()), default=0)
+
+    def load(self):
+        files = {}
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                if entry.is_file() and not entry.name.startswith('.'):
+                    with open(entry.path, 'rb') as f:
+                        files[entry.name] = f.read()
+
+        assets = {}
+        urls = {}
+        for name in FINGERPRINTED:
+            if name in files:
+                urls[name] = _fingerprinted_name(name, files[name])
+                assets[urls[name]] = Asset(files[name], _mimetype(name), IMMUTABLE)
+        # HTML references to fingerprinted files: href="style.css", src="./dashboard.js"
+        pattern = re.compile(r'''((?:href|src)=["'](?:\./)?)(%s)(["'])''' % '|'.join(map(re.escape, urls)))
+        for name, body in files.items():
+            if name.endswith('.html') and urls:
+                body = pattern.sub(lambda m: m.group(1) + urls[m.group(2)] + m.group(3),
+                                   body.decode('utf-8')).encode('utf-8')
+            # Unfingerprinted names stay reachable (and revalidated) for old links
+            assets[name] = Asset(body, _mimetype(name), REVALIDATE)
+        with self._lock:
+            self._assets = assets
+            self._mtime = self._scan_mtime()
+
+    def get(self, path, watch=False):
+        if self._assets is None or (watch and self._scan_mtime() != self._mtime):
+            self.load()
+        return self._assets.get(path)
+
+    def stats(self):
+        assets = self._assets or {}
+        return {
+            'files': len(assets),
+            'bytes': sum(len(a.body) + sum(map(len, a.encoded.values())) for a in assets.values()),
+        }
+
+    # Write every asset and its .gz/.br variants to a directory, for a reverse
+    # proxy or CDN to serve instead of the API workers
+    def build(self, out_dir):
+        if self._assets is None:
+            self.load()
+        os.makedirs(out_dir, exist_ok=True)
+        written = 0
+        for path, asset in self._assets.items():
+            target = os.path.join(out_dir, path)
+            with open(target, 'wb') as f:
+                f.write(asset.body)
+            for coding, body in asset.encoded.items():
+                with open(f"{target}.{'gz' if coding == 'gzip' else coding}", 'wb') as f:
+                    f.write(body)
+            written += 1
+        return written
+
+
+store = AssetStore(FRONTEND_DIR)
+
+
+def _watch():
+    if ASSETS_WATCH is not None:
+        return ASSETS_WATCH == '1'
+    return current_app.debug
+
+
+# Serve a file from the store, in the best coding the client accepts
+def serve(path):
+    asset = store.get(path, _watch())
+    if asset is None:
+        abort(404)
+    coding = encoding.negotiate(request.headers.get('Accept-Encoding')) if asset.encoded else None
+    if coding in asset.encoded:
+        response = current_app.response_class(asset.encoded[coding], mimetype=asset.mimetype)
+        response.headers['Content-Encoding'] = coding
+        response.set_etag(f'{asset.etag}-{coding}')
+    else:
+        response = current_app.response_class(asset.body, mimetype=asset.mimetype)
+        response.set_etag(asset.etag)
+    if asset.encoded:
+        response.vary.add('Accept-Encoding')
+    response.headers['Cache-Control'] = asset.cache_control
+    return response.make_conditional(request)
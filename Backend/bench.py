@@ -0,0 +1,1114 @@
+"""Load-testing harness for the Harvest Hub API.
+
+Runs against a throwaway Postgres only: the target database name (DB_NAME)
+must contain "bench" unless --force is given, and `seed --reset` drops the
+whole public schema. Point BLOB_DIR at a scratch directory as well, since
+seeding writes payment proofs to the blob store.
+
+    DB_NAME=harvesthub_bench BLOB_DIR=/tmp/bench-blobs python bench.py seed --reset
+    DB_NAME=harvesthub_bench BLOB_DIR=/tmp/bench-blobs python bench.py run --output bench.json
+    python bench.py compare before.json after.json
+    DB_NAME=harvesthub_bench BLOB_DIR=/tmp/bench-blobs python bench.py contention
+    DB_NAME=harvesthub_bench python bench.py event-order
+    DB_NAME=harvesthub_bench python bench.py partition-moves
+
+Requests are signed in as the simulated users with session tokens the bench
+issues itself, so with --url the bench needs the server's SESSION_SECRET.
+
+`run` starts the app in-process on a threaded development server unless
+--url points at an already running server. Every route is driven with a
+mixed farmer / buyer / NGO workload and the report (per-route throughput and
+p50/p95/p99 latency) is written as JSON so runs from different commits can be
+compared.
+
+`contention` points many buyers and NGOs at a handful of fresh listings at
+once, sends every request several times with the same idempotency key while
+a farmer keeps approving, and exits non-zero if a listing was sold twice, a
+retry created a duplicate, a donation went to two NGOs or the rollups drifted.
+
+`event-order` commits two transactions' change events in the opposite order
+of their ids and exits non-zero if resuming the feed from the token a client
+held in between misses the later commit.
+
+`partition-moves` runs the row moves of partition maintenance (into a new
+month, back from a detached one, resolved ones into the archive) on a few
+requests from 1989-90 inside one transaction, rolls it back, and exits
+non-zero if a move wrote change events.
+"""
+import argparse
+import base64
+import csv
+import http.client
+import io
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import date, datetime, timedelta, timezone
+from urllib.parse import urlencode, urlsplit
+
+import db
+import blobstore
+import events
+import hashing
+import migrations
+import partitions
+import purchases
+import rollups
+import sessions
+
+BENCH_PASSWORD = 'bench-password'
+PNG_MAGIC = b'\x89PNG\r\n\x1a\n'
+
+CROPS = ('Tomatoes', 'Potatoes', 'Onions', 'Wheat', 'Rice', 'Maize', 'Carrots', 'Spinach', 'Mangoes', 'Apples',
+         'Oranges', 'Bananas', 'Lentils', 'Chickpeas', 'Cabbage', 'Cauliflower', 'Garlic', 'Ginger', 'Peas', 'Okra')
+UNITS = ('kg', 'kg', 'kg', 'tons', 'crates', 'bags')
+FOCUS_AREAS = ('food security', 'child nutrition', 'disaster relief', 'community kitchens', 'elderly care',
+               'school meals', 'homeless shelters', 'women empowerment')
+
+_tokens = {}
+
+
+# Authorization header of a simulated user; one session per user, as a browser would keep
+def auth_headers(username, role):
+    token = _tokens.get((username, role))
+    if token is None:
+        token = _tokens.setdefault((username, role), sessions.issue(username, role)[0])
+    return {'Authorization': f'Bearer {token}'}
+
+
+# (role, weight) of the simulated users
+ROLE_MIX = (('farmer', 3), ('buyer', 5), ('ngo', 2))
+
+
+def check_target(force):
+    name = db.DB_NAME
+    if 'bench' not in name and not force:
+        sys.exit(f"Refusing to use database {name!r}: set DB_NAME to a throwaway *bench* database or pass --force")
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+    # Nearest-rank percentile
+    rank = max(math.ceil(pct / 100.0 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+def fake_proof(rnd, size):
+    return PNG_MAGIC + rnd.randbytes(max(size - len(PNG_MAGIC), 0))
+
+
+def _copy_rows(cur, table, columns, rows):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    for row in rows:
+        writer.writerow(['' if v is None else v for v in row])
+    buf.seek(0)
+    cur.copy_expert(f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv);", buf)
+
+
+# ---------------------------------------------------------------------------
+# Seeding
+
+def seed(args):
+    check_target(args.force)
+    rnd = random.Random(args.seed)
+    started = time.monotonic()
+    with db.pool.connection() as conn:
+        if args.reset:
+            cur = conn.cursor()
+            cur.execute("DROP SCHEMA public CASCADE; CREATE SCHEMA public;")
+            conn.commit()
+            cur.close()
+        migrations.migrate(conn)
+
+        # One bcrypt hash shared by every seeded user keeps seeding fast
+        password_hash = hashing.hash_password(BENCH_PASSWORD)
+        farmers = [f'bench_farmer_{i:05d}' for i in range(args.farmers)]
+        buyers = [f'bench_buyer_{i:05d}' for i in range(args.buyers)]
+        ngos = [f'bench_ngo_{i:05d}' for i in range(args.ngos)]
+
+        cur = conn.cursor()
+        _copy_rows(cur, 'users', ('username', 'password', 'role'),
+                   [(u, password_hash, 'farmer') for u in farmers] +
+                   [(u, password_hash, 'buyer') for u in buyers] +
+                   [(u, password_hash, 'ngo') for u in ngos])
+        _copy_rows(cur, 'ngo_profiles', ('ngo_id', 'org_name', 'contact', 'address', 'focus_area'),
+                   [(u, f'Org {u}', f'0300-{i:07d}', f'{i} Relief Road', ', '.join(rnd.sample(FOCUS_AREAS, 2)))
+                    for i, u in enumerate(ngos)])
+        conn.commit()
+        print(f"Seeded {len(farmers) + len(buyers) + len(ngos)} users and {len(ngos)} NGO profiles")
+
+        # Listings, in COPY batches
+        today = date.today()
+        columns = ('title', 'quantity', 'quantity_amount', 'quantity_unit', 'type', 'farmer_id', 'farmer_name',
+                   'available_date', 'price', 'status', 'claimed_by')
+        remaining = args.listings
+        while remaining:
+            batch = []
+            for _ in range(min(remaining, 10000)):
+                farmer = rnd.choice(farmers)
+                type_ = rnd.choices(('sell', 'barter', 'donate'), (6, 2, 2))[0]
+                amount = rnd.randint(1, 500)
+                unit = rnd.choice(UNITS)
+                price = round(rnd.uniform(10, 500), 2) if type_ == 'sell' else 0
+                status, claimed_by = 'available', None
+                if rnd.random() < 0.3:
+                    if type_ == 'donate':
+                        status, claimed_by = 'claimed', rnd.choice(ngos) if ngos else None
+                    elif type_ == 'sell':
+                        status = 'sold'
+                available = today + timedelta(days=rnd.randint(-730, 60)) if rnd.random() < 0.9 else None
+                batch.append((rnd.choice(CROPS), f'{amount} {unit}', amount, unit, type_, farmer,
+                              farmer.replace('_', ' ').title(), available, price, status, claimed_by))
+            _copy_rows(cur, 'listings', columns, batch)
+            conn.commit()
+            remaining -= len(batch)
+        rollups.rebuild(conn)
+        print(f"Seeded {args.listings} listings")
+
+        # Purchase requests against sell/barter listings, proofs in the blob
+        # store (a --legacy-proofs fraction stays inline as base64 data URLs)
+        cur.execute("SELECT id, farmer_id, title, quantity, price FROM listings WHERE type IN ('sell', 'barter');")
+        targets = cur.fetchall()
+        proofs = []
+        for _ in range(args.proof_variants):
+            data = fake_proof(rnd, int(args.proof_kb * 1024 * rnd.uniform(0.5, 1.5)))
+            digest, size, _ = blobstore.store_blob(data)
+            proofs.append((data, digest, size))
+        columns = ('listing_id', 'buyer_id', 'farmer_id', 'crop_title', 'quantity', 'price', 'payment_proof',
+                   'proof_hash', 'proof_size', 'status', 'created_at')
+        remaining = args.requests if targets else 0
+        now = datetime.now()
+        partitions.ensure_partitions(conn, now - timedelta(days=365))
+        while remaining:
+            batch = []
+            for _ in range(min(remaining, 2000)):
+                listing_id, farmer_id, title, quantity, price = rnd.choice(targets)
+                data, digest, size = rnd.choice(proofs)
+                if rnd.random() < args.legacy_proofs:
+                    inline, digest, size = 'data:image/png;base64,' + base64.b64encode(data).decode('ascii'), None, None
+                else:
+                    inline = None
+                status = rnd.choices(('pending', 'approved', 'rejected'), (2, 1, 1))[0]
+                created = now - timedelta(seconds=rnd.randint(0, 365 * 86400))
+                batch.append((listing_id, rnd.choice(buyers), farmer_id, title, quantity, price, inline,
+                              digest, size, status, created.isoformat(sep=' ')))
+            _copy_rows(cur, 'purchase_requests', columns, batch)
+            conn.commit()
+            remaining -= len(batch)
+        cur.execute("ANALYZE;")
+        conn.commit()
+        cur.close()
+    hashing.hash_pool.shutdown()
+    print(f"Seeded {args.requests if targets else 0} purchase requests in {time.monotonic() - started:.1f}s")
+
+
+# ---------------------------------------------------------------------------
+# Workload
+
+class Dataset:
+    """Ids sampled from the seeded database that the simulated users act on."""
+
+    def __init__(self, conn, sample_size):
+        cur = conn.cursor()
+        cur.execute("SELECT username, role FROM users WHERE username LIKE 'bench%';")
+        users = cur.fetchall()
+        self.farmers = [u for u, r in users if r == 'farmer']
+        self.buyers = [u for u, r in users if r == 'buyer']
+        self.ngos = [u for u, r in users if r == 'ngo']
+        cur.execute("SELECT id, farmer_id, type, status FROM listings ORDER BY random() LIMIT %s;", (sample_size,))
+        self.listings = cur.fetchall()
+        self.market = [row[0] for row in self.listings if row[2] in ('sell', 'barter') and row[3] == 'available']
+        self.donations = [row[0] for row in self.listings if row[2] == 'donate' and row[3] == 'available']
+        cur.execute("SELECT id, farmer_id FROM purchase_requests WHERE status = 'pending' ORDER BY random() LIMIT %s;",
+                    (sample_size,))
+        self.pending = cur.fetchall()
+        cur.execute("SELECT DISTINCT proof_hash FROM purchase_requests WHERE proof_hash <> '' LIMIT 100;")
+        self.digests = [row[0] for row in cur.fetchall()]
+        cur.execute("""
+            SELECT id, buyer_id FROM purchase_requests
+            WHERE proof_hash IS NULL AND payment_proof IS NOT NULL LIMIT %s;
+        """, (sample_size,))
+        self.legacy = cur.fetchall()
+        cur.execute("SELECT (SELECT COUNT(*) FROM users), (SELECT COUNT(*) FROM listings), "
+                    "(SELECT COUNT(*) FROM ngo_profiles), (SELECT COUNT(*) FROM purchase_requests);")
+        self.counts = dict(zip(('users', 'listings', 'ngo_profiles', 'purchase_requests'), cur.fetchone()))
+        cur.close()
+        conn.rollback()
+        self.created = []           # (listing id, farmer) added during the run, fair game for PUT/DELETE
+        self._lock = threading.Lock()
+
+    def take(self, items):
+        with self._lock:
+            return items.pop() if items else None
+
+    def put(self, items, item):
+        with self._lock:
+            items.append(item)
+
+
+class Workload:
+    def __init__(self, dataset, proof_kb, rnd):
+        self.ds = dataset
+        # Upload bodies: a unique 4-byte nonce after the PNG magic keeps every
+        # proof distinct (no dedup shortcut) without re-encoding the whole image
+        body = rnd.randbytes(int(proof_kb * 1024) // 3 * 3)
+        self.proof_tail = base64.b64encode(body).decode('ascii')
+        self.ops = {
+            'farmer': [
+                (4, self.farmer_listings), (2, self.add_listing), (1, self.update_listing), (1, self.delete_listing),
+                (2, self.farmer_analytics), (2, self.farmer_requests), (1, self.approve_request),
+                (1, self.export_listings), (1, self.export_requests), (1, self.bulk_import),
+            ],
+            'buyer': [
+                (6, self.browse_market), (2, self.search), (2, self.view_listing), (2, self.purchase),
+                (2, self.buyer_requests),
+                (1, self.buyer_analytics), (1, self.view_proof), (1, self.legacy_proof),
+            ],
+            'ngo': [
+                (5, self.browse_donations), (1, self.claim), (2, self.get_profile), (1, self.save_profile),
+                (2, self.ngo_analytics),
+            ],
+            'any': [
+                (2, self.login), (1, self.register), (1, self.home), (1, self.events), (1, self.ops_stats),
+            ],
+        }
+
+    def next_request(self, rnd):
+        role = rnd.choices([r for r, _ in ROLE_MIX] + ['any'], [w for _, w in ROLE_MIX] + [1])[0]
+        ops = self.ops[role]
+        op = rnd.choices([fn for _, fn in ops], [w for w, _ in ops])[0]
+        return op(rnd)
+
+    # Each op returns (route label, method, path, json body or bytes, content type,
+    # (username, role) signed in or None) or None to skip
+    def farmer_listings(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        return 'GET /api/listings', 'GET', '/api/listings?' + urlencode({'farmer_id': farmer}), None, None, None
+
+    def add_listing(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        body = {'title': rnd.choice(CROPS), 'quantity': f'{rnd.randint(1, 200)} kg', 'type': 'sell',
+                'farmer_id': farmer, 'farmer_name': farmer, 'available_date': date.today().isoformat(),
+                'price': round(rnd.uniform(10, 500), 2)}
+        return 'POST /api/listings', 'POST', '/api/listings', body, None, (farmer, 'farmer')
+
+    def update_listing(self, rnd):
+        created = self.ds.take(self.ds.created)
+        if created is None:
+            return None
+        listing_id, farmer = created
+        self.ds.put(self.ds.created, created)
+        body = {'title': rnd.choice(CROPS), 'quantity': f'{rnd.randint(1, 200)} kg', 'type': 'sell',
+                'farmer_id': farmer, 'farmer_name': farmer, 'available_date': date.today().isoformat(),
+                'price': round(rnd.uniform(10, 500), 2)}
+        return 'PUT /api/listings/<id>', 'PUT', f'/api/listings/{listing_id}', body, None, (farmer, 'farmer')
+
+    def delete_listing(self, rnd):
+        created = self.ds.take(self.ds.created)
+        if created is None:
+            return None
+        listing_id, farmer = created
+        return 'DELETE /api/listings/<id>', 'DELETE', f'/api/listings/{listing_id}', None, None, (farmer, 'farmer')
+
+    def farmer_analytics(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        return ('GET /api/analytics/farmer/<id>', 'GET', f'/api/analytics/farmer/{farmer}', None, None,
+                (farmer, 'farmer'))
+
+    def farmer_requests(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        return ('GET /api/purchase-requests/farmer/<id>', 'GET', f'/api/purchase-requests/farmer/{farmer}',
+                None, None, (farmer, 'farmer'))
+
+    def approve_request(self, rnd):
+        pending = self.ds.take(self.ds.pending)
+        if pending is None:
+            return None
+        status = rnd.choice(('approved', 'rejected'))
+        return ('PUT /api/purchase-request/<id>/status', 'PUT',
+                f'/api/purchase-request/{pending[0]}/status', {'status': status}, None, (pending[1], 'farmer'))
+
+    def export_listings(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        return ('GET /api/listings/export', 'GET',
+                '/api/listings/export?' + urlencode({'farmer_id': farmer, 'format': 'ndjson'}), None, None, None)
+
+    def export_requests(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        return ('GET /api/purchase-requests/export', 'GET',
+                '/api/purchase-requests/export?' + urlencode({'farmer_id': farmer}), None, None, (farmer, 'farmer'))
+
+    def bulk_import(self, rnd):
+        farmer = rnd.choice(self.ds.farmers)
+        rows = ''.join(json.dumps({'title': rnd.choice(CROPS), 'quantity': f'{rnd.randint(1, 50)} kg',
+                                   'type': rnd.choice(('sell', 'barter', 'donate')), 'price': rnd.randint(0, 300)}) + '\n'
+                       for _ in range(50))
+        return ('POST /api/listings/bulk', 'POST',
+                '/api/listings/bulk?' + urlencode({'farmer_id': farmer, 'farmer_name': farmer}),
+                rows.encode('utf-8'), 'application/x-ndjson', (farmer, 'farmer'))
+
+    def browse_market(self, rnd):
+        params = {'type': rnd.choice(('sell', 'barter')), 'status': 'available',
+                  'sort': rnd.choice(('new', 'price_asc', 'price_desc'))}
+        if rnd.random() < 0.3:
+            params['q'] = rnd.choice(CROPS)[:4].lower()
+        return 'GET /api/listings', 'GET', '/api/listings?' + urlencode(params), None, None, None
+
+    # Autocomplete prefixes, whole words and typos
+    def search(self, rnd):
+        crop = rnd.choice(CROPS).lower()
+        kind = rnd.random()
+        if kind < 0.4:
+            q = crop[:rnd.randint(2, len(crop))]
+        elif kind < 0.7:
+            i = rnd.randrange(len(crop) - 1)
+            q = crop[:i] + crop[i + 1] + crop[i] + crop[i + 2:]
+        else:
+            q = crop
+        params = {'q': q, 'type': 'sell,barter', 'status': 'available'}
+        return 'GET /api/listings/search', 'GET', '/api/listings/search?' + urlencode(params), None, None, None
+
+    def view_listing(self, rnd):
+        listing_id = rnd.choice(self.ds.listings)[0]
+        return 'GET /api/listings/<id>', 'GET', f'/api/listings/{listing_id}', None, None, None
+
+    def purchase(self, rnd):
+        if not self.ds.market:
+            return None
+        nonce = base64.b64encode(PNG_MAGIC + rnd.randbytes(4)).decode('ascii')
+        buyer = rnd.choice(self.ds.buyers)
+        body = {'listing_id': rnd.choice(self.ds.market), 'buyer_id': buyer,
+                'payment_proof': 'data:image/png;base64,' + nonce + self.proof_tail}
+        return 'POST /api/purchase-request', 'POST', '/api/purchase-request', body, None, (buyer, 'buyer')
+
+    def buyer_requests(self, rnd):
+        buyer = rnd.choice(self.ds.buyers)
+        return ('GET /api/purchase-requests/buyer/<id>', 'GET', f'/api/purchase-requests/buyer/{buyer}',
+                None, None, (buyer, 'buyer'))
+
+    def buyer_analytics(self, rnd):
+        buyer = rnd.choice(self.ds.buyers)
+        return ('GET /api/analytics/buyer/<id>', 'GET', f'/api/analytics/buyer/{buyer}', None, None,
+                (buyer, 'buyer'))
+
+    def view_proof(self, rnd):
+        if not self.ds.digests:
+            return None
+        return 'GET /api/proofs/<digest>', 'GET', f'/api/proofs/{rnd.choice(self.ds.digests)}', None, None, None
+
+    def legacy_proof(self, rnd):
+        legacy = self.ds.take(self.ds.legacy)
+        if legacy is None:
+            return None
+        request_id, buyer = legacy
+        return ('GET /api/purchase-request/<id>/proof', 'GET',
+                f'/api/purchase-request/{request_id}/proof', None, None, (buyer, 'buyer'))
+
+    def browse_donations(self, rnd):
+        params = {'type': 'donate', 'status': 'available'}
+        if rnd.random() < 0.3:
+            params = {'claimed_by': rnd.choice(self.ds.ngos)}
+        return 'GET /api/listings', 'GET', '/api/listings?' + urlencode(params), None, None, None
+
+    def claim(self, rnd):
+        listing_id = self.ds.take(self.ds.donations)
+        if listing_id is None:
+            return None
+        ngo = rnd.choice(self.ds.ngos)
+        return ('POST /api/claim/<id>', 'POST', f'/api/claim/{listing_id}', {'claimed_by': ngo}, None, (ngo, 'ngo'))
+
+    def get_profile(self, rnd):
+        ngo = rnd.choice(self.ds.ngos)
+        return ('GET /api/ngo/profile', 'GET', '/api/ngo/profile?' + urlencode({'ngo_id': ngo}), None, None,
+                (ngo, 'ngo'))
+
+    def save_profile(self, rnd):
+        ngo = rnd.choice(self.ds.ngos)
+        body = {'ngo_id': ngo, 'org_name': f'Org {ngo}', 'contact': '0300-0000000', 'address': '1 Relief Road',
+                'focus_area': ', '.join(rnd.sample(FOCUS_AREAS, 2))}
+        return 'POST /api/ngo/profile', 'POST', '/api/ngo/profile', body, None, (ngo, 'ngo')
+
+    def ngo_analytics(self, rnd):
+        ngo = rnd.choice(self.ds.ngos)
+        return 'GET /api/analytics/ngo/<id>', 'GET', f'/api/analytics/ngo/{ngo}', None, None, (ngo, 'ngo')
+
+    def login(self, rnd):
+        user = rnd.choice(self.ds.farmers + self.ds.buyers + self.ds.ngos)
+        return 'POST /api/login', 'POST', '/api/login', {'username': user, 'password': BENCH_PASSWORD}, None, None
+
+    def register(self, rnd):
+        body = {'username': f'benchnew_{uuid.uuid4().hex[:12]}', 'password': BENCH_PASSWORD,
+                'role': rnd.choice(('farmer', 'buyer', 'ngo'))}
+        return 'POST /api/register', 'POST', '/api/register', body, None, None
+
+    def home(self, rnd):
+        return 'GET /', 'GET', '/', None, None, None
+
+    def events(self, rnd):
+        user = rnd.choice(self.ds.buyers)
+        return 'GET /api/events', 'GET', '/api/events', None, None, (user, 'buyer')
+
+    def ops_stats(self, rnd):
+        path = rnd.choice(('/api/health/ready', '/api/db/pool', '/api/cache/stats', '/api/hashing/stats'))
+        return f'GET {path}', 'GET', path, None, None, None
+
+
+# ---------------------------------------------------------------------------
+# Load generation
+
+class RouteStats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = {}
+        self.errors = 0
+        self.bytes = 0
+
+
+class Worker(threading.Thread):
+    def __init__(self, target, workload, seed, deadline, warmup_until, timeout):
+        super().__init__(daemon=True)
+        self.target = target
+        self.workload = workload
+        self.rnd = random.Random(seed)
+        self.deadline = deadline
+        self.warmup_until = warmup_until
+        self.timeout = timeout
+        self.stats = {}
+        self.conn = None
+
+    def _connection(self):
+        if self.conn is None:
+            self.conn = http.client.HTTPConnection(self.target.hostname, self.target.port or 80, timeout=self.timeout)
+        return self.conn
+
+    def _reset(self):
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = None
+
+    def request(self, label, method, path, body, content_type, user):
+        headers = auth_headers(*user) if user else {}
+        if isinstance(body, dict):
+            body = json.dumps(body).encode('utf-8')
+            content_type = 'application/json'
+        if content_type:
+            headers['Content-Type'] = content_type
+        if label == 'GET /api/events':
+            # Long-lived stream: measure time to the first frame on a separate connection
+            conn = http.client.HTTPConnection(self.target.hostname, self.target.port or 80, timeout=self.timeout)
+            try:
+                conn.request(method, path, headers=headers)
+                response = conn.getresponse()
+                received = b''
+                while True:
+                    line = response.readline()
+                    received += line
+                    if not line or line == b'\n':
+                        break
+                return response.status, received
+            finally:
+                conn.close()
+        conn = self._connection()
+        conn.request(method, path, body=body, headers=headers)
+        response = conn.getresponse()
+        payload = response.read()
+        if response.getheader('Connection', '').lower() == 'close' or response.version < 11:
+            self._reset()
+        if label == 'GET /api/purchase-request/<id>/proof' and response.status in (301, 302):
+            location = urlsplit(response.getheader('Location', ''))
+            conn = self._connection()
+            conn.request('GET', location.path)
+            response = conn.getresponse()
+            payload = response.read()
+            if response.getheader('Connection', '').lower() == 'close' or response.version < 11:
+                self._reset()
+        return response.status, payload
+
+    def run(self):
+        while time.monotonic() < self.deadline:
+            spec = self.workload.next_request(self.rnd)
+            if spec is None:
+                continue
+            label, method, path, body, content_type, user = spec
+            start = time.perf_counter()
+            try:
+                status, payload = self.request(label, method, path, body, content_type, user)
+            except Exception as e:
+                status, payload = type(e).__name__, b''
+                self._reset()
+            elapsed = time.perf_counter() - start
+            if label == 'POST /api/listings' and status == 201:
+                # Listings created here are the ones later updated and deleted
+                listing_id = json.loads(payload).get('id')
+                if listing_id:
+                    self.workload.ds.put(self.workload.ds.created, (listing_id, body['farmer_id']))
+            if time.monotonic() < self.warmup_until:
+                continue
+            stats = self.stats.setdefault(label, RouteStats())
+            stats.latencies.append(elapsed)
+            stats.statuses[str(status)] = stats.statuses.get(str(status), 0) + 1
+            stats.bytes += len(payload)
+            if not isinstance(status, int) or status >= 500:
+                stats.errors += 1
+        self._reset()
+
+
+def summarize(stats, seconds):
+    latencies = sorted(stats.latencies)
+
+    def ms(value):
+        return round(value * 1000, 3) if value is not None else None
+
+    return {
+        'count': len(latencies),
+        'errors': stats.errors,
+        'statuses': stats.statuses,
+        'throughput_rps': round(len(latencies) / seconds, 3),
+        'mean_ms': ms(sum(latencies) / len(latencies)) if latencies else None,
+        'p50_ms': ms(percentile(latencies, 50)),
+        'p95_ms': ms(percentile(latencies, 95)),
+        'p99_ms': ms(percentile(latencies, 99)),
+        'max_ms': ms(latencies[-1]) if latencies else None,
+        'avg_bytes': round(stats.bytes / len(latencies)) if latencies else 0,
+    }
+
+
+# ---------------------------------------------------------------------------
+# Contention: many buyers and NGOs racing for the same few listings
+
+class Client:
+    """One keep-alive connection; records latency and status per route label."""
+
+    def __init__(self, target, timeout, user=None):
+        self.target = target
+        self.timeout = timeout
+        self.user = user
+        self.conn = None
+        self.stats = {}
+
+    def post(self, label, path, body, headers=None):
+        headers = dict(headers or {}, **{'Content-Type': 'application/json'})
+        if self.user:
+            headers.update(auth_headers(*self.user))
+        start = time.perf_counter()
+        try:
+            if self.conn is None:
+                self.conn = http.client.HTTPConnection(self.target.hostname, self.target.port or 80,
+                                                       timeout=self.timeout)
+            self.conn.request('POST', path, body=json.dumps(body).encode('utf-8'), headers=headers)
+            response = self.conn.getresponse()
+            payload = response.read()
+            status = response.status
+            replayed = response.getheader('Idempotent-Replayed') == 'true'
+        except Exception as e:
+            if self.conn is not None:
+                self.conn.close()
+            self.conn = None
+            status, payload, replayed = type(e).__name__, b'', False
+        stats = self.stats.setdefault(label, RouteStats())
+        stats.latencies.append(time.perf_counter() - start)
+        stats.statuses[str(status)] = stats.statuses.get(str(status), 0) + 1
+        if not isinstance(status, int) or status >= 500:
+            stats.errors += 1
+        try:
+            result = json.loads(payload) if payload else {}
+        except ValueError:
+            result = {}
+        return status, result, replayed
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+
+
+# POST with the same idempotency key until the response is final. 409 means a
+# competing transaction holds the listing right now (or a hold is live): a
+# few immediate retries, then give up. Every attempt after the first final
+# answer is a client retry that must replay that answer.
+def _contend(client, label, path, body, key, retries, busy_retries):
+    responses = []
+    for _ in range(retries):
+        for _ in range(busy_retries + 1):
+            status, result, replayed = client.post(label, path, body, {'Idempotency-Key': key})
+            if status != 409:
+                break
+        responses.append((status, result, replayed))
+    return responses
+
+
+def contention(args):
+    check_target(args.force)
+    with db.pool.connection() as conn:
+        dataset = Dataset(conn, 1)
+    if not (dataset.farmers and dataset.buyers and dataset.ngos):
+        sys.exit("No seeded users found, run `python bench.py seed` first")
+
+    server = None
+    url = args.url
+    if not url:
+        if args.hold_ttl is not None:
+            purchases.HOLD_TTL = args.hold_ttl
+        server, url = start_local_server(args.port)
+    target = urlsplit(url)
+    rnd = random.Random(args.seed)
+    proof = 'data:image/png;base64,' + base64.b64encode(fake_proof(rnd, 2048)).decode('ascii')
+
+    # Fresh hot listings, created through the API so rollups and events see them
+    farmer = rnd.choice(dataset.farmers)
+    setup = Client(target, args.timeout, (farmer, 'farmer'))
+    hot, donations = [], []
+    for kind, into, count in (('sell', hot, args.listings), ('donate', donations, args.donations)):
+        for _ in range(count):
+            status, result, _ = setup.post('setup', '/api/listings', {
+                'title': rnd.choice(CROPS), 'quantity': f'{rnd.randint(1, 200)} kg', 'type': kind,
+                'farmer_id': farmer, 'farmer_name': farmer, 'available_date': date.today().isoformat(),
+                'price': round(rnd.uniform(10, 500), 2) if kind == 'sell' else None})
+            if status != 201:
+                sys.exit(f"Could not create a listing: {status} {result}")
+            into.append(result['id'])
+    setup.close()
+
+    print(f"{args.concurrency} buyers racing for {len(hot)} listings and {args.concurrency} NGOs for "
+          f"{len(donations)} donations on {url}, each request sent {args.retries}x with one idempotency key")
+    results = {'purchase': [], 'claim': []}     # (actor, listing, key, responses)
+    results_lock = threading.Lock()
+    clients = []
+    start_gate = threading.Barrier(args.concurrency * 2 + 1)
+    done = threading.Event()
+
+    def buyer(i):
+        buyer_id = dataset.buyers[i % len(dataset.buyers)]
+        client = Client(target, args.timeout, (buyer_id, 'buyer'))
+        clients.append(client)
+        order = list(hot)
+        random.Random(args.seed + i).shuffle(order)
+        start_gate.wait()
+        for listing_id in order:
+            key = str(uuid.uuid4())
+            body = {'listing_id': listing_id, 'buyer_id': buyer_id, 'payment_proof': proof}
+            responses = _contend(client, 'POST /api/purchase-request', '/api/purchase-request', body, key,
+                                 args.retries, args.busy_retries)
+            with results_lock:
+                results['purchase'].append((buyer_id, listing_id, key, responses))
+
+    def ngo(i):
+        ngo_id = dataset.ngos[i % len(dataset.ngos)]
+        client = Client(target, args.timeout, (ngo_id, 'ngo'))
+        clients.append(client)
+        order = list(donations)
+        random.Random(args.seed - i).shuffle(order)
+        start_gate.wait()
+        for listing_id in order:
+            key = str(uuid.uuid4())
+            responses = _contend(client, 'POST /api/claim/<id>', f'/api/claim/{listing_id}',
+                                 {'claimed_by': ngo_id}, key, args.retries, args.busy_retries)
+            with results_lock:
+                results['claim'].append((ngo_id, listing_id, key, responses))
+
+    # The farmer approves whatever is pending on the hot listings while buyers keep buying
+    def approver():
+        client = Client(target, args.timeout, (farmer, 'farmer'))
+        clients.append(client)
+        start_gate.wait()
+        while True:
+            finished = done.is_set()
+            with db.pool.connection() as conn:
+                cur = conn.cursor()
+                cur.execute("SELECT id FROM purchase_requests WHERE listing_id = ANY(%s) AND status = 'pending';",
+                            (hot,))
+                pending = [row[0] for row in cur.fetchall()]
+                cur.close()
+                conn.rollback()
+            if pending:
+                client.post('POST /api/purchase-requests/status', '/api/purchase-requests/status',
+                            {'approve': pending, 'farmer_id': farmer})
+            if finished:
+                return
+            time.sleep(0.01)
+
+    threads = ([threading.Thread(target=buyer, args=(i,)) for i in range(args.concurrency)] +
+               [threading.Thread(target=ngo, args=(i,)) for i in range(args.concurrency)])
+    approver_thread = threading.Thread(target=approver)
+    started = time.monotonic()
+    for thread in threads + [approver_thread]:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    done.set()
+    approver_thread.join()
+    elapsed = time.monotonic() - started
+    for client in clients:
+        client.close()
+    if server is not None:
+        server.shutdown()
+
+    violations = check_contention(hot, donations, results)
+
+    merged = {}
+    for client in clients:
+        for label, stats in client.stats.items():
+            into = merged.setdefault(label, RouteStats())
+            into.latencies.extend(stats.latencies)
+            into.errors += stats.errors
+            for status, count in stats.statuses.items():
+                into.statuses[status] = into.statuses.get(status, 0) + count
+    print(f"{'route':<40} {'count':>7} {'err':>5} {'p50':>9} {'p95':>9} {'p99':>9}  statuses")
+    for label in sorted(merged):
+        row = summarize(merged[label], elapsed)
+        print(f"{label:<40} {row['count']:>7} {row['errors']:>5} {row['p50_ms'] or '-':>9} "
+              f"{row['p95_ms'] or '-':>9} {row['p99_ms'] or '-':>9}  {row['statuses']}")
+    print(f"Finished in {elapsed:.1f}s")
+    for violation in violations:
+        print(f"VIOLATION: {violation}")
+    if violations or any(stats.errors for stats in merged.values()):
+        sys.exit(1)
+    print("All invariants held")
+
+
+# Invariants after a contention run: every retry replayed its first answer, no
+# buyer got two requests for a listing, each listing was sold at most once with
+# no pending requests left behind, each donation went to exactly the NGO that
+# was told it won, and the rollups still match the listings
+def check_contention(hot, donations, results):
+    violations = []
+    for kind, entries in results.items():
+        for actor, listing_id, key, responses in entries:
+            final = [(status, result) for status, result, _ in responses if status != 409]
+            if final and any(answer != final[0] for answer in final[1:]):
+                violations.append(f"{kind} by {actor} on {listing_id}: retries with key {key} "
+                                  f"got different answers {final}")
+
+    with db.pool.connection() as conn:
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT listing_id, buyer_id, COUNT(*) FROM purchase_requests
+            WHERE listing_id = ANY(%s) GROUP BY listing_id, buyer_id HAVING COUNT(*) > 1;
+        """, (hot,))
+        for listing_id, buyer_id, count in cur.fetchall():
+            violations.append(f"buyer {buyer_id} has {count} requests for listing {listing_id}")
+        cur.execute("""
+            SELECT l.id, l.status,
+                   COUNT(*) FILTER (WHERE pr.status = 'approved'),
+                   COUNT(*) FILTER (WHERE pr.status = 'pending')
+            FROM listings l LEFT JOIN purchase_requests pr ON pr.listing_id = l.id
+            WHERE l.id = ANY(%s) GROUP BY l.id, l.status;
+        """, (hot,))
+        for listing_id, status, approved, pending in cur.fetchall():
+            if approved > 1:
+                violations.append(f"listing {listing_id} has {approved} approved requests")
+            if (status == 'sold') != (approved == 1):
+                violations.append(f"listing {listing_id} is {status} with {approved} approved requests")
+            if status == 'sold' and pending:
+                violations.append(f"sold listing {listing_id} still has {pending} pending requests")
+
+        winners = {}
+        for ngo_id, listing_id, _, responses in results['claim']:
+            if any(status == 200 for status, _, _ in responses):
+                winners.setdefault(listing_id, set()).add(ngo_id)
+        cur.execute("SELECT id, status, claimed_by FROM listings WHERE id = ANY(%s);", (donations,))
+        for listing_id, status, claimed_by in cur.fetchall():
+            told = winners.get(listing_id, set())
+            if status != 'claimed' or told != {claimed_by}:
+                violations.append(f"donation {listing_id} is {status} by {claimed_by}, "
+                                  f"but {sorted(told) or 'nobody'} were told they claimed it")
+        cur.close()
+        conn.rollback()
+        for table, count in rollups.verify(conn).items():
+            if count:
+                violations.append(f"{table}: {count} rollup rows disagree with listings")
+    return violations
+
+
+def start_local_server(port):
+    from werkzeug.serving import WSGIRequestHandler, make_server
+    import app as app_module
+
+    class KeepAliveHandler(WSGIRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_request(self, *args, **kwargs):
+            pass
+
+    server = make_server('127.0.0.1', port, app_module.app, threaded=True, request_handler=KeepAliveHandler)
+    threading.Thread(target=server.serve_forever, name='bench-server', daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run(args):
+    check_target(args.force)
+    rnd = random.Random(args.seed)
+    with db.pool.connection() as conn:
+        dataset = Dataset(conn, args.sample_size)
+    if not (dataset.farmers and dataset.buyers and dataset.ngos and dataset.listings):
+        sys.exit("No seeded data found, run `python bench.py seed` first")
+    workload = Workload(dataset, args.proof_kb, rnd)
+
+    server = None
+    url = args.url
+    if not url:
+        server, url = start_local_server(args.port)
+    target = urlsplit(url)
+
+    print(f"Driving {url} with {args.concurrency} clients for {args.duration}s (+{args.warmup}s warmup)")
+    started = time.monotonic()
+    warmup_until = started + args.warmup
+    deadline = warmup_until + args.duration
+    workers = [Worker(target, workload, args.seed + i, deadline, warmup_until, args.timeout)
+               for i in range(args.concurrency)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    if server is not None:
+        server.shutdown()
+
+    merged = {}
+    for worker in workers:
+        for label, stats in worker.stats.items():
+            into = merged.setdefault(label, RouteStats())
+            into.latencies.extend(stats.latencies)
+            into.errors += stats.errors
+            into.bytes += stats.bytes
+            for status, count in stats.statuses.items():
+                into.statuses[status] = into.statuses.get(status, 0) + count
+    total = RouteStats()
+    for stats in merged.values():
+        total.latencies.extend(stats.latencies)
+        total.errors += stats.errors
+        total.bytes += stats.bytes
+        for status, count in stats.statuses.items():
+            total.statuses[status] = total.statuses.get(status, 0) + count
+
+    report = {
+        'meta': {
+            'timestamp': datetime.now(timezone.utc).isoformat(),
+            'git_commit': git_commit(),
+            'python': platform.python_version(),
+            'url': url if args.url else 'in-process',
+            'concurrency': args.concurrency,
+            'duration_s': args.duration,
+            'warmup_s': args.warmup,
+            'seed': args.seed,
+            'proof_kb': args.proof_kb,
+            'dataset': dataset.counts,
+        },
+        'total': summarize(total, args.duration),
+        'routes': {label: summarize(merged[label], args.duration) for label in sorted(merged)},
+    }
+
+    print(f"{'route':<46} {'count':>7} {'err':>5} {'rps':>9} {'p50':>9} {'p95':>9} {'p99':>9}")
+    for label, row in list(report['routes'].items()) + [('TOTAL', report['total'])]:
+        print(f"{label:<46} {row['count']:>7} {row['errors']:>5} {row['throughput_rps']:>9} "
+              f"{row['p50_ms'] or '-':>9} {row['p95_ms'] or '-':>9} {row['p99_ms'] or '-':>9}")
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, indent=2)
+        print(f"Wrote {args.output}")
+
+
+# Compare two reports; exit 1 when a route's p95 regressed by more than --threshold percent
+def compare(args):
+    with open(args.baseline, encoding='utf-8') as f:
+        baseline = json.load(f)
+    with open(args.candidate, encoding='utf-8') as f:
+        candidate = json.load(f)
+    regressions = []
+    print(f"{'route':<46} {'p95 before':>11} {'p95 after':>11} {'change':>8} {'rps change':>11}")
+    for label in sorted(set(baseline['routes']) | set(candidate['routes'])):
+        before = baseline['routes'].get(label)
+        after = candidate['routes'].get(label)
+        if not before or not after or not before['p95_ms'] or not after['p95_ms']:
+            print(f"{label:<46} {'(missing in one run)':>32}")
+            continue
+        change = (after['p95_ms'] - before['p95_ms']) / before['p95_ms'] * 100
+        rps_change = ((after['throughput_rps'] - before['throughput_rps']) / before['throughput_rps'] * 100
+                      if before['throughput_rps'] else 0)
+        flag = ''
+        if change > args.threshold and min(before['count'], after['count']) >= args.min_count:
+            regressions.append(label)
+            flag = '  REGRESSION'
+        print(f"{label:<46} {before['p95_ms']:>11} {after['p95_ms']:>11} {change:>7.1f}% {rps_change:>10.1f}%{flag}")
+    if regressions:
+        print(f"{len(regressions)} routes regressed by more than {args.threshold}% at p95")
+        sys.exit(1)
+
+
+# Transaction A writes an event, B writes one with a higher id and commits
+# first, then A commits. A client streaming in between holds B's token (or the
+# latest one); resuming from it must still deliver A's event.
+def event_order(args):
+    check_target(args.force)
+    marker = uuid.uuid4().hex
+
+    def resume(cur, token):
+        cur.execute(events.REPLAY_SQL, (token, events.EVENTS_REPLAY_LIMIT))
+        rows = cur.fetchall()
+        return {row[3].get('writer'): row[0] for row in rows if row[3].get('marker') == marker}
+
+    def write(conn, writer):
+        cur = conn.cursor()
+        cur.execute("""
+            INSERT INTO change_events (kind, op, payload) VALUES ('bench', 'insert', %s) RETURNING id;
+        """, (json.dumps({'marker': marker, 'writer': writer}),))
+        event_id = cur.fetchone()[0]
+        cur.close()
+        return event_id
+
+    violations = []
+    with db.pool.connection() as reader, db.pool.connection() as a, db.pool.connection() as b:
+        reader.autocommit = True
+        cur = reader.cursor()
+        start = events.latest_event_id(reader)
+        id_a, id_b = write(a, 'A'), write(b, 'B')
+        b.commit()
+        seen = resume(cur, start)
+        if set(seen) != {'B'}:
+            violations.append(f"after B committed, resuming from {start} returned {sorted(seen)}")
+        token_b = seen.get('B', start)
+        latest = events.latest_event_id(reader)
+        a.commit()
+        for name, token in (("B's token", token_b), ('the latest token', latest)):
+            if 'A' not in resume(cur, token):
+                violations.append(f"resuming from {name} ({token}) missed event {id_a}, "
+                                  f"committed after event {id_b}")
+        cur.execute("DELETE FROM change_events WHERE kind = 'bench' AND payload->>'marker' = %s;", (marker,))
+        cur.close()
+        reader.autocommit = False
+
+    for violation in violations:
+        print(f"VIOLATION: {violation}")
+    if violations:
+        sys.exit(1)
+    print(f"Event {id_a} committed after event {id_b} and was still replayed")
+
+
+def partition_moves(args):
+    check_target(args.force)
+    # Long before any monthly partition, so these requests start in the default partition
+    month = date(1990, 1, 1)
+    requests = (('1990-01-15', 'pending'), ('1990-01-20', 'approved'), ('1989-06-01', 'approved'))
+    violations = []
+    with db.pool.connection() as conn:
+        cur = conn.cursor()
+        try:
+            for created_at, status in requests:
+                cur.execute("""
+                    INSERT INTO purchase_requests (listing_id, buyer_id, farmer_id, crop_title, quantity, status, created_at)
+                    VALUES (0, 'bench-moves', 'bench-moves', 'Bench', '1 kg', %s, %s);
+                """, (status, created_at))
+            cur.execute("SELECT COUNT(*) FROM change_events;")
+            before = cur.fetchone()[0]
+
+            name = partitions.create_partition(cur, month)
+            cur.execute(f"SELECT COUNT(*) FROM {name} WHERE buyer_id = 'bench-moves';")
+            if cur.fetchone()[0] != 2:
+                violations.append(f"creating {name} didn't move its month's requests into it")
+            cur.execute(f"ALTER TABLE {partitions.HOT_TABLE} DETACH PARTITION {name};")
+            partitions.return_pending(cur, name)
+            swept, _ = partitions.sweep_resolved(cur, month)
+            cur.execute(f"""
+                SELECT status FROM {partitions.DEFAULT_PARTITION} WHERE buyer_id = 'bench-moves';
+            """)
+            if [row[0] for row in cur.fetchall()] != ['pending'] or swept < 1:
+                violations.append("the pending request wasn't returned or the resolved one wasn't archived")
+
+            cur.execute("SELECT COUNT(*) FROM change_events;")
+            written = cur.fetchone()[0] - before
+            if written:
+                violations.append(f"moving requests between partitions wrote {written} change events")
+        finally:
+            conn.rollback()
+            cur.close()
+
+    for violation in violations:
+        print(f"VIOLATION: {violation}")
+    if violations:
+        sys.exit(1)
+    print("Requests moved between partitions without change events")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Harvest Hub load-testing harness')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('seed', help='populate the bench database')
+    cmd.add_argument('--reset', action='store_true', help='drop and recreate the schema first')
+    cmd.add_argument('--farmers', type=int, default=200)
+    cmd.add_argument('--buyers', type=int, default=500)
+    cmd.add_argument('--ngos', type=int, default=50)
+    cmd.add_argument('--listings', type=int, default=100000)
+    cmd.add_argument('--requests', type=int, default=20000)
+    cmd.add_argument('--proof-kb', type=float, default=150, help='average payment proof size')
+    cmd.add_argument('--proof-variants', type=int, default=50, help='distinct proof images to spread over requests')
+    cmd.add_argument('--legacy-proofs', type=float, default=0.1,
+                     help='fraction of requests keeping their proof inline as base64')
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.add_argument('--force', action='store_true', help='allow a database whose name lacks "bench"')
+    cmd.set_defaults(func=seed)
+
+    cmd = commands.add_parser('run', help='drive mixed-role traffic and report per-route latency')
+    cmd.add_argument('--url', help='server to drive (default: start the app in-process)')
+    cmd.add_argument('--port', type=int, default=0, help='port for the in-process server')
+    cmd.add_argument('--concurrency', type=int, default=16)
+    cmd.add_argument('--duration', type=float, default=30)
+    cmd.add_argument('--warmup', type=float, default=5)
+    cmd.add_argument('--timeout', type=float, default=30)
+    cmd.add_argument('--proof-kb', type=float, default=150, help='size of uploaded payment proofs')
+    cmd.add_argument('--sample-size', type=int, default=20000, help='ids sampled from the database to act on')
+    cmd.add_argument('--output', help='write the JSON report here')
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.add_argument('--force', action='store_true', help='allow a database whose name lacks "bench"')
+    cmd.set_defaults(func=run)
+
+    cmd = commands.add_parser('compare', help='compare two JSON reports')
+    cmd.add_argument('baseline')
+    cmd.add_argument('candidate')
+    cmd.add_argument('--threshold', type=float, default=10, help='allowed p95 increase in percent')
+    cmd.add_argument('--min-count', type=int, default=20, help='ignore routes with fewer samples')
+    cmd.set_defaults(func=compare)
+
+    cmd = commands.add_parser('contention', help='race buyers and NGOs for a few hot listings and check invariants')
+    cmd.add_argument('--url', help='server to drive (default: start the app in-process)')
+    cmd.add_argument('--port', type=int, default=0, help='port for the in-process server')
+    cmd.add_argument('--concurrency', type=int, default=32, help='buyers, and as many NGOs')
+    cmd.add_argument('--listings', type=int, default=5, help='hot listings for sale')
+    cmd.add_argument('--donations', type=int, default=5, help='hot donations')
+    cmd.add_argument('--retries', type=int, default=3, help='times each request is sent with the same key')
+    cmd.add_argument('--busy-retries', type=int, default=5, help='immediate retries after a 409')
+    cmd.add_argument('--hold-ttl', type=int, help='HOLD_TTL for the in-process server')
+    cmd.add_argument('--timeout', type=float, default=30)
+    cmd.add_argument('--seed', type=int, default=1)
+    cmd.add_argument('--force', action='store_true', help='allow a database whose name lacks "bench"')
+    cmd.set_defaults(func=contention)
+
+    cmd = commands.add_parser('event-order', help='check the event feed resumes across out-of-order commits')
+    cmd.add_argument('--force', action='store_true', help='allow a database whose name lacks "bench"')
+    cmd.set_defaults(func=event_order)
+
+    cmd = commands.add_parser('partition-moves', help='check partition maintenance moves write no change events')
+    cmd.add_argument('--force', action='store_true', help='allow a database whose name lacks "bench"')
+    cmd.set_defaults(func=partition_moves)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,150 @@
+import base64
+import binascii
+import hashlib
+import os
+import re
+import shutil
+import tempfile
+
+BLOB_DIR = os.environ.get('BLOB_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobs'))
+# Proofs of archived purchase requests (see partitions.py); can be a cheaper, slower volume
+BLOB_COLD_DIR = os.environ.get('BLOB_COLD_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)), 'blobs-cold'))
+PROOF_MAX_BYTES = int(os.environ.get('PROOF_MAX_BYTES', 5 * 1024 * 1024))
+
+DIGEST_RE = re.compile(r'^[0-9a-f]{64}$')
+DATA_URL_RE = re.compile(r'^data:([\w.+-]+/[\w.+-]+)?(;[\w=-]+)*;base64,', re.IGNORECASE)
+
+# magic prefix -> mime type of the image formats accepted as payment proof
+IMAGE_SIGNATURES = (
+    (b'\x89PNG\r\n\x1a\n', 'image/png'),
+    (b'\xff\xd8\xff', 'image/jpeg'),
+    (b'GIF87a', 'image/gif'),
+    (b'GIF89a', 'image/gif'),
+)
+
+
+class InvalidBlob(ValueError):
+    pass
+
+
+def sniff_image_type(head):
+    for signature, mime in IMAGE_SIGNATURES:
+        if head.startswith(signature):
+            return mime
+    if head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return 'image/webp'
+    return None
+
+
+def decode_data_url(value):
+    match = DATA_URL_RE.match(value)
+    payload = value[match.end():] if match else value
+    try:
+        return base64.b64decode(payload, validate=False)
+    except (binascii.Error, ValueError):
+        raise InvalidBlob('Payment proof is not valid base64')
+
+
+def blob_path(digest, root=BLOB_DIR):
+    return os.path.join(root, digest[:2], digest[2:4], digest)
+
+
+# Write a file under a temporary name and rename it into place, so readers
+# never see a partial blob
+def _write_atomic(path, write):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write(f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
+        raise
+
+
+# Store bytes under their SHA-256; identical uploads share one file.
+# Returns (digest, size, mime type).
+def store_blob(data):
+    if not data:
+        raise InvalidBlob('Payment proof is empty')
+    if len(data) > PROOF_MAX_BYTES:
+        raise InvalidBlob('Payment proof is too large')
+    mime = sniff_image_type(data[:16])
+    if mime is None:
+        raise InvalidBlob('Payment proof must be a PNG, JPEG, GIF or WebP image')
+
+    digest = hashlib.sha256(data).hexdigest()
+    path = blob_path(digest)
+    if not os.path.exists(path):
+        _write_atomic(path, lambda f: f.write(data))
+    return digest, len(data), mime
+
+
+# Move a blob to cold storage; returns False if it isn't in the hot store.
+# A request made meanwhile with the same proof stores a fresh hot copy, and
+# open_blob() finds the blob in either place.
+def move_to_cold(digest):
+    path = blob_path(digest)
+    if not os.path.isfile(path):
+        return False
+    cold_path = blob_path(digest, BLOB_COLD_DIR)
+    if not os.path.exists(cold_path):
+        with open(path, 'rb') as source:
+            _write_atomic(cold_path, lambda f: shutil.copyfileobj(source, f))
+    os.unlink(path)
+    return True
+
+
+def open_blob(digest):
+    if not DIGEST_RE.match(digest):
+        return None
+    path = blob_path(digest)
+    if not os.path.isfile(path):
+        path = blob_path(digest, BLOB_COLD_DIR)
+        if not os.path.isfile(path):
+            return None
+    with open(path, 'rb') as f:
+        mime = sniff_image_type(f.read(16)) or 'application/octet-stream'
+    return path, mime
+
+
+# Move inline base64 proofs from purchase_requests (or one of its
+# partitions) into the blob store. Works in batches with SKIP LOCKED so it can
+# run alongside live traffic (or in several copies); returns the number of
+# rows migrated.
+def migrate_legacy_proofs(conn, batch_size=100, table='purchase_requests'):
+    migrated = 0
+    while True:
+        cur = conn.cursor()
+        cur.execute(f"""
+            SELECT id, payment_proof FROM {table}
+            WHERE proof_hash IS NULL AND payment_proof IS NOT NULL
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED;
+        """, (batch_size,))
+        rows = cur.fetchall()
+        if not rows:
+            cur.close()
+            conn.commit()
+            return migrated
+        for request_id, payment_proof in rows:
+            try:
+                digest, size, _ = store_blob(decode_data_url(payment_proof))
+            except InvalidBlob as e:
+                # Keep unreadable proofs inline rather than losing them
+                print(f"Skipping proof for request {request_id}: {e}")
+                cur.execute(f"UPDATE {table} SET proof_hash = '' WHERE id = %s;", (request_id,))
+                continue
+            cur.execute(f"""
+                UPDATE {table}
+                SET proof_hash = %s, proof_size = %s, payment_proof = NULL
+                WHERE id = %s;
+            """, (digest, size, request_id))
+            migrated += 1
+        conn.commit()
+        cur.close()
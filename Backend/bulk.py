@@ -0,0 +1,195 @@
+import csv
+import io
+import json
+import os
+import uuid
+from itertools import islice
+
+import db
+import encoding
+import rollups
+from validation import LISTING_INSERT_COLUMNS, validate_listing
+
+IMPORT_BATCH_SIZE = int(os.environ.get('IMPORT_BATCH_SIZE', 1000))
+IMPORT_MAX_ERRORS = int(os.environ.get('IMPORT_MAX_ERRORS', 1000))
+EXPORT_FETCH_SIZE = int(os.environ.get('EXPORT_FETCH_SIZE', 2000))
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+LISTING_EXPORT_COLUMNS = ('id', 'title', 'quantity', 'quantity_amount', 'quantity_unit', 'type', 'farmer_id',
+                          'farmer_name', 'available_date', 'price', 'status', 'claimed_by')
+PURCHASE_REQUEST_EXPORT_COLUMNS = ('id', 'listing_id', 'buyer_id', 'farmer_id', 'crop_title', 'quantity', 'price',
+                                   'status', 'created_at', 'proof_hash', 'proof_size')
+
+
+# Parse a text stream into (line number, record) pairs; records that can't be
+# parsed at all are yielded as ValueError instances so they get reported per row
+def read_records(stream, fmt):
+    if fmt == 'csv':
+        reader = csv.DictReader(stream)
+        for record in reader:
+            if None in record:
+                yield reader.line_num, ValueError('Too many columns')
+            else:
+                yield reader.line_num, record
+    elif fmt == 'ndjson':
+        for line_no, line in enumerate(stream, 1):
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                yield line_no, ValueError('Invalid JSON')
+                continue
+            if not isinstance(record, dict):
+                yield line_no, ValueError('Each line must be a JSON object')
+            else:
+                yield line_no, record
+    else:
+        raise ValueError(f'Unsupported format: {fmt}')
+
+
+# Reject records naming a farmer other than the one importing them
+def owned_records(records, farmer_id):
+    for line_no, record in records:
+        if isinstance(record, dict) and record.get('farmer_id') not in (None, '', farmer_id):
+            record = ValueError('farmer_id must be your own username')
+        yield line_no, record
+
+
+# Validate and COPY listing records in batches inside the caller's transaction.
+# Returns (inserted rows as (id, farmer_id), [{'line', 'error'}]). Rollups are
+# updated for the inserted rows; committing is left to the caller.
+def import_listings(conn, records, defaults=None, batch_size=IMPORT_BATCH_SIZE):
+    cur = conn.cursor()
+    cur.execute("""
+        CREATE TEMP TABLE IF NOT EXISTS listings_import (
+            title VARCHAR(100), quantity VARCHAR(50), quantity_amount NUMERIC(12,3), quantity_unit VARCHAR(20),
+            type VARCHAR(50), farmer_id VARCHAR(100), farmer_name VARCHAR(100), available_date DATE, price DECIMAL(10,2)
+        ) ON COMMIT DROP;
+    """)
+    columns = ', '.join(LISTING_INSERT_COLUMNS)
+    inserted = []
+    errors = []
+    records = iter(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        buf = io.StringIO()
+        writer = csv.writer(buf)
+        for line_no, record in batch:
+            try:
+                if isinstance(record, Exception):
+                    raise record
+                writer.writerow(validate_listing(record, defaults))
+            except ValueError as e:
+                if len(errors) < IMPORT_MAX_ERRORS:
+                    errors.append({'line': line_no, 'error': str(e)})
+        if buf.tell() == 0:
+            continue
+        buf.seek(0)
+        cur.copy_expert(f"COPY listings_import ({columns}) FROM STDIN WITH (FORMAT csv);", buf)
+        cur.execute(f"""
+            INSERT INTO listings ({columns}, status)
+            SELECT {columns}, 'available' FROM listings_import
+            RETURNING id, {rollups.STATE_COLUMNS};
+        """)
+        rows = cur.fetchall()
+        rollups.apply_listing_changes(cur, [(None, row[1:]) for row in rows])
+        cur.execute("TRUNCATE listings_import;")
+        inserted.extend((row[0], row[1]) for row in rows)
+    cur.close()
+    return inserted, errors
+
+
+def _format_value(value):
+    if value is None:
+        return None
+    if hasattr(value, 'isoformat'):
+        return value.isoformat()
+    if not isinstance(value, (str, int, float, bool)):
+        return str(value)
+    return value
+
+
+# Stream a query as CSV or NDJSON chunks through a server-side (named) cursor,
+# so memory stays flat however large the table is. Uses its own pooled
+# connection for the lifetime of the generator. For NDJSON, `shape` maps a row
+# to its object (the row's columns by default).
+def export_query(sql, params, columns, fmt, shape=None):
+    if fmt not in ('csv', 'ndjson'):
+        raise ValueError(f'Unsupported format: {fmt}')
+    conn = db.pool.getconn()
+    try:
+        cur = conn.cursor(name=f'export_{uuid.uuid4().hex}')
+        cur.itersize = EXPORT_FETCH_SIZE
+        cur.execute(sql, params)
+        if fmt == 'csv':
+            yield from _csv_chunks(cur, columns)
+        else:
+            yield from _ndjson_chunks(cur, shape or (lambda row: dict(zip(columns, map(_format_value, row)))))
+        cur.close()
+    finally:
+        db.pool.putconn(conn)
+
+
+def _csv_chunks(rows, columns):
+    buf = io.StringIO()
+    writer = csv.writer(buf)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_format_value(v) for v in row])
+        if buf.tell() >= EXPORT_CHUNK_BYTES:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    if buf.tell():
+        yield buf.getvalue()
+
+
+def _ndjson_chunks(rows, shape):
+    buf = bytearray()
+    for row in rows:
+        buf += encoding.dumps(shape(row))
+        buf += b'\n'
+        if len(buf) >= EXPORT_CHUNK_BYTES:
+            yield bytes(buf)
+            buf.clear()
+    if buf:
+        yield bytes(buf)
+
+
+def export_listings(fmt, farmer_id=None, type_=None, status=None):
+    where = []
+    params = []
+    if farmer_id:
+        where.append("farmer_id = %s")
+        params.append(farmer_id)
+    if type_:
+        where.append("type = %s")
+        params.append(type_)
+    if status:
+        where.append("status = %s")
+        params.append(status)
+    sql = f"SELECT {', '.join(LISTING_EXPORT_COLUMNS)} FROM listings"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id;"
+    return export_query(sql, params, LISTING_EXPORT_COLUMNS, fmt)
+
+
+def export_purchase_requests(fmt, farmer_id=None, buyer_id=None, archived=False):
+    where = []
+    params = []
+    if farmer_id:
+        where.append("farmer_id = %s")
+        params.append(farmer_id)
+    if buyer_id:
+        where.append("buyer_id = %s")
+        params.append(buyer_id)
+    table = 'purchase_requests_archive' if archived else 'purchase_requests'
+    sql = f"SELECT {', '.join(PURCHASE_REQUEST_EXPORT_COLUMNS)} FROM {table}"
+    if where:
+        sql += " WHERE " + " AND ".join(where)
+    sql += " ORDER BY id;"
+    return export_query(sql, params, PURCHASE_REQUEST_EXPORT_COLUMNS, fmt)
@@ -0,0 +1,250 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from flask import current_app, request
+
+import db
+import encoding
+
+CACHE_MAX_ENTRIES = int(os.environ.get('CACHE_MAX_ENTRIES', 1024))
+CACHE_MAX_BYTES = int(os.environ.get('CACHE_MAX_BYTES', 32 * 1024 * 1024))
+# Seconds an invalidation is remembered (never less than DB_REPLICA_MAX_LAG)
+CACHE_INVALIDATION_WINDOW = max(float(os.environ.get('CACHE_INVALIDATION_WINDOW', 30)), db.DB_REPLICA_MAX_LAG)
+
+# Response headers that are part of the cached representation
+CACHED_HEADERS = ('Content-Type', 'X-Next-Cursor')
+
+
+class CacheEntry:
+    __slots__ = ('body', 'headers', 'etag', 'last_modified', 'tags', 'encoded', 'size')
+
+    def __init__(self, body, headers, tags, last_modified):
+        self.body = body
+        self.headers = headers
+        self.etag = hashlib.blake2b(body, digest_size=16).hexdigest()
+        self.last_modified = last_modified
+        self.tags = tags
+        self.encoded = {}               # content coding -> compressed body, filled on demand
+        self.size = len(body)
+
+    def compressible(self):
+        mimetype = self.headers.get('Content-Type', '').split(';')[0].strip()
+        return encoding.compressible(mimetype, len(self.body))
+
+
+class ResponseCache:
+    """LRU cache of serialized GET responses, invalidated by tag on writes.
+
+    Every invalidation advances a global generation. A reader snapshots the
+    generation before running the query and the entry is only stored if none
+    of its tags was invalidated since, so a write racing a read can't leave a
+    stale entry behind. Invalidations are remembered for
+    CACHE_INVALIDATION_WINDOW seconds only, which keeps memory bounded
+    however many tags are ever used; a read that took longer than that is
+    served but not stored.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()   # key -> CacheEntry
+        self._modified = OrderedDict()  # key -> Last-Modified of its newest entry (LRU, 4 x max_entries)
+        self._by_tag = {}               # tag -> set(keys)
+        self._generation = 0
+        self._forgotten = 0             # generation of the newest invalidation no longer remembered
+        self._invalidated = OrderedDict()   # tag -> (generation, monotonic time) of its last invalidation, oldest first
+        self._bytes = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.not_modified = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    # Last-Modified for a new entry of `key`, in the whole seconds HTTP dates
+    # carry. An entry rebuilt within the second of the one it replaces is
+    # stamped a second later, so If-Modified-Since never matches stale data.
+    def stamp(self, key):
+        now = int(time.time())
+        with self._lock:
+            previous = self._modified.pop(key, None)
+            stamp = now if previous is None or now > previous else previous + 1
+            self._modified[key] = stamp
+            while len(self._modified) > self.max_entries * 4:
+                self._modified.popitem(last=False)
+        return stamp
+
+    def generation(self):
+        with self._lock:
+            return self._generation
+
+    def _prune(self, now):
+        cutoff = now - CACHE_INVALIDATION_WINDOW
+        while self._invalidated:
+            tag, (generation, at) = next(iter(self._invalidated.items()))
+            if at > cutoff:
+                break
+            del self._invalidated[tag]
+            self._forgotten = generation
+
+    def put(self, key, entry, generation):
+        size = entry.size
+        if size > self.max_bytes // 4:
+            return
+        with self._lock:
+            self._prune(time.monotonic())
+            if generation < self._forgotten or any(
+                    self._invalidated.get(tag, (0, 0))[0] > generation for tag in entry.tags):
+                return
+            self._remove(key)
+            self._entries[key] = entry
+            self._bytes += size
+            for tag in entry.tags:
+                self._by_tag.setdefault(tag, set()).add(key)
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self._bytes -= entry.size
+        for tag in entry.tags:
+            keys = self._by_tag.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_tag[tag]
+
+    # The entry's body in a content coding, compressed once and kept alongside
+    # it (and counted against max_bytes) while the entry is cached
+    def encoded(self, key, entry, coding):
+        body = entry.encoded.get(coding)
+        if body is not None:
+            return body
+        body = encoding.compress(entry.body, coding)
+        with self._lock:
+            if coding not in entry.encoded:
+                entry.encoded[coding] = body
+                entry.size += len(body)
+                if self._entries.get(key) is entry:
+                    self._bytes += len(body)
+        return body
+
+    # Whether any of the tags was invalidated in the last `seconds`: a replica
+    # read may not include that write yet
+    def recently_invalidated(self, tags, seconds):
+        cutoff = time.monotonic() - seconds
+        with self._lock:
+            return any(self._invalidated.get(tag, (0, 0))[1] > cutoff for tag in tags)
+
+    def invalidate(self, *tags):
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            self._generation += 1
+            for tag in tags:
+                self._invalidated.pop(tag, None)
+                self._invalidated[tag] = (self._generation, now)
+                for key in list(self._by_tag.get(tag, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            # Reads in flight right now may not store what they fetched
+            self._generation += 1
+            self._forgotten = self._generation
+            self._entries.clear()
+            self._by_tag.clear()
+            self._bytes = 0
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_ratio': round(self.hits / lookups, 4) if lookups else 0.0,
+                'not_modified': self.not_modified,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+                'remembered_invalidations': len(self._invalidated),
+            }
+
+
+response_cache = ResponseCache(CACHE_MAX_ENTRIES, CACHE_MAX_BYTES)
+
+
+def _respond(key, entry):
+    compressible = entry.compressible()
+    coding = encoding.negotiate(request.headers.get('Accept-Encoding')) if compressible else None
+    if coding:
+        response = current_app.response_class(response_cache.encoded(key, entry, coding), status=200)
+        response.headers['Content-Encoding'] = coding
+        response.set_etag(f'{entry.etag}-{coding}')
+    else:
+        response = current_app.response_class(entry.body, status=200)
+        response.set_etag(entry.etag)
+    for name, value in entry.headers.items():
+        response.headers[name] = value
+    if compressible:
+        # Each coding is its own representation with its own ETag
+        response.vary.add('Accept-Encoding')
+    response.last_modified = entry.last_modified
+    # Clients may keep the body but must revalidate; unchanged data costs a 304
+    response.headers['Cache-Control'] = 'no-cache'
+    response = response.make_conditional(request)
+    if response.status_code == 304:
+        response_cache.not_modified += 1
+    return response
+
+
+# Cache a GET view. `tags` maps the view kwargs (and request.args) to the
+# invalidation tags the response depends on. Streamed responses (ndjson) are
+# passed through uncached.
+def cached(tags):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            key = (request.path, tuple(sorted(request.args.items(multi=True))))
+            entry = response_cache.get(key)
+            if entry is None:
+                entry_tags = tuple(tags(**kwargs))
+                generation = response_cache.generation()
+                response = current_app.make_response(view(*args, **kwargs))
+                if response.status_code != 200 or response.is_streamed:
+                    return response
+                headers = {name: response.headers[name] for name in CACHED_HEADERS if name in response.headers}
+                entry = CacheEntry(response.get_data(), headers, entry_tags, response_cache.stamp(key))
+                if not (db.served_by_replica()
+                        and response_cache.recently_invalidated(entry_tags, db.DB_REPLICA_MAX_LAG)):
+                    response_cache.put(key, entry, generation)
+            return _respond(key, entry)
+        return wrapper
+    return decorator
+
+
+def invalidate(*tags):
+    response_cache.invalidate(*tags)
@@ -0,0 +1,433 @@
+import itertools
+import os
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+import psycopg2
+from psycopg2 import extensions
+from flask import g, jsonify, request
+
+import metrics
+
+# Hardcoded DB credentials (for trial only); environment overrides win
+DB_HOST = os.environ.get('DB_HOST', "....")
+DB_PORT = os.environ.get('DB_PORT', "5432")
+DB_NAME = os.environ.get('DB_NAME', "harvesthub")
+DB_USER = os.environ.get('DB_USER', "HarvestHub")
+DB_PASSWORD = os.environ.get('DB_PASSWORD', "0000")
+DB_CONNECT_TIMEOUT = int(os.environ.get('DB_CONNECT_TIMEOUT', 5))
+
+# Pool sizing / health settings
+DB_POOL_MIN = int(os.environ.get('DB_POOL_MIN', 1))
+DB_POOL_MAX = int(os.environ.get('DB_POOL_MAX', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 5))        # seconds to wait for a free connection
+DB_POOL_RECYCLE = float(os.environ.get('DB_POOL_RECYCLE', 1800))     # close connections older than this
+DB_POOL_PING_AFTER = float(os.environ.get('DB_POOL_PING_AFTER', 30))  # pre-ping connections idle longer than this
+DB_POOL_MAX_IDLE = float(os.environ.get('DB_POOL_MAX_IDLE', 300))    # shrink back to DB_POOL_MIN after this
+
+# Read replicas: comma separated host[:port] list sharing DB_NAME/DB_USER/DB_PASSWORD,
+# e.g. DB_REPLICA_HOSTS=localhost:5433 for a second local instance. Empty = primary only.
+DB_REPLICA_HOSTS = [h.strip() for h in os.environ.get('DB_REPLICA_HOSTS', '').split(',') if h.strip()]
+DB_REPLICA_POOL_MAX = int(os.environ.get('DB_REPLICA_POOL_MAX', DB_POOL_MAX))
+# Seconds a read waits for a busy replica's pool before trying the next one
+# (or the primary); only the primary's pool is waited on for DB_POOL_TIMEOUT
+DB_REPLICA_POOL_TIMEOUT = float(os.environ.get('DB_REPLICA_POOL_TIMEOUT', 0))
+DB_REPLICA_MAX_LAG = float(os.environ.get('DB_REPLICA_MAX_LAG', 2))          # seconds; laggier replicas are skipped
+DB_REPLICA_LAG_CHECK = float(os.environ.get('DB_REPLICA_LAG_CHECK', 1))      # re-measure lag at most this often
+DB_REPLICA_RETRY_AFTER = float(os.environ.get('DB_REPLICA_RETRY_AFTER', 10))  # skip an unreachable replica this long
+DB_READ_YOUR_WRITES = float(os.environ.get('DB_READ_YOUR_WRITES', 5))        # seconds a writer reads from the primary
+PRIMARY_COOKIE = 'hh_primary_until'
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class DatabaseUnavailable(Exception):
+    pass
+
+
+class ConnectionPool:
+    """Thread-safe psycopg2 pool with checkout timeouts, pre-ping and recycling."""
+
+    def __init__(self, minconn, maxconn, timeout, recycle, ping_after, max_idle, **connect_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.recycle = recycle
+        self.ping_after = ping_after
+        self.max_idle = max_idle
+        self.connect_kwargs = connect_kwargs
+
+        self._cond = threading.Condition()
+        self._idle = []     # [(conn, last_used)], most recently used last
+        self._born = {}     # id(conn) -> creation time
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+        self._checkouts = 0
+        self._timeouts = 0
+        self._connects = 0
+        self._discarded = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _connect(self):
+        try:
+            conn = psycopg2.connect(**self.connect_kwargs)
+        except Exception as e:
+            print(f"Connection error: {e}")
+            raise DatabaseUnavailable(str(e))
+        self._born[id(conn)] = time.monotonic()
+        self._connects += 1
+        return conn
+
+    def _discard(self, conn):
+        self._born.pop(id(conn), None)
+        self._discarded += 1
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+    def _usable(self, conn, last_used):
+        if conn.closed:
+            return False
+        now = time.monotonic()
+        if self.recycle and now - self._born.get(id(conn), now) > self.recycle:
+            return False
+        if now - last_used > self.ping_after:
+            try:
+                cur = conn.cursor()
+                cur.execute("SELECT 1;")
+                cur.close()
+                conn.rollback()
+            except Exception:
+                return False
+        return True
+
+    def open(self):
+        # Pre-fill up to minconn; failures are left for the first checkout to surface
+        with self._cond:
+            missing = self.minconn - self._size
+            self._size += max(missing, 0)
+        for _ in range(max(missing, 0)):
+            try:
+                conn = self._connect()
+            except DatabaseUnavailable:
+                with self._cond:
+                    self._size -= 1
+                continue
+            with self._cond:
+                self._idle.append((conn, time.monotonic()))
+                self._cond.notify()
+
+    def getconn(self, timeout=None):
+        timeout = self.timeout if timeout is None else timeout
+        start = time.monotonic()
+        deadline = start + timeout
+        conn = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    break
+                if self._size < self.maxconn:
+                    self._size += 1
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolExhausted(f"No database connection available within {timeout}s")
+                self._waiting += 1
+                try:
+                    self._cond.wait(remaining)
+                finally:
+                    self._waiting -= 1
+            self._in_use += 1
+
+        try:
+            if conn is not None and not self._usable(conn, last_used):
+                self._discard(conn)
+                conn = None
+            if conn is None:
+                conn = self._connect()
+        except DatabaseUnavailable:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+        waited = time.monotonic() - start
+        with self._cond:
+            self._checkouts += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        metrics.record_db_wait(waited)
+        return conn
+
+    def putconn(self, conn, close=False):
+        if not close and not conn.closed:
+            status = conn.info.transaction_status
+            if status == extensions.TRANSACTION_STATUS_UNKNOWN:
+                close = True
+            elif status != extensions.TRANSACTION_STATUS_IDLE:
+                try:
+                    conn.rollback()
+                except Exception:
+                    close = True
+
+        now = time.monotonic()
+        with self._cond:
+            self._in_use -= 1
+            if close or conn.closed:
+                self._size -= 1
+                self._discard(conn)
+            else:
+                self._idle.append((conn, now))
+                # Shrink: least recently used connections sit at the front
+                while (self._size > self.minconn and self._idle
+                       and now - self._idle[0][1] > self.max_idle):
+                    stale, _ = self._idle.pop(0)
+                    self._size -= 1
+                    self._discard(stale)
+            self._cond.notify()
+
+    @contextmanager
+    def connection(self, timeout=None):
+        conn = self.getconn(timeout)
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    # In a forked child: start with a fresh lock and no connections. The parent
+    # closes its connections before forking (see serve.py), since closing an
+    # inherited one here would end the parent's session too.
+    def after_fork(self):
+        self._cond = threading.Condition()
+        self._idle = []
+        self._born = {}
+        self._size = 0
+        self._in_use = 0
+        self._waiting = 0
+
+    def closeall(self):
+        with self._cond:
+            while self._idle:
+                conn, _ = self._idle.pop()
+                self._size -= 1
+                self._discard(conn)
+
+    def stats(self):
+        with self._cond:
+            return {
+                'min': self.minconn,
+                'max': self.maxconn,
+                'size': self._size,
+                'idle': len(self._idle),
+                'in_use': self._in_use,
+                'waiting': self._waiting,
+                'checkouts': self._checkouts,
+                'timeouts': self._timeouts,
+                'connects': self._connects,
+                'discarded': self._discarded,
+                'checkout_wait_avg_ms': round(self._wait_total / max(self._checkouts, 1) * 1000, 3),
+                'checkout_wait_max_ms': round(self._wait_max * 1000, 3),
+            }
+
+
+pool = ConnectionPool(
+    DB_POOL_MIN, DB_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_AFTER, DB_POOL_MAX_IDLE,
+    host=DB_HOST,
+    port=DB_PORT,
+    database=DB_NAME,
+    user=DB_USER,
+    password=DB_PASSWORD,
+    connect_timeout=DB_CONNECT_TIMEOUT,
+    cursor_factory=metrics.TimedCursor
+)
+
+
+# How far the replica's replay is behind the primary, in seconds. A replica
+# that has replayed everything it received is current, however old its last
+# transaction, but only while its WAL receiver is streaming: a receiver that
+# stopped or is reconnecting receives nothing, so the replica is behind by an
+# unknown amount (NULL). Without pg_read_all_stats the receiver's status reads
+# as NULL; its row still shows that it is running. A server that isn't in
+# recovery (e.g. a second standalone instance in development) counts as current.
+LAG_SQL = """
+    SELECT CASE
+        WHEN NOT pg_is_in_recovery() THEN 0
+        WHEN NOT EXISTS (SELECT 1 FROM pg_stat_wal_receiver WHERE status IS NULL OR status = 'streaming') THEN NULL
+        WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+        ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+    END;
+"""
+
+
+class Replica:
+    def __init__(self, host):
+        hostname, _, port = host.partition(':')
+        self.name = host
+        self.pool = ConnectionPool(
+            0, DB_REPLICA_POOL_MAX, DB_POOL_TIMEOUT, DB_POOL_RECYCLE, DB_POOL_PING_AFTER, DB_POOL_MAX_IDLE,
+            **dict(pool.connect_kwargs, host=hostname, port=port or DB_PORT))
+        self.lag = None
+        self.checked_at = 0.0
+        self.down_until = 0.0
+        self.reads = 0
+
+    def measure_lag(self, conn):
+        cur = conn.cursor()
+        cur.execute(LAG_SQL)
+        lag = cur.fetchone()[0]
+        self.lag = None if lag is None else float(lag)
+        cur.close()
+        conn.rollback()
+        self.checked_at = time.monotonic()
+
+    # Lag unknown (receiver not streaming) counts as too far behind
+    def behind(self):
+        return self.lag is None or self.lag > DB_REPLICA_MAX_LAG
+
+
+class Router:
+    """Sends read-only requests to a replica and everything else to the primary.
+
+    A request reads from a replica only if its view is marked @replica_read,
+    the client hasn't written within DB_READ_YOUR_WRITES seconds (a cookie set
+    on every successful write) and some replica is reachable and no more than
+    DB_REPLICA_MAX_LAG seconds behind; otherwise it falls back to the primary.
+    Replicas are tried round robin.
+    """
+
+    def __init__(self, primary, hosts):
+        self.primary = primary
+        self.replicas = [Replica(host) for host in hosts]
+        self._next = itertools.count()
+        self.read_your_writes = 0
+        self.fallbacks = 0
+
+    def pools(self):
+        return [self.primary] + [replica.pool for replica in self.replicas]
+
+    # (pool, conn) for a read-only request
+    def checkout_read(self):
+        start = next(self._next)
+        now = time.monotonic()
+        for i in range(len(self.replicas)):
+            replica = self.replicas[(start + i) % len(self.replicas)]
+            if replica.down_until > now:
+                continue
+            lag_known = now - replica.checked_at < DB_REPLICA_LAG_CHECK
+            if lag_known and replica.behind():
+                continue
+            try:
+                conn = replica.pool.getconn(timeout=DB_REPLICA_POOL_TIMEOUT)
+            except DatabaseUnavailable:
+                replica.down_until = now + DB_REPLICA_RETRY_AFTER
+                continue
+            except PoolExhausted:
+                continue
+            try:
+                if not lag_known:
+                    replica.measure_lag(conn)
+            except Exception as e:
+                print(f"Error checking replica {replica.name}: {e}")
+                replica.pool.putconn(conn, close=True)
+                replica.down_until = now + DB_REPLICA_RETRY_AFTER
+                continue
+            if replica.behind():
+                replica.pool.putconn(conn)
+                continue
+            replica.reads += 1
+            return replica.pool, conn
+        self.fallbacks += 1
+        return self.primary, self.primary.getconn()
+
+    def stats(self):
+        return {
+            'read_your_writes': self.read_your_writes,
+            'primary_fallbacks': self.fallbacks,
+            'replicas': [{
+                'host': replica.name,
+                'reads': replica.reads,
+                'lag_seconds': replica.lag,
+                'down': replica.down_until > time.monotonic(),
+                'pool': replica.pool.stats(),
+            } for replica in self.replicas],
+        }
+
+
+router = Router(pool, DB_REPLICA_HOSTS)
+
+
+# Mark a view as safe to serve from a replica
+def replica_read(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_replica_ok = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def _recent_writer():
+    try:
+        return float(request.cookies.get(PRIMARY_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+# Request-scoped connection: checked out on first use, returned on teardown
+def get_db_connection():
+    if 'db_conn' not in g:
+        if g.get('db_replica_ok') and router.replicas:
+            if _recent_writer():
+                router.read_your_writes += 1
+                g.db_pool, g.db_conn = pool, pool.getconn()
+            else:
+                g.db_pool, g.db_conn = router.checkout_read()
+        else:
+            g.db_pool, g.db_conn = pool, pool.getconn()
+    return g.db_conn
+
+
+# True when this request's reads came from a replica
+def served_by_replica():
+    return g.get('db_pool', pool) is not pool
+
+
+def release_db_connection(exc=None):
+    conn = g.pop('db_conn', None)
+    if conn is not None:
+        g.pop('db_pool', pool).putconn(conn)
+
+
+# After a successful write, send this client's reads to the primary for a while
+def _mark_writer(response):
+    if router.replicas and request.method not in ('GET', 'HEAD', 'OPTIONS') and response.status_code < 400:
+        until = time.time() + DB_READ_YOUR_WRITES
+        response.set_cookie(PRIMARY_COOKIE, f'{until:.3f}', max_age=int(DB_READ_YOUR_WRITES) + 1,
+                            httponly=True, samesite='Lax')
+    return response
+
+
+def init_app(app):
+    app.teardown_appcontext(release_db_connection)
+    app.after_request(_mark_writer)
+
+    @app.errorhandler(PoolExhausted)
+    def handle_pool_exhausted(e):
+        print(f"Pool exhausted: {e}")
+        response = jsonify({'error': 'Database busy, please retry'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
+
+    @app.errorhandler(DatabaseUnavailable)
+    def handle_db_unavailable(e):
+        return jsonify({'error': 'DB connection failed'}), 500
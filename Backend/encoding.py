@@ -0,0 +1,190 @@
+import datetime
+import decimal
+import gzip
+import json
+import os
+import uuid
+import zlib
+
+from flask import request
+from flask.json.provider import DefaultJSONProvider
+
+# orjson and brotli are optional: without them responses fall back to the
+# standard library encoder and gzip only
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+COMPRESS_MIN_BYTES = int(os.environ.get('COMPRESS_MIN_BYTES', 1024))
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 6))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 5))
+
+# Bodies worth compressing; images are already compressed and event streams
+# must reach the client unbuffered
+COMPRESSIBLE_MIMETYPES = ('application/json', 'application/x-ndjson', 'text/csv', 'text/plain', 'text/html',
+                          'text/css', 'text/javascript', 'application/javascript')
+
+# ?format= of the list endpoints: a JSON array of objects (default), columnar
+# ({"count": n, "columns": {field: [values...]}}, field names sent once) or
+# newline-delimited JSON streamed straight from the database
+LIST_FORMATS = ('json', 'columnar', 'ndjson')
+NDJSON_MIMETYPE = 'application/x-ndjson'
+
+
+def _default(value):
+    if isinstance(value, decimal.Decimal):
+        return float(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+# Compact JSON as UTF-8 bytes
+if orjson is not None:
+    def dumps(obj):
+        return orjson.dumps(obj, default=_default)
+else:
+    def dumps(obj):
+        return json.dumps(obj, default=_default, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+
+
+class JSONProvider(DefaultJSONProvider):
+    """jsonify() through dumps(): compact, and no str round trip on the way out."""
+
+    def dumps(self, obj, **kwargs):
+        return dumps(obj).decode('utf-8')
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(dumps(obj) + b'\n', mimetype=self.mimetype)
+
+
+def list_format(args):
+    fmt = args.get('format', 'json')
+    if fmt not in LIST_FORMATS:
+        raise ValueError('Unsupported format')
+    return fmt
+
+
+# Encode rows as a json or columnar list body, shaping each row as it is read
+# so no list of dicts is built first. Returns (body bytes, mimetype). ndjson is
+# streamed instead (see bulk.export_query).
+def encode_rows(rows, shape, fmt):
+    if fmt == 'columnar':
+        columns = None
+        count = 0
+        for row in rows:
+            item = shape(row)
+            if columns is None:
+                columns = {field: [] for field in item}
+            for field, value in item.items():
+                columns[field].append(value)
+            count += 1
+        return dumps({'count': count, 'columns': columns or {}}) + b'\n', 'application/json'
+    return b'[' + b','.join(dumps(shape(row)) for row in rows) + b']\n', 'application/json'
+
+
+# Content-Encoding to use for an Accept-Encoding header: 'br', 'gzip' or None
+def negotiate(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                quality = 0.0
+        accepted[coding.strip().lower()] = quality
+    for coding in ('br', 'gzip'):
+        if coding == 'br' and brotli is None:
+            continue
+        if accepted.get(coding, accepted.get('*', 0.0)) > 0:
+            return coding
+    return None
+
+
+def compressible(mimetype, size=None):
+    return mimetype in COMPRESSIBLE_MIMETYPES and (size is None or size >= COMPRESS_MIN_BYTES)
+
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+
+class StreamCompressor:
+    """Incremental compression for streamed bodies; every chunk is flushed so
+    the client can decode rows as they arrive."""
+
+    def __init__(self, coding):
+        if coding == 'br':
+            self._compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+            self._flush = self._compressor.flush
+            self._finish = self._compressor.finish
+            self._compress = self._compressor.process
+        else:
+            self._compressor = zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self._flush = lambda: self._compressor.flush(zlib.Z_SYNC_FLUSH)
+            self._finish = self._compressor.flush
+            self._compress = self._compressor.compress
+
+    def compress(self, chunk):
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        return self._compress(chunk) + self._flush()
+
+    def finish(self):
+        return self._finish()
+
+
+def compress_stream(chunks, coding):
+    compressor = StreamCompressor(coding)
+    try:
+        for chunk in chunks:
+            data = compressor.compress(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+    finally:
+        if hasattr(chunks, 'close'):
+            chunks.close()
+
+
+# Compress responses the view (or the response cache) didn't already encode
+def _compress_response(response):
+    if (response.status_code != 200 or 'Content-Encoding' in response.headers
+            or response.direct_passthrough or not compressible(response.mimetype)):
+        return response
+    response.vary.add('Accept-Encoding')
+    coding = negotiate(request.headers.get('Accept-Encoding'))
+    if coding is None:
+        return response
+    if response.is_streamed:
+        response.response = compress_stream(response.response, coding)
+        response.headers.pop('Content-Length', None)
+    else:
+        body = response.get_data()
+        if len(body) < COMPRESS_MIN_BYTES:
+            return response
+        response.set_data(compress(body, coding))
+        etag, weak = response.get_etag()
+        if etag:
+            response.set_etag(f'{etag}-{coding}', weak)
+    response.headers['Content-Encoding'] = coding
+    return response
+
+
+# Register after metrics.init_app() so response sizes are measured compressed
+def init_app(app):
+    app.json = JSONProvider(app)
+    app.after_request(_compress_response)
@@ -0,0 +1,227 @@
+import json
+import os
+import queue
+import select
+import threading
+import time
+
+import psycopg2
+
+import db
+
+EVENTS_CHANNEL = 'harvesthub_events'
+EVENTS_RETENTION_HOURS = float(os.environ.get('EVENTS_RETENTION_HOURS', 24))
+EVENTS_REPLAY_LIMIT = int(os.environ.get('EVENTS_REPLAY_LIMIT', 500))
+EVENTS_QUEUE_SIZE = int(os.environ.get('EVENTS_QUEUE_SIZE', 1000))
+EVENTS_HEARTBEAT = float(os.environ.get('EVENTS_HEARTBEAT', 15))
+
+# change_events rows and the NOTIFY on EVENTS_CHANNEL come from the
+# record_change_event() trigger installed by migration 7 (see migrations.py).
+# The SSE id / resume token is the event's position (migration 18), assigned
+# in commit order, not its row id: ids are taken at insert time, so an event
+# with a lower id can commit after a higher one was streamed, and resuming
+# after the id would skip it.
+
+
+# Which events a subscriber sees
+def event_visible(event, username, role):
+    payload = event['payload']
+    if event['kind'] == 'purchase_requests':
+        return username in (payload.get('farmer_id'), payload.get('buyer_id'))
+    if event['kind'] == 'listings':
+        if role == 'farmer':
+            return payload.get('farmer_id') == username
+        if role == 'buyer':
+            return payload.get('type') in ('sell', 'barter')
+        if role == 'ngo':
+            return payload.get('type') == 'donate' or payload.get('claimed_by') == username
+    return False
+
+
+def format_sse(event):
+    data = json.dumps(dict(event['payload'], op=event['op']), separators=(',', ':'))
+    return f"id: {event['id']}\nevent: {event['kind']}\ndata: {data}\n\n"
+
+
+class Subscription:
+    def __init__(self, username, role):
+        self.username = username
+        self.role = role
+        self.queue = queue.Queue(maxsize=EVENTS_QUEUE_SIZE)
+        self.overflowed = False
+
+    def offer(self, event):
+        if not event_visible(event, self.username, self.role):
+            return
+        try:
+            self.queue.put_nowait(event)
+        except queue.Full:
+            # Slow reader: end the stream, the client resumes from its last id
+            self.overflowed = True
+
+    # End the stream (e.g. on shutdown); the client reconnects and resumes
+    def close(self):
+        self.overflowed = True
+        try:
+            self.queue.put_nowait(None)
+        except queue.Full:
+            pass
+
+
+class EventBroker:
+    """One LISTEN connection per process fanning out change events.
+
+    Listeners (e.g. cache invalidation) see every event; SSE subscriptions
+    see the ones visible to their user.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+        self._listeners = []
+        self._thread = None
+        self._stopping = threading.Event()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='event-broker', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def subscribe(self, username, role):
+        return self.register(Subscription(username, role))
+
+    # Anything with an offer(event) method can subscribe (see aio.AsyncSubscription)
+    def register(self, subscription):
+        self.start()
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+    # End every open stream so the clients reconnect, to another worker when
+    # this one is shutting down
+    def close_streams(self):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            subscription.close()
+
+    def _dispatch(self, events):
+        for event in events:
+            for callback in self._listeners:
+                try:
+                    callback(event)
+                except Exception as e:
+                    print(f"Error in event listener: {e}")
+            with self._lock:
+                subscriptions = list(self._subscriptions)
+            for subscription in subscriptions:
+                subscription.offer(event)
+
+    def _run(self):
+        while not self._stopping.is_set():
+            conn = None
+            try:
+                conn = psycopg2.connect(**db.pool.connect_kwargs)
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute(f"LISTEN {EVENTS_CHANNEL};")
+                last_prune = 0
+                while not self._stopping.is_set():
+                    if time.monotonic() - last_prune > 3600:
+                        cur.execute("DELETE FROM change_events WHERE created_at < now() - make_interval(secs => %s);",
+                                    (EVENTS_RETENTION_HOURS * 3600,))
+                        last_prune = time.monotonic()
+                    if select.select([conn], [], [], 5)[0] == []:
+                        continue
+                    conn.poll()
+                    ids = []
+                    while conn.notifies:
+                        ids.append(int(conn.notifies.pop(0).payload))
+                    if ids:
+                        # NOTIFY arrives in commit order, so fetch exactly the notified ids
+                        cur.execute("""
+                            SELECT position, kind, op, payload FROM change_events
+                            WHERE id = ANY(%s::bigint[]) ORDER BY position;
+                        """, (ids,))
+                        self._dispatch([
+                            {'id': row[0], 'kind': row[1], 'op': row[2], 'payload': row[3]}
+                            for row in cur.fetchall()
+                        ])
+            except Exception as e:
+                print(f"Event listener error: {e}")
+                self._stopping.wait(5)
+            finally:
+                if conn is not None:
+                    conn.close()
+
+
+broker = EventBroker()
+
+
+# Events after position `last_event_id` visible to this user, for resuming a
+# stream. Returns (events, truncated); truncated means the client fell too far
+# behind and should reload instead of replaying.
+REPLAY_SQL = """
+    SELECT position, kind, op, payload FROM change_events
+    WHERE position > %s ORDER BY position LIMIT %s;
+"""
+LATEST_EVENT_SQL = "SELECT COALESCE(MAX(position), 0) FROM change_events;"
+
+
+def replay(conn, last_event_id, username, role):
+    cur = conn.cursor()
+    cur.execute(REPLAY_SQL, (last_event_id, EVENTS_REPLAY_LIMIT))
+    rows = cur.fetchall()
+    cur.close()
+    return visible_backlog(rows, username, role)
+
+
+def visible_backlog(rows, username, role):
+    events = [{'id': row[0], 'kind': row[1], 'op': row[2], 'payload': row[3]} for row in rows]
+    visible = [event for event in events if event_visible(event, username, role)]
+    return visible, len(rows) == EVENTS_REPLAY_LIMIT
+
+
+def latest_event_id(conn):
+    cur = conn.cursor()
+    cur.execute(LATEST_EVENT_SQL)
+    last = cur.fetchone()[0]
+    cur.close()
+    return last
+
+
+# Generator of SSE frames for one subscriber. The subscription is registered
+# before the backlog is read, so live events already in the backlog are skipped.
+def stream(subscription, backlog, last_event_id, truncated=False):
+    try:
+        yield f"retry: 3000\nid: {last_event_id}\n\n"
+        if truncated:
+            yield "event: reset\ndata: {}\n\n"
+        replayed = set()
+        for event in backlog:
+            replayed.add(event['id'])
+            yield format_sse(event)
+        while not subscription.overflowed:
+            try:
+                event = subscription.queue.get(timeout=EVENTS_HEARTBEAT)
+            except queue.Empty:
+                yield ": keep-alive\n\n"
+                continue
+            if event is None or event['id'] in replayed:
+                continue
+            yield format_sse(event)
+    finally:
+        broker.unsubscribe(subscription)
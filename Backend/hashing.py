@@ -0,0 +1,164 @@
+import os
+import threading
+import time
+from concurrent import futures
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import bcrypt
+from flask import jsonify
+
+BCRYPT_ROUNDS = int(os.environ.get('BCRYPT_ROUNDS', 12))
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', max((os.cpu_count() or 2) // 2, 1)))
+HASH_QUEUE_SIZE = int(os.environ.get('HASH_QUEUE_SIZE', HASH_WORKERS * 4))
+HASH_ADMISSION_TIMEOUT = float(os.environ.get('HASH_ADMISSION_TIMEOUT', 0.05))
+HASH_TIMEOUT = float(os.environ.get('HASH_TIMEOUT', 10))
+
+
+class HashingBusy(Exception):
+    pass
+
+
+# Run in the worker processes
+def _hashpw(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds))
+
+
+def _checkpw(password, hashed):
+    return bcrypt.checkpw(password, hashed)
+
+
+class HashPool:
+    """Size-limited process pool for bcrypt with admission control.
+
+    At most `workers + queue_size` hashes are admitted at once; beyond that
+    callers get HashingBusy straight away instead of piling up behind
+    CPU-bound work and starving cheap requests. A hash holds its slot until
+    the worker finishes it, even if the caller gave up waiting after
+    HASH_TIMEOUT. A pool whose worker died is replaced.
+    """
+
+    def __init__(self, workers, queue_size):
+        self.workers = workers
+        self.queue_size = queue_size
+        self._slots = threading.BoundedSemaphore(workers + queue_size)
+        self._lock = threading.Lock()
+        self._executor = None
+        self._pid = None
+
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._timed_out = 0
+        self._restarts = 0
+        self._latency_total = 0.0
+        self._latency_max = 0.0
+
+    def _get_executor(self):
+        # Created lazily, and again after a fork, so each worker process owns its pool
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+                self._pid = os.getpid()
+            return self._executor
+
+    # Drop a pool whose worker died (killed, out of memory) so the next call starts a fresh one
+    def _discard_executor(self, executor):
+        with self._lock:
+            if self._executor is not executor:
+                return
+            self._executor = None
+            self._restarts += 1
+        executor.shutdown(wait=False)
+
+    def _submit(self, fn, *args):
+        for _ in range(2):
+            executor = self._get_executor()
+            try:
+                return executor, executor.submit(fn, *args)
+            except BrokenProcessPool:
+                self._discard_executor(executor)
+        raise HashingBusy('Password hashing workers keep failing')
+
+    def _finish(self, start):
+        elapsed = time.monotonic() - start
+        with self._lock:
+            self._in_flight -= 1
+            self._completed += 1
+            self._latency_total += elapsed
+            self._latency_max = max(self._latency_max, elapsed)
+        self._slots.release()
+
+    def run(self, fn, *args):
+        if not self._slots.acquire(timeout=HASH_ADMISSION_TIMEOUT):
+            with self._lock:
+                self._rejected += 1
+            raise HashingBusy('Password hashing is saturated')
+        start = time.monotonic()
+        with self._lock:
+            self._in_flight += 1
+        try:
+            executor, future = self._submit(fn, *args)
+        except BaseException:
+            self._finish(start)
+            raise
+        # The slot is freed when the worker is done, not when the caller stops waiting
+        future.add_done_callback(lambda _: self._finish(start))
+        try:
+            return future.result(timeout=HASH_TIMEOUT)
+        except futures.TimeoutError:
+            with self._lock:
+                self._timed_out += 1
+            raise HashingBusy('Password hashing timed out')
+        except BrokenProcessPool:
+            self._discard_executor(executor)
+            raise HashingBusy('Password hashing worker failed')
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None and self._pid == os.getpid():
+                self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': self.workers,
+                'queue_size': self.queue_size,
+                'rounds': BCRYPT_ROUNDS,
+                'in_flight': self._in_flight,
+                'queue_depth': max(self._in_flight - self.workers, 0),
+                'completed': self._completed,
+                'rejected': self._rejected,
+                'timed_out': self._timed_out,
+                'restarts': self._restarts,
+                'latency_avg_ms': round(self._latency_total / max(self._completed, 1) * 1000, 3),
+                'latency_max_ms': round(self._latency_max * 1000, 3),
+            }
+
+
+hash_pool = HashPool(HASH_WORKERS, HASH_QUEUE_SIZE)
+
+
+def hash_password(password):
+    return hash_pool.run(_hashpw, password.encode('utf-8'), BCRYPT_ROUNDS).decode('utf-8')
+
+
+def check_password(password, hashed):
+    return hash_pool.run(_checkpw, password.encode('utf-8'), hashed.encode('utf-8'))
+
+
+# True when a stored hash was made with a different work factor than BCRYPT_ROUNDS
+def needs_rehash(hashed):
+    try:
+        return int(hashed.split('$')[2]) != BCRYPT_ROUNDS
+    except (IndexError, ValueError):
+        return True
+
+
+def init_app(app):
+    @app.errorhandler(HashingBusy)
+    def handle_hashing_busy(e):
+        response = jsonify({'error': 'Server busy, please retry'})
+        response.headers['Retry-After'] = '1'
+        return response, 503
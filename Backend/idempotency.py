@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+
+from psycopg2.extras import Json
+
+# Clients send `Idempotency-Key: <random id>` on POSTs they may retry. The
+# first request with a key stores its response in the same transaction as its
+# writes; retries with the key replay that response instead of running again.
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+IDEMPOTENCY_TTL_HOURS = int(os.environ.get('IDEMPOTENCY_TTL_HOURS', 24))
+KEY_MAX_LENGTH = 200
+
+
+class KeyMismatch(ValueError):
+    pass
+
+
+class KeyInFlight(Exception):
+    pass
+
+
+def valid_key(key):
+    return bool(key) and len(key) <= KEY_MAX_LENGTH and key.isprintable()
+
+
+# Hash of the request fields that must match when a key is reused
+def fingerprint(*parts):
+    raw = json.dumps(parts, default=str, separators=(',', ':')).encode('utf-8')
+    return hashlib.sha256(raw).hexdigest()
+
+
+# Claim a key inside the caller's transaction. Returns None for a new key: the
+# caller does the work, calls save() and commits (or rolls back to release the
+# key). For a key that was already used, returns its stored (status, body).
+# A concurrent request with the same key waits on the primary key until the
+# first one commits or rolls back, so the work runs at most once.
+def begin(cur, scope, key, request_fingerprint):
+    cur.execute("""
+        INSERT INTO idempotency_keys (scope, key, fingerprint)
+        VALUES (%s, %s, %s)
+        ON CONFLICT (scope, key) DO UPDATE
+            SET fingerprint = EXCLUDED.fingerprint, status_code = NULL, response = NULL, created_at = now()
+            WHERE idempotency_keys.created_at < now() - make_interval(hours => %s)
+        RETURNING 1;
+    """, (scope, key, request_fingerprint, IDEMPOTENCY_TTL_HOURS))
+    if cur.fetchone():
+        return None
+    cur.execute("""
+        SELECT fingerprint, status_code, response FROM idempotency_keys
+        WHERE scope = %s AND key = %s;
+    """, (scope, key))
+    stored_fingerprint, status_code, response = cur.fetchone()
+    if stored_fingerprint != request_fingerprint:
+        raise KeyMismatch('Idempotency key was already used for a different request')
+    if status_code is None:
+        raise KeyInFlight('A request with this idempotency key is still being processed')
+    return status_code, response
+
+
+def save(cur, scope, key, status_code, body):
+    cur.execute("""
+        UPDATE idempotency_keys SET status_code = %s, response = %s
+        WHERE scope = %s AND key = %s;
+    """, (status_code, Json(body), scope, key))
+
+
+# Delete expired keys; returns the number removed
+def prune(conn):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM idempotency_keys WHERE created_at < now() - make_interval(hours => %s);",
+                (IDEMPOTENCY_TTL_HOURS,))
+    removed = cur.rowcount
+    conn.commit()
+    cur.close()
+    return removed
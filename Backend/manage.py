@@ -0,0 +1,248 @@
+import argparse
+
+import sys
+
+import assets
+import db
+import blobstore
+import bulk
+import idempotency
+import matching
+import migrations
+import partitions
+import pricing
+import proofs
+import purchases
+import rollups
+import sessions
+
+
+# Apply pending schema migrations, or just report the schema version
+def migrate(args):
+    with db.pool.connection() as conn:
+        if args.status:
+            current, latest = migrations.schema_status(conn)
+            print(f"Schema version {current}, latest {latest}")
+            for migration in migrations.MIGRATIONS:
+                if migration.version > current:
+                    print(f"  pending {migration.version}: {migration.description}")
+            return
+        applied = migrations.migrate(conn, args.target)
+        current, _ = migrations.schema_status(conn)
+    print(f"Applied {len(applied)} migrations, schema is at version {current}")
+
+
+# Move inline base64 payment proofs into the blob store
+def migrate_proofs(args):
+    with db.pool.connection() as conn:
+        migrated = blobstore.migrate_legacy_proofs(conn, args.batch_size)
+    print(f"Migrated {migrated} payment proofs to {blobstore.BLOB_DIR}")
+
+
+# Recompute the analytics rollups from listings, then check them
+def rebuild_rollups(args):
+    with db.pool.connection() as conn:
+        if not args.verify_only:
+            rollups.rebuild(conn)
+            print("Rollups rebuilt")
+        mismatches = rollups.verify(conn)
+    for table, count in mismatches.items():
+        print(f"{table}: {'OK' if count == 0 else f'{count} mismatched rows'}")
+    if any(mismatches.values()):
+        sys.exit(1)
+
+
+# Recompute every donation <-> NGO match (e.g. after editing produce_categories)
+def rebuild_matches(args):
+    with db.pool.connection() as conn:
+        matching.rebuild(conn)
+    print("Donation matches rebuilt")
+
+
+# Recompute crop price statistics and buyer spend from listings and approved requests
+def rebuild_prices(args):
+    with db.pool.connection() as conn:
+        pricing.rebuild(conn)
+    print("Crop price statistics and buyer spend rebuilt")
+
+
+# Recompute the crops whose listings changed since the servers last did (safe to run from cron)
+def refresh_prices(args):
+    with db.pool.connection() as conn:
+        refreshed = pricing.refresh_dirty(conn, args.batch_size)
+    print(f"Refreshed price statistics of {refreshed} crops")
+
+
+def _format_for(path, fmt):
+    if fmt:
+        return fmt
+    return 'ndjson' if path.endswith(('.ndjson', '.jsonl')) else 'csv'
+
+
+# Bulk load listings from a CSV or NDJSON file (or - for stdin) via COPY
+def import_listings(args):
+    fmt = _format_for(args.file, args.format)
+    defaults = {k: v for k, v in (('farmer_id', args.farmer_id), ('farmer_name', args.farmer_name)) if v}
+    stream = sys.stdin if args.file == '-' else open(args.file, encoding='utf-8', newline='')
+    try:
+        with db.pool.connection() as conn:
+            inserted, errors = bulk.import_listings(conn, bulk.read_records(stream, fmt), defaults, args.batch_size)
+            if errors and args.atomic:
+                conn.rollback()
+                inserted = []
+            else:
+                conn.commit()
+    finally:
+        if stream is not sys.stdin:
+            stream.close()
+    for error in errors:
+        print(f"line {error['line']}: {error['error']}", file=sys.stderr)
+    print(f"Imported {len(inserted)} listings, {len(errors)} rejected rows")
+    if errors:
+        sys.exit(1)
+
+
+# Stream listings or purchase requests to a file (or stdout)
+def export_table(args):
+    fmt = args.format or (_format_for(args.output, None) if args.output != '-' else 'csv')
+    if args.table == 'listings':
+        chunks = bulk.export_listings(fmt, farmer_id=args.farmer_id)
+    else:
+        chunks = bulk.export_purchase_requests(fmt, farmer_id=args.farmer_id, buyer_id=args.buyer_id,
+                                               archived=args.table == 'archived-purchase-requests')
+    # CSV comes as text, NDJSON as UTF-8 bytes
+    out = sys.stdout.buffer if args.output == '-' else open(args.output, 'wb')
+    try:
+        for chunk in chunks:
+            out.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+    finally:
+        if out is not sys.stdout.buffer:
+            out.close()
+
+
+# Delete expired idempotency keys and listing holds (safe to run from cron)
+def prune(args):
+    with db.pool.connection() as conn:
+        keys = idempotency.prune(conn)
+        holds = purchases.prune_holds(conn)
+    print(f"Removed {keys} expired idempotency keys and {holds} expired listing holds")
+
+
+# Sign a user out everywhere, e.g. after a password leak
+def revoke_sessions(args):
+    with db.pool.connection() as conn:
+        sessions.revoke(conn, args.username)
+    print(f"Revoked every session of {args.username} issued so far")
+
+
+# Create upcoming purchase request partitions and archive old ones (run daily)
+def maintain_partitions(args):
+    if args.archive_after < 1:
+        sys.exit("--archive-after must be at least 1 month")
+    with db.pool.connection() as conn:
+        created = partitions.ensure_partitions(conn)
+        print(f"Created {len(created)} partitions" + (f": {', '.join(created)}" if created else ''))
+        if not args.no_archive:
+            summary = partitions.archive(conn, args.archive_after)
+            print(f"Archived {len(summary['archived'])} months, {summary['swept']} straggling requests; "
+                  f"moved {summary['cold_proofs']} proofs to cold storage")
+            for name in summary['skipped']:
+                print(f"Skipped {name}: lock not available, retry later", file=sys.stderr)
+        if args.verbose:
+            for parent, name, rows in partitions.report(conn):
+                print(f"{parent:28} {name:40} ~{max(rows, 0)} rows")
+
+
+# Queue proofs without thumbnails (e.g. uploaded before migration 16) and
+# process whatever is due here; running servers pick up the rest as well
+def process_proofs(args):
+    with db.pool.connection() as conn:
+        queued = proofs.backfill(conn, retry_failed=args.retry_failed)
+        print(f"Queued {queued} proofs")
+        if args.enqueue_only:
+            return
+        if proofs.Image is None:
+            sys.exit("Processing proofs needs Pillow installed")
+        counts = proofs.drain(conn)
+    print(f"Processed proofs: {counts['ready']} ready, {counts['failed']} failed, {counts['retry']} to retry")
+
+
+# Write the fingerprinted, precompressed Frontend for a reverse proxy or CDN
+def build_assets(args):
+    written = assets.store.build(args.output)
+    print(f"Wrote {written} assets (with .gz/.br variants) to {args.output}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Harvest Hub maintenance commands')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    cmd = commands.add_parser('migrate', help='apply pending schema migrations')
+    cmd.add_argument('--status', action='store_true', help='show the schema version and pending migrations')
+    cmd.add_argument('--target', type=int, help='stop after this version')
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser('migrate-proofs', help='move inline payment proofs into the blob store')
+    cmd.add_argument('--batch-size', type=int, default=100)
+    cmd.set_defaults(func=migrate_proofs)
+
+    cmd = commands.add_parser('rebuild-rollups', help='recompute analytics rollups and verify them against listings')
+    cmd.add_argument('--verify-only', action='store_true', help='only compare the rollups with the raw listings')
+    cmd.set_defaults(func=rebuild_rollups)
+
+    cmd = commands.add_parser('rebuild-matches', help='recompute donation recommendations for every NGO')
+    cmd.set_defaults(func=rebuild_matches)
+
+    cmd = commands.add_parser('rebuild-prices', help='recompute crop price statistics and buyer spend')
+    cmd.set_defaults(func=rebuild_prices)
+
+    cmd = commands.add_parser('refresh-prices', help='recompute price statistics of crops with changed listings')
+    cmd.add_argument('--batch-size', type=int, default=pricing.PRICE_REFRESH_BATCH)
+    cmd.set_defaults(func=refresh_prices)
+
+    cmd = commands.add_parser('import-listings', help='bulk load listings from CSV or NDJSON')
+    cmd.add_argument('file', help="input file, or - for stdin")
+    cmd.add_argument('--format', choices=['csv', 'ndjson'])
+    cmd.add_argument('--farmer-id', help='farmer_id for rows that omit it')
+    cmd.add_argument('--farmer-name', help='farmer_name for rows that omit it')
+    cmd.add_argument('--batch-size', type=int, default=bulk.IMPORT_BATCH_SIZE)
+    cmd.add_argument('--atomic', action='store_true', help='import nothing if any row is invalid')
+    cmd.set_defaults(func=import_listings)
+
+    cmd = commands.add_parser('export', help='stream a table as CSV or NDJSON')
+    cmd.add_argument('table', choices=['listings', 'purchase-requests', 'archived-purchase-requests'])
+    cmd.add_argument('--format', choices=['csv', 'ndjson'])
+    cmd.add_argument('--output', default='-', help='output file, or - for stdout')
+    cmd.add_argument('--farmer-id')
+    cmd.add_argument('--buyer-id')
+    cmd.set_defaults(func=export_table)
+
+    cmd = commands.add_parser('prune', help='delete expired idempotency keys and listing holds')
+    cmd.set_defaults(func=prune)
+
+    cmd = commands.add_parser('process-proofs', help='make payment proof thumbnails, backfilling old proofs')
+    cmd.add_argument('--retry-failed', action='store_true', help='retry proofs that failed before')
+    cmd.add_argument('--enqueue-only', action='store_true', help='only queue them for the servers')
+    cmd.set_defaults(func=process_proofs)
+
+    cmd = commands.add_parser('revoke-sessions', help="revoke every session token of a user")
+    cmd.add_argument('username')
+    cmd.set_defaults(func=revoke_sessions)
+
+    cmd = commands.add_parser('partitions', help='create upcoming purchase request partitions and archive old ones')
+    cmd.add_argument('--archive-after', type=int, default=partitions.ARCHIVE_AFTER_MONTHS,
+                     help='archive resolved requests older than this many months')
+    cmd.add_argument('--no-archive', action='store_true', help='only create partitions')
+    cmd.add_argument('--verbose', action='store_true', help='list partitions with row estimates')
+    cmd.set_defaults(func=maintain_partitions)
+
+    cmd = commands.add_parser('build-assets', help='write fingerprinted, precompressed frontend files')
+    cmd.add_argument('--output', default='dist', help='output directory')
+    cmd.set_defaults(func=build_assets)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,41 @@
+# Donation <-> NGO matching. donation_matches holds one scored row per
+# (NGO, available donation) pair that has something in common; it is kept
+# current by database triggers (migration 12) whenever a donation is added,
+# edited, claimed or deleted and whenever an NGO's focus area changes. The
+# scoring itself lives in the donation_match_candidates view (migration 20:
+# produce categories match by title words); the feed is read through
+# queries.RecommendationQuery, which skips donations no longer available.
+
+
+# Recompute every match from scratch
+def rebuild(conn, commit=True):
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE donation_matches IN EXCLUSIVE MODE;")
+    cur.execute("DELETE FROM donation_matches;")
+    cur.execute("""
+        INSERT INTO donation_matches (ngo_id, listing_id, score, focus_score, past_claims, available_date)
+        SELECT ngo_id, listing_id, score, focus_score, past_claims, available_date
+        FROM donation_match_candidates;
+    """)
+    if commit:
+        conn.commit()
+    cur.close()
+
+
+# After an NGO claims a crop, its other open donations of that crop rank
+# higher for that NGO. Call after the claim's rollups were applied, since the
+# claim history comes from ngo_monthly_stats.
+def record_claim(cur, ngo_id, title):
+    cur.execute("""
+        DELETE FROM donation_matches m
+        USING listings l
+        WHERE m.ngo_id = %s AND l.id = m.listing_id AND l.title = %s;
+    """, (ngo_id, title))
+    cur.execute("""
+        INSERT INTO donation_matches (ngo_id, listing_id, score, focus_score, past_claims, available_date)
+        SELECT ngo_id, listing_id, score, focus_score, past_claims, available_date
+        FROM donation_match_candidates
+        WHERE ngo_id = %s AND listing_id IN (
+            SELECT id FROM listings WHERE type = 'donate' AND status = 'available' AND title = %s
+        );
+    """, (ngo_id, title))
@@ -0,0 +1,333 @@
+import cProfile
+import io
+import os
+import pstats
+import re
+import threading
+import time
+from contextvars import ContextVar
+
+from flask import g, request
+from psycopg2 import extensions
+
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))       # 0 disables the slow-request log
+SLOW_LOG_STATEMENTS = int(os.environ.get('SLOW_LOG_STATEMENTS', 5))
+STATEMENT_MAX_CHARS = 300
+# Profiling one request: send `X-Profile: <PROFILE_TOKEN>`. Unset token = disabled.
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_TOP = int(os.environ.get('PROFILE_TOP', 25))
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SIZE_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+# Session tokens passed as ?token= (see sessions.py) stay out of the logs
+TOKEN_PARAM_RE = re.compile(r'([?&]token=)[^&]*')
+
+
+class RequestStats:
+    __slots__ = ('db_wait', 'db_time', 'statements', 'rows', 'slowest')
+
+    def __init__(self):
+        self.db_wait = 0.0
+        self.db_time = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.slowest = []       # [(seconds, statement text)], for the slow-request log
+
+    def add_statement(self, query, elapsed):
+        self.db_time += elapsed
+        self.statements += 1
+        if SLOW_REQUEST_MS:
+            if isinstance(query, bytes):
+                query = query.decode('utf-8', 'replace')
+            self.slowest.append((elapsed, ' '.join(str(query).split())[:STATEMENT_MAX_CHARS]))
+            if len(self.slowest) > SLOW_LOG_STATEMENTS * 4:
+                self.slowest.sort(reverse=True)
+                del self.slowest[SLOW_LOG_STATEMENTS:]
+
+
+# Stats of the request running in this thread (or task); None outside requests
+_current = ContextVar('request_stats', default=None)
+
+
+def record_db_wait(seconds):
+    stats = _current.get()
+    if stats is not None:
+        stats.db_wait += seconds
+
+
+def record_rows(count):
+    stats = _current.get()
+    if stats is not None:
+        stats.rows += count
+
+
+def record_statement(query, elapsed):
+    stats = _current.get()
+    if stats is not None:
+        stats.add_statement(query, elapsed)
+
+
+class TimedCursor(extensions.cursor):
+    """Cursor that charges statement time and fetched rows to the current request.
+
+    Statement text is logged without its parameters, so values such as
+    password hashes never reach the slow-request log.
+    """
+
+    def execute(self, query, vars=None):
+        start = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_statement(query, time.perf_counter() - start)
+
+    def executemany(self, query, vars_list):
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_statement(query, time.perf_counter() - start)
+
+    def copy_expert(self, sql, file, size=8192):
+        start = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_statement(sql, time.perf_counter() - start)
+
+    # Fetches from named cursors are round trips, so they count as DB time too
+    def fetchone(self):
+        start = time.perf_counter()
+        row = super().fetchone()
+        self._fetched(start, 1 if row is not None else 0)
+        return row
+
+    def fetchmany(self, size=None):
+        start = time.perf_counter()
+        rows = super().fetchmany(self.arraysize if size is None else size)
+        self._fetched(start, len(rows))
+        return rows
+
+    def fetchall(self):
+        start = time.perf_counter()
+        rows = super().fetchall()
+        self._fetched(start, len(rows))
+        return rows
+
+    def __iter__(self):
+        while True:
+            rows = self.fetchmany(self.itersize)
+            if not rows:
+                return
+            yield from rows
+
+    def _fetched(self, start, count):
+        stats = _current.get()
+        if stats is not None:
+            if self.name:
+                stats.db_time += time.perf_counter() - start
+            stats.rows += count
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+class RouteMetrics:
+    def __init__(self):
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.response_bytes = Histogram(SIZE_BUCKETS)
+        self.statuses = {}
+        self.db_wait = 0.0
+        self.db_time = 0.0
+        self.statements = 0
+        self.rows = 0
+        self.slow = 0
+
+
+class Registry:
+    """Per-route request metrics, rendered in the Prometheus text format."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._routes = {}           # (method, route) -> RouteMetrics
+        self._collectors = []       # (prefix, fn returning {name: number})
+
+    def add_collector(self, prefix, fn):
+        self._collectors.append((prefix, fn))
+
+    def observe(self, method, route, status, elapsed, size, stats, slow):
+        with self._lock:
+            metrics = self._routes.get((method, route))
+            if metrics is None:
+                metrics = self._routes[(method, route)] = RouteMetrics()
+            metrics.latency.observe(elapsed)
+            if size is not None:
+                metrics.response_bytes.observe(size)
+            metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.db_wait += stats.db_wait
+            metrics.db_time += stats.db_time
+            metrics.statements += stats.statements
+            metrics.rows += stats.rows
+            metrics.slow += slow
+
+    def render(self):
+        lines = []
+
+        def histogram(name, help_text, key):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} histogram")
+            for (method, route), metrics in routes:
+                h = getattr(metrics, key)
+                labels = f'method="{method}",route="{_escape(route)}"'
+                cumulative = 0
+                for bound, count in zip(h.buckets, h.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+                lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {h.count}')
+                lines.append(f'{name}_sum{{{labels}}} {h.sum:.6f}')
+                lines.append(f'{name}_count{{{labels}}} {h.count}')
+
+        def counter(name, help_text, key):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} counter")
+            for (method, route), metrics in routes:
+                lines.append(f'{name}{{method="{method}",route="{_escape(route)}"}} {getattr(metrics, key)}')
+
+        with self._lock:
+            routes = sorted((key, _snapshot(metrics)) for key, metrics in self._routes.items())
+
+        lines.append("# HELP harvesthub_requests_total Requests handled, by route and status.")
+        lines.append("# TYPE harvesthub_requests_total counter")
+        for (method, route), metrics in routes:
+            for status, count in sorted(metrics.statuses.items()):
+                lines.append(f'harvesthub_requests_total{{method="{method}",route="{_escape(route)}",'
+                             f'status="{status}"}} {count}')
+        histogram('harvesthub_request_duration_seconds', 'Time to build the response.', 'latency')
+        histogram('harvesthub_response_bytes', 'Response body size (streamed responses excluded).',
+                  'response_bytes')
+        counter('harvesthub_db_wait_seconds_total', 'Time spent waiting for a pooled connection.', 'db_wait')
+        counter('harvesthub_db_seconds_total', 'Time spent executing SQL and fetching rows.', 'db_time')
+        counter('harvesthub_db_statements_total', 'SQL statements executed.', 'statements')
+        counter('harvesthub_db_rows_total', 'Rows fetched from the database.', 'rows')
+        counter('harvesthub_slow_requests_total', f'Requests slower than {SLOW_REQUEST_MS:g}ms.', 'slow')
+
+        for prefix, fn in self._collectors:
+            try:
+                values = fn()
+            except Exception as e:
+                print(f"Error collecting {prefix} metrics: {e}")
+                continue
+            for key, value in sorted(values.items()):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f"# TYPE harvesthub_{prefix}_{key} gauge")
+                lines.append(f"harvesthub_{prefix}_{key} {value}")
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+
+def _snapshot(metrics):
+    copy = RouteMetrics()
+    for name in ('latency', 'response_bytes'):
+        src, dst = getattr(metrics, name), getattr(copy, name)
+        dst.counts, dst.sum, dst.count = list(src.counts), src.sum, src.count
+    copy.statuses = dict(metrics.statuses)
+    copy.db_wait, copy.db_time = metrics.db_wait, metrics.db_time
+    copy.statements, copy.rows, copy.slow = metrics.statements, metrics.rows, metrics.slow
+    return copy
+
+
+registry = Registry()
+
+# cProfile can only run one profiler per process at a time
+_profile_lock = threading.Lock()
+
+
+# Request tracking for servers other than Flask (see aio.py): begin_request()
+# makes DB time in this thread or task count towards the returned stats
+def begin_request():
+    stats = RequestStats()
+    return stats, _current.set(stats)
+
+
+def end_request(token, stats, method, route, path, status, elapsed, size):
+    _current.reset(token)
+    slow = bool(SLOW_REQUEST_MS) and elapsed * 1000 >= SLOW_REQUEST_MS
+    registry.observe(method, route, str(status), elapsed, size, stats, slow)
+    if slow:
+        path = TOKEN_PARAM_RE.sub(r'\1***', path)
+        print(f"Slow request: {method} {path} -> {status} in {elapsed * 1000:.1f}ms "
+              f"(db wait {stats.db_wait * 1000:.1f}ms, db {stats.db_time * 1000:.1f}ms, "
+              f"{stats.statements} statements, {stats.rows} rows)")
+        for seconds, statement in sorted(stats.slowest, reverse=True)[:SLOW_LOG_STATEMENTS]:
+            print(f"  {seconds * 1000:8.1f}ms  {statement}")
+
+
+def server_timing(stats, elapsed):
+    return (f"db-wait;dur={stats.db_wait * 1000:.1f}, db;dur={stats.db_time * 1000:.1f}, "
+            f"total;dur={elapsed * 1000:.1f}")
+
+
+def _route():
+    # The URL rule, not the raw path, so ids don't explode the label set
+    return request.url_rule.rule if request.url_rule is not None else '<unmatched>'
+
+
+def _start_request():
+    g.metrics_start = time.perf_counter()
+    g.metrics_stats, g.metrics_token = begin_request()
+    g.metrics_profiler = None
+    if PROFILE_TOKEN and request.headers.get('X-Profile') == PROFILE_TOKEN and _profile_lock.acquire(blocking=False):
+        g.metrics_profiler = cProfile.Profile()
+        g.metrics_profiler.enable()
+
+
+def _finish_response(response):
+    if 'metrics_start' not in g:
+        return response
+    elapsed = time.perf_counter() - g.metrics_start
+    stats = g.metrics_stats
+    g.metrics_status = response.status_code
+    g.metrics_size = None if response.is_streamed else response.calculate_content_length()
+    response.headers['Server-Timing'] = server_timing(stats, elapsed)
+    return response
+
+
+def _finish_request(exc=None):
+    if 'metrics_start' not in g:
+        return
+    elapsed = time.perf_counter() - g.metrics_start
+    end_request(g.metrics_token, g.metrics_stats, request.method, _route(), request.full_path.rstrip('?'),
+                g.get('metrics_status', 500), elapsed, g.get('metrics_size'))
+
+    profiler = g.get('metrics_profiler')
+    if profiler is not None:
+        profiler.disable()
+        _profile_lock.release()
+        out = io.StringIO()
+        pstats.Stats(profiler, stream=out).sort_stats('cumulative').print_stats(PROFILE_TOP)
+        print(f"Profile for {request.method} {request.full_path.rstrip('?')}:\n{out.getvalue()}")
+
+
+def init_app(app):
+    app.before_request(_start_request)
+    app.after_request(_finish_response)
+    app.teardown_request(_finish_request)
@@ -0,0 +1,1073 @@
+import os
+import time
+
+from psycopg2 import errors
+
+import matching
+import partitions
+import pricing
+import rollups
+
+# Versioned schema migrations, applied by `python manage.py migrate`.
+#
+# Append new migrations to MIGRATIONS with the next version number; never edit
+# one that has shipped. Transactional migrations run in a single transaction
+# together with their schema_version row. Migrations marked
+# transactional=False run statement by statement in autocommit mode, which is
+# what CREATE INDEX CONCURRENTLY and batched backfills need so that reads and
+# writes keep flowing while they run. Every DDL statement runs under a short
+# lock_timeout and is retried, so a migration waiting for a lock never queues
+# ordinary queries behind it for long.
+
+MIGRATION_LOCK_ID = 7_201_944_301   # pg_advisory_lock key: one migrator at a time
+MIGRATION_LOCK_TIMEOUT = os.environ.get('MIGRATION_LOCK_TIMEOUT', '5s')
+MIGRATION_RETRIES = int(os.environ.get('MIGRATION_RETRIES', 5))
+BACKFILL_BATCH_SIZE = int(os.environ.get('BACKFILL_BATCH_SIZE', 5000))
+
+
+class Migration:
+    def __init__(self, version, description, steps, transactional=True):
+        self.version = version
+        self.description = description
+        self.steps = steps              # SQL strings or callables taking the connection
+        self.transactional = transactional
+
+
+# CREATE INDEX CONCURRENTLY that can be re-run after a failure: an interrupted
+# concurrent build leaves an INVALID index behind, which is dropped first
+def concurrent_index(name, definition):
+    def step(conn):
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT NOT i.indisvalid FROM pg_index i
+            JOIN pg_class c ON c.oid = i.indexrelid
+            WHERE c.relname = %s;
+        """, (name,))
+        row = cur.fetchone()
+        if row and row[0]:
+            cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {name};")
+        cur.execute(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON {definition};")
+        cur.close()
+    step.__name__ = f'create index {name}'
+    return step
+
+
+def backfill_quantity(conn):
+    cur = conn.cursor()
+    while True:
+        cur.execute("""
+            UPDATE listings
+            SET quantity_amount = COALESCE(substring(quantity FROM '^\\s*([0-9]+(?:\\.[0-9]+)?)')::numeric, 0),
+                quantity_unit = CASE WHEN quantity ~ '^\\s*[0-9]'
+                    THEN NULLIF(left(btrim(regexp_replace(quantity, '^\\s*[0-9]+(\\.[0-9]+)?', '')), 20), '')
+                END
+            WHERE id IN (SELECT id FROM listings WHERE quantity_amount IS NULL LIMIT %s);
+        """, (BACKFILL_BATCH_SIZE,))
+        if cur.rowcount == 0:
+            break
+    cur.close()
+
+
+def backfill_search(conn):
+    cur = conn.cursor()
+    while True:
+        cur.execute("""
+            UPDATE listings
+            SET search_vector = listing_search_vector(title, type, farmer_name),
+                search_text = listing_search_text(title, type, farmer_name)
+            WHERE id IN (SELECT id FROM listings WHERE search_text IS NULL LIMIT %s);
+        """, (BACKFILL_BATCH_SIZE,))
+        if cur.rowcount == 0:
+            break
+    cur.close()
+
+
+def seed_matches(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM donation_matches);")
+    if cur.fetchone()[0]:
+        matching.rebuild(conn, commit=False)
+    cur.close()
+
+
+def rescore_matches(conn):
+    matching.rebuild(conn, commit=False)
+
+
+def seed_prices(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM crop_price_stats);")
+    if cur.fetchone()[0]:
+        pricing.rebuild(conn, commit=False)
+    cur.close()
+
+
+def create_request_partitions(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT MIN(created_at) FROM purchase_requests_unpartitioned;")
+    oldest = cur.fetchone()[0]
+    cur.close()
+    partitions.ensure_partitions(conn, oldest, commit=False)
+
+
+def seed_rollups(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT NOT EXISTS (SELECT 1 FROM farmer_monthly_stats) AND EXISTS (SELECT 1 FROM listings);")
+    if cur.fetchone()[0]:
+        rollups.rebuild(conn, commit=False)
+    cur.close()
+
+
+MIGRATIONS = [
+    Migration(1, 'base schema', [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            username VARCHAR(100) PRIMARY KEY,
+            password VARCHAR(100) NOT NULL,
+            role VARCHAR(50) NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS listings (
+            id SERIAL PRIMARY KEY,
+            title VARCHAR(100) NOT NULL,
+            quantity VARCHAR(50) NOT NULL,
+            type VARCHAR(50) NOT NULL,
+            farmer_id VARCHAR(100) NOT NULL,
+            farmer_name VARCHAR(100) NOT NULL,
+            available_date DATE,
+            price DECIMAL(10,2)
+        );
+        """,
+        """
+        ALTER TABLE listings
+            ADD COLUMN IF NOT EXISTS status VARCHAR(50) DEFAULT 'available',
+            ADD COLUMN IF NOT EXISTS claimed_by VARCHAR(100);
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ngo_profiles (
+            ngo_id VARCHAR(100) PRIMARY KEY,
+            org_name VARCHAR(200) NOT NULL,
+            contact VARCHAR(100) NOT NULL,
+            address TEXT NOT NULL,
+            focus_area TEXT NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS purchase_requests (
+            id SERIAL PRIMARY KEY,
+            listing_id INTEGER NOT NULL,
+            buyer_id VARCHAR(100) NOT NULL,
+            farmer_id VARCHAR(100) NOT NULL,
+            crop_title VARCHAR(100) NOT NULL,
+            quantity VARCHAR(50) NOT NULL,
+            price DECIMAL(10,2),
+            payment_proof TEXT,
+            status VARCHAR(50) DEFAULT 'pending',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+        );
+        """,
+    ]),
+    # Indexes backing the filtered, keyset-paginated listing reads
+    Migration(2, 'listing filter indexes', [
+        concurrent_index('idx_listings_farmer_id', "listings (farmer_id, id)"),
+        concurrent_index('idx_listings_type_status', "listings (type, status, id)"),
+        concurrent_index('idx_listings_claimed_by', "listings (claimed_by, id) WHERE claimed_by IS NOT NULL"),
+        concurrent_index('idx_listings_status_date', "listings (status, (COALESCE(available_date, DATE '1970-01-01')), id)"),
+        concurrent_index('idx_listings_status_price', "listings (status, (COALESCE(price, 0)), id)"),
+    ], transactional=False),
+    # Payment proofs live in the blob store; payment_proof only holds legacy inline data
+    Migration(3, 'payment proof blob columns', [
+        """
+        ALTER TABLE purchase_requests
+            ADD COLUMN IF NOT EXISTS proof_hash VARCHAR(64),
+            ADD COLUMN IF NOT EXISTS proof_size INTEGER;
+        """,
+    ]),
+    # Numeric quantity: "12.5 kg" -> quantity_amount 12.5, quantity_unit 'kg'
+    Migration(4, 'numeric listing quantity', [
+        """
+        ALTER TABLE listings
+            ADD COLUMN IF NOT EXISTS quantity_amount NUMERIC(12,3),
+            ADD COLUMN IF NOT EXISTS quantity_unit VARCHAR(20);
+        """,
+    ]),
+    Migration(5, 'backfill listing quantity', [backfill_quantity], transactional=False),
+    # Analytics rollups, maintained by the listing write paths (see rollups.py)
+    Migration(6, 'analytics rollups', [
+        """
+        CREATE TABLE IF NOT EXISTS farmer_monthly_stats (
+            farmer_id VARCHAR(100) NOT NULL,
+            month DATE NOT NULL,
+            listing_count INTEGER NOT NULL DEFAULT 0,
+            quantity NUMERIC NOT NULL DEFAULT 0,
+            earnings NUMERIC NOT NULL DEFAULT 0,
+            sell_count INTEGER NOT NULL DEFAULT 0,
+            barter_count INTEGER NOT NULL DEFAULT 0,
+            donate_count INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (farmer_id, month)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS ngo_monthly_stats (
+            ngo_id VARCHAR(100) NOT NULL,
+            month DATE NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            claimed_count INTEGER NOT NULL DEFAULT 0,
+            claimed_quantity NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (ngo_id, month, title)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS crop_monthly_stats (
+            title VARCHAR(100) NOT NULL,
+            month DATE NOT NULL,
+            type VARCHAR(50) NOT NULL,
+            status VARCHAR(50) NOT NULL,
+            listing_count INTEGER NOT NULL DEFAULT 0,
+            priced_count INTEGER NOT NULL DEFAULT 0,
+            price_sum NUMERIC NOT NULL DEFAULT 0,
+            quantity NUMERIC NOT NULL DEFAULT 0,
+            PRIMARY KEY (title, month, type, status)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_crop_monthly_stats_type_status ON crop_monthly_stats (type, status);",
+        seed_rollups,
+    ]),
+    # Change feed: triggers record listing / purchase request changes and NOTIFY listeners (see events.py)
+    Migration(7, 'change events feed', [
+        """
+        CREATE TABLE IF NOT EXISTS change_events (
+            id BIGSERIAL PRIMARY KEY,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            kind VARCHAR(50) NOT NULL,
+            op VARCHAR(10) NOT NULL,
+            payload JSONB NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_change_events_created_at ON change_events (created_at);",
+        """
+        CREATE OR REPLACE FUNCTION record_change_event() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+            payload JSONB;
+            event_id BIGINT;
+        BEGIN
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+            IF TG_TABLE_NAME = 'listings' THEN
+                payload := jsonb_build_object(
+                    'id', rec.id, 'title', rec.title, 'type', rec.type, 'status', rec.status,
+                    'farmer_id', rec.farmer_id, 'claimed_by', rec.claimed_by);
+            ELSE
+                payload := jsonb_build_object(
+                    'id', rec.id, 'listing_id', rec.listing_id, 'status', rec.status,
+                    'farmer_id', rec.farmer_id, 'buyer_id', rec.buyer_id);
+            END IF;
+            INSERT INTO change_events (kind, op, payload)
+            VALUES (TG_TABLE_NAME, lower(TG_OP), payload)
+            RETURNING id INTO event_id;
+            PERFORM pg_notify('harvesthub_events', event_id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_change_event ON listings;
+        CREATE TRIGGER listings_change_event
+            AFTER INSERT OR UPDATE OR DELETE ON listings
+            FOR EACH ROW EXECUTE PROCEDURE record_change_event();
+        """,
+        """
+        DROP TRIGGER IF EXISTS purchase_requests_change_event ON purchase_requests;
+        CREATE TRIGGER purchase_requests_change_event
+            AFTER INSERT OR DELETE OR UPDATE OF status ON purchase_requests
+            FOR EACH ROW EXECUTE PROCEDURE record_change_event();
+        """,
+    ]),
+    # Short buyer reservations on listings and stored responses for client
+    # idempotency keys (see purchases.py and idempotency.py)
+    Migration(8, 'listing holds and idempotency keys', [
+        """
+        CREATE TABLE IF NOT EXISTS listing_holds (
+            listing_id INTEGER PRIMARY KEY REFERENCES listings (id) ON DELETE CASCADE,
+            buyer_id VARCHAR(100) NOT NULL,
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS idempotency_keys (
+            scope VARCHAR(50) NOT NULL,
+            key VARCHAR(200) NOT NULL,
+            fingerprint VARCHAR(64) NOT NULL,
+            status_code INTEGER,
+            response JSONB,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            PRIMARY KEY (scope, key)
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys (created_at);",
+    ]),
+    # A buyer's pending request for a listing, and a listing's pending requests
+    Migration(9, 'pending purchase request index', [
+        concurrent_index('idx_purchase_requests_pending',
+                         "purchase_requests (listing_id, buyer_id) WHERE status = 'pending'"),
+    ], transactional=False),
+    # Listing search (see queries.ListingQuery): a weighted tsvector for ranked
+    # full-text and prefix matches, and lowercased text for pg_trgm fuzzy
+    # matches, both kept current by a trigger. The change feed trigger is
+    # narrowed to the user-visible columns so backfills don't flood it.
+    Migration(10, 'listing search columns', [
+        "CREATE EXTENSION IF NOT EXISTS pg_trgm;",
+        """
+        ALTER TABLE listings
+            ADD COLUMN IF NOT EXISTS search_vector TSVECTOR,
+            ADD COLUMN IF NOT EXISTS search_text TEXT;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listing_search_vector(title TEXT, type TEXT, farmer_name TEXT)
+        RETURNS TSVECTOR AS $$
+            SELECT setweight(to_tsvector('simple', coalesce(title, '')), 'A')
+                || setweight(to_tsvector('simple', coalesce(farmer_name, '')), 'B')
+                || setweight(to_tsvector('simple', coalesce(type, '')), 'C');
+        $$ LANGUAGE sql IMMUTABLE;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listing_search_text(title TEXT, type TEXT, farmer_name TEXT)
+        RETURNS TEXT AS $$
+            SELECT lower(coalesce(title, '') || ' ' || coalesce(farmer_name, '') || ' ' || coalesce(type, ''));
+        $$ LANGUAGE sql IMMUTABLE;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION set_listing_search() RETURNS trigger AS $$
+        BEGIN
+            NEW.search_vector := listing_search_vector(NEW.title, NEW.type, NEW.farmer_name);
+            NEW.search_text := listing_search_text(NEW.title, NEW.type, NEW.farmer_name);
+            RETURN NEW;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_search ON listings;
+        CREATE TRIGGER listings_search
+            BEFORE INSERT OR UPDATE OF title, type, farmer_name ON listings
+            FOR EACH ROW EXECUTE PROCEDURE set_listing_search();
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_change_event ON listings;
+        CREATE TRIGGER listings_change_event
+            AFTER INSERT OR DELETE OR UPDATE OF title, quantity, type, farmer_id, farmer_name,
+                available_date, price, status, claimed_by ON listings
+            FOR EACH ROW EXECUTE PROCEDURE record_change_event();
+        """,
+    ]),
+    Migration(11, 'listing search indexes', [
+        backfill_search,
+        concurrent_index('idx_listings_search_vector', "listings USING gin (search_vector)"),
+        concurrent_index('idx_listings_search_trgm', "listings USING gin (search_text gin_trgm_ops)"),
+    ], transactional=False),
+    # Donation <-> NGO matches (see matching.py), kept current by triggers on
+    # listings and ngo_profiles so every write path, COPY included, is covered
+    Migration(12, 'donation matches', [
+        """
+        CREATE TABLE IF NOT EXISTS produce_categories (
+            crop VARCHAR(50) PRIMARY KEY,
+            terms TEXT NOT NULL
+        );
+        """,
+        """
+        INSERT INTO produce_categories (crop, terms) VALUES
+            ('tomato', 'vegetables fresh produce salad cooking kitchens meals'),
+            ('potato', 'vegetables staples cooking kitchens meals'),
+            ('onion', 'vegetables staples cooking kitchens meals'),
+            ('carrot', 'vegetables fresh produce nutrition children school'),
+            ('spinach', 'vegetables leafy greens fresh produce nutrition'),
+            ('cabbage', 'vegetables leafy greens fresh produce cooking'),
+            ('cauliflower', 'vegetables fresh produce cooking'),
+            ('garlic', 'vegetables spices cooking kitchens'),
+            ('ginger', 'vegetables spices cooking kitchens'),
+            ('peas', 'vegetables pulses protein nutrition'),
+            ('okra', 'vegetables fresh produce cooking'),
+            ('mango', 'fruits fresh produce nutrition children school'),
+            ('apple', 'fruits fresh produce nutrition children school elderly'),
+            ('orange', 'fruits fresh produce nutrition vitamins children'),
+            ('banana', 'fruits fresh produce nutrition children school elderly'),
+            ('wheat', 'grains staples flour bread food security relief'),
+            ('rice', 'grains staples food security relief kitchens meals shelters'),
+            ('maize', 'grains staples food security relief'),
+            ('lentil', 'pulses protein staples nutrition relief kitchens'),
+            ('chickpea', 'pulses protein staples nutrition relief')
+        ON CONFLICT (crop) DO NOTHING;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS donation_matches (
+            ngo_id VARCHAR(100) NOT NULL REFERENCES ngo_profiles (ngo_id) ON DELETE CASCADE,
+            listing_id INTEGER NOT NULL REFERENCES listings (id) ON DELETE CASCADE,
+            score NUMERIC(4,2) NOT NULL,
+            focus_score REAL NOT NULL,
+            past_claims INTEGER NOT NULL,
+            available_date DATE,
+            PRIMARY KEY (ngo_id, listing_id)
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_donation_matches_feed ON donation_matches
+            (ngo_id, score DESC, (COALESCE(available_date, DATE 'infinity')), listing_id);
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_donation_matches_listing_id ON donation_matches (listing_id);",
+        # Focus areas are free text: any (stemmed) word of it may match
+        """
+        CREATE OR REPLACE FUNCTION focus_tsquery(focus_area TEXT) RETURNS TSQUERY AS $$
+            SELECT replace(plainto_tsquery('english', coalesce(focus_area, ''))::text, ' & ', ' | ')::tsquery;
+        $$ LANGUAGE sql STABLE;
+        """,
+        # Every available donation scored against every NGO: how well the
+        # donation (crop, type and its produce category terms) matches the
+        # NGO's focus area, plus how often the NGO claimed that crop before.
+        # Pairs with neither signal are left out.
+        """
+        CREATE OR REPLACE VIEW donation_match_candidates AS
+        SELECT ngo_id, listing_id,
+               round((LEAST(focus_score * 10, 1) * 0.6 + LEAST(past_claims, 10) / 10.0 * 0.4)::numeric, 2) AS score,
+               focus_score, past_claims, available_date
+        FROM (
+            SELECT p.ngo_id, l.id AS listing_id, l.available_date,
+                   ts_rank(to_tsvector('english', l.title || ' ' || l.type || ' ' || COALESCE(c.terms, '')),
+                           focus_tsquery(p.focus_area)) AS focus_score,
+                   COALESCE(h.claims, 0)::integer AS past_claims
+            FROM listings l
+            CROSS JOIN ngo_profiles p
+            LEFT JOIN LATERAL (
+                SELECT string_agg(terms, ' ') AS terms FROM produce_categories
+                WHERE l.search_text LIKE '%' || crop || '%'
+            ) c ON true
+            LEFT JOIN LATERAL (
+                SELECT SUM(claimed_count) AS claims FROM ngo_monthly_stats s
+                WHERE s.ngo_id = p.ngo_id AND s.title = l.title
+            ) h ON true
+            WHERE l.type = 'donate' AND l.status = 'available'
+        ) m
+        WHERE focus_score > 0 OR past_claims > 0;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION refresh_listing_matches(listing_ids INTEGER[]) RETURNS void AS $$
+            DELETE FROM donation_matches WHERE listing_id = ANY(listing_ids);
+            INSERT INTO donation_matches (ngo_id, listing_id, score, focus_score, past_claims, available_date)
+            SELECT ngo_id, listing_id, score, focus_score, past_claims, available_date
+            FROM donation_match_candidates WHERE listing_id = ANY(listing_ids);
+        $$ LANGUAGE sql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION refresh_ngo_matches(ngo VARCHAR) RETURNS void AS $$
+            DELETE FROM donation_matches WHERE ngo_id = ngo;
+            INSERT INTO donation_matches (ngo_id, listing_id, score, focus_score, past_claims, available_date)
+            SELECT ngo_id, listing_id, score, focus_score, past_claims, available_date
+            FROM donation_match_candidates WHERE ngo_id = ngo;
+        $$ LANGUAGE sql;
+        """,
+        # Statement-level triggers with transition tables: a bulk import
+        # rescores its donations in one set-based pass
+        """
+        CREATE OR REPLACE FUNCTION listings_inserted_matches() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_listing_matches(ARRAY(SELECT id FROM inserted WHERE type = 'donate'));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_updated_matches() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_listing_matches(ARRAY(
+                SELECT n.id FROM updated n JOIN previous o ON o.id = n.id
+                WHERE (n.type = 'donate' OR o.type = 'donate')
+                  AND (n.title, n.type, n.status, n.available_date)
+                      IS DISTINCT FROM (o.title, o.type, o.status, o.available_date)));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION ngo_profile_matches() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_ngo_matches(NEW.ngo_id);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_insert_matches ON listings;
+        CREATE TRIGGER listings_insert_matches
+            AFTER INSERT ON listings REFERENCING NEW TABLE AS inserted
+            FOR EACH STATEMENT EXECUTE PROCEDURE listings_inserted_matches();
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_update_matches ON listings;
+        CREATE TRIGGER listings_update_matches
+            AFTER UPDATE ON listings REFERENCING OLD TABLE AS previous NEW TABLE AS updated
+            FOR EACH STATEMENT EXECUTE PROCEDURE listings_updated_matches();
+        """,
+        """
+        DROP TRIGGER IF EXISTS ngo_profiles_matches ON ngo_profiles;
+        CREATE TRIGGER ngo_profiles_matches
+            AFTER INSERT OR UPDATE OF focus_area ON ngo_profiles
+            FOR EACH ROW EXECUTE PROCEDURE ngo_profile_matches();
+        """,
+        seed_matches,
+    ]),
+    # A crop's priced sell listings, for its price statistics
+    Migration(13, 'crop price index', [
+        concurrent_index('idx_listings_crop_price', "listings (title, price) WHERE type = 'sell' AND price > 0"),
+    ], transactional=False),
+    # Crop price statistics and buyer spend (see pricing.py), kept current by
+    # statement-level triggers so bulk imports and batch approvals are covered
+    Migration(14, 'crop price statistics and buyer spend', [
+        """
+        CREATE TABLE IF NOT EXISTS crop_price_stats (
+            title VARCHAR(100) PRIMARY KEY,
+            listing_count INTEGER NOT NULL,
+            min_price NUMERIC(10,2) NOT NULL,
+            p10 NUMERIC(10,2) NOT NULL,
+            median NUMERIC(10,2) NOT NULL,
+            p90 NUMERIC(10,2) NOT NULL,
+            trend JSONB NOT NULL,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_crop_price_stats_count ON crop_price_stats (listing_count DESC, title);",
+        """
+        CREATE TABLE IF NOT EXISTS buyer_crop_spend (
+            buyer_id VARCHAR(100) NOT NULL,
+            title VARCHAR(100) NOT NULL,
+            purchases INTEGER NOT NULL,
+            quantity NUMERIC(14,3) NOT NULL,
+            spend NUMERIC(14,2) NOT NULL,
+            market_value NUMERIC(14,2) NOT NULL,
+            PRIMARY KEY (buyer_id, title)
+        );
+        """,
+        # Same parsing as the listing quantity backfill: "12.5 kg" -> 12.5
+        """
+        CREATE OR REPLACE FUNCTION parse_quantity_amount(quantity TEXT) RETURNS NUMERIC AS $$
+            SELECT COALESCE(substring(quantity FROM '^\\s*([0-9]+(?:\\.[0-9]+)?)')::numeric, 0);
+        $$ LANGUAGE sql IMMUTABLE;
+        """,
+        # Crops are locked in title order before their listings are read, so
+        # concurrent writers to one crop recompute it one after the other and
+        # the last one sees every committed listing. A full rebuild locks the
+        # whole table instead (lock_crops = false).
+        """
+        CREATE OR REPLACE FUNCTION refresh_crop_prices(titles VARCHAR[], lock_crops BOOLEAN DEFAULT true)
+        RETURNS void AS $$
+        BEGIN
+            IF lock_crops THEN
+                PERFORM pg_advisory_xact_lock(hashtext('crop_price_stats:' || t))
+                FROM (SELECT DISTINCT unnest(titles) AS t ORDER BY 1) locked;
+            END IF;
+
+            DELETE FROM crop_price_stats c
+            WHERE c.title = ANY(titles) AND NOT EXISTS (
+                SELECT 1 FROM listings l WHERE l.title = c.title AND l.type = 'sell' AND l.price > 0);
+
+            INSERT INTO crop_price_stats (title, listing_count, min_price, p10, median, p90, trend)
+            SELECT s.title, s.listing_count, s.min_price, s.p10, s.median, s.p90, COALESCE(t.trend, '[]'::jsonb)
+            FROM (
+                SELECT title, COUNT(*) AS listing_count, MIN(price) AS min_price,
+                       round(percentile_cont(0.1) WITHIN GROUP (ORDER BY price)::numeric, 2) AS p10,
+                       round(percentile_cont(0.5) WITHIN GROUP (ORDER BY price)::numeric, 2) AS median,
+                       round(percentile_cont(0.9) WITHIN GROUP (ORDER BY price)::numeric, 2) AS p90
+                FROM listings
+                WHERE title = ANY(titles) AND type = 'sell' AND price > 0
+                GROUP BY title
+            ) s
+            LEFT JOIN LATERAL (
+                SELECT jsonb_agg(jsonb_build_object(
+                           'month', to_char(month, 'YYYY-MM'), 'listings', listing_count,
+                           'median', median, 'min', min_price) ORDER BY month) AS trend
+                FROM (
+                    SELECT date_trunc('month', available_date) AS month, COUNT(*) AS listing_count,
+                           MIN(price) AS min_price,
+                           round(percentile_cont(0.5) WITHIN GROUP (ORDER BY price)::numeric, 2) AS median
+                    FROM listings
+                    WHERE title = s.title AND type = 'sell' AND price > 0
+                      AND available_date >= date_trunc('month', now()) - interval '11 months'
+                    GROUP BY 1
+                ) monthly
+            ) t ON true
+            ON CONFLICT (title) DO UPDATE SET
+                listing_count = EXCLUDED.listing_count, min_price = EXCLUDED.min_price, p10 = EXCLUDED.p10,
+                median = EXCLUDED.median, p90 = EXCLUDED.p90, trend = EXCLUDED.trend, updated_at = now();
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        # Approved purchases, valued at the crop's median price right now.
+        # Only priced purchases count towards spend and market value.
+        """
+        CREATE OR REPLACE FUNCTION add_buyer_spend(request_ids INTEGER[]) RETURNS void AS $$
+            INSERT INTO buyer_crop_spend (buyer_id, title, purchases, quantity, spend, market_value)
+            SELECT r.buyer_id, r.crop_title, COUNT(*), SUM(r.amount),
+                   COALESCE(SUM(r.amount * r.price) FILTER (WHERE r.price > 0), 0),
+                   COALESCE(SUM(r.amount * COALESCE(s.median, r.price)) FILTER (WHERE r.price > 0), 0)
+            FROM (
+                SELECT buyer_id, crop_title, parse_quantity_amount(quantity) AS amount, price
+                FROM purchase_requests WHERE id = ANY(request_ids)
+            ) r
+            LEFT JOIN crop_price_stats s ON s.title = r.crop_title
+            GROUP BY r.buyer_id, r.crop_title
+            ORDER BY r.buyer_id, r.crop_title
+            ON CONFLICT (buyer_id, title) DO UPDATE SET
+                purchases = buyer_crop_spend.purchases + EXCLUDED.purchases,
+                quantity = buyer_crop_spend.quantity + EXCLUDED.quantity,
+                spend = buyer_crop_spend.spend + EXCLUDED.spend,
+                market_value = buyer_crop_spend.market_value + EXCLUDED.market_value;
+        $$ LANGUAGE sql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_inserted_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_crop_prices(ARRAY(
+                SELECT DISTINCT title FROM inserted WHERE type = 'sell' AND price > 0));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_updated_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_crop_prices(ARRAY(
+                SELECT t FROM updated n JOIN previous o ON o.id = n.id,
+                     LATERAL (VALUES (o.title), (n.title)) titles (t)
+                WHERE (n.type = 'sell' OR o.type = 'sell')
+                  AND (n.title, n.type, n.price, n.available_date)
+                      IS DISTINCT FROM (o.title, o.type, o.price, o.available_date)));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_deleted_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM refresh_crop_prices(ARRAY(
+                SELECT DISTINCT title FROM removed WHERE type = 'sell' AND price > 0));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION purchase_requests_approved_spend() RETURNS trigger AS $$
+        BEGIN
+            PERFORM add_buyer_spend(ARRAY(
+                SELECT n.id FROM updated n JOIN previous o ON o.id = n.id
+                WHERE n.status = 'approved' AND o.status IS DISTINCT FROM 'approved'));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_insert_prices ON listings;
+        CREATE TRIGGER listings_insert_prices
+            AFTER INSERT ON listings REFERENCING NEW TABLE AS inserted
+            FOR EACH STATEMENT EXECUTE PROCEDURE listings_inserted_prices();
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_update_prices ON listings;
+        CREATE TRIGGER listings_update_prices
+            AFTER UPDATE ON listings REFERENCING OLD TABLE AS previous NEW TABLE AS updated
+            FOR EACH STATEMENT EXECUTE PROCEDURE listings_updated_prices();
+        """,
+        """
+        DROP TRIGGER IF EXISTS listings_delete_prices ON listings;
+        CREATE TRIGGER listings_delete_prices
+            AFTER DELETE ON listings REFERENCING OLD TABLE AS removed
+            FOR EACH STATEMENT EXECUTE PROCEDURE listings_deleted_prices();
+        """,
+        """
+        DROP TRIGGER IF EXISTS purchase_requests_spend ON purchase_requests;
+        CREATE TRIGGER purchase_requests_spend
+            AFTER UPDATE ON purchase_requests REFERENCING OLD TABLE AS previous NEW TABLE AS updated
+            FOR EACH STATEMENT EXECUTE PROCEDURE purchase_requests_approved_spend();
+        """,
+        seed_prices,
+    ]),
+    # purchase_requests partitioned by created_at month, with per-user
+    # indexes, and purchase_requests_archive for months that went cold (see
+    # partitions.py). A one-off copy under an exclusive lock: purchase
+    # requests wait while it runs. Primary keys include the partition key;
+    # ids still come from the one sequence.
+    Migration(15, 'partitioned purchase requests', [
+        "LOCK TABLE purchase_requests IN ACCESS EXCLUSIVE MODE;",
+        "ALTER SEQUENCE purchase_requests_id_seq OWNED BY NONE;",
+        "ALTER TABLE purchase_requests RENAME TO purchase_requests_unpartitioned;",
+        """
+        CREATE TABLE purchase_requests (
+            id INTEGER NOT NULL DEFAULT nextval('purchase_requests_id_seq'),
+            listing_id INTEGER NOT NULL,
+            buyer_id VARCHAR(100) NOT NULL,
+            farmer_id VARCHAR(100) NOT NULL,
+            crop_title VARCHAR(100) NOT NULL,
+            quantity VARCHAR(50) NOT NULL,
+            price DECIMAL(10,2),
+            payment_proof TEXT,
+            status VARCHAR(50) DEFAULT 'pending',
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            proof_hash VARCHAR(64),
+            proof_size INTEGER
+        ) PARTITION BY RANGE (created_at);
+        """,
+        "CREATE TABLE purchase_requests_default PARTITION OF purchase_requests DEFAULT;",
+        create_request_partitions,
+        """
+        INSERT INTO purchase_requests
+            (id, listing_id, buyer_id, farmer_id, crop_title, quantity, price, payment_proof,
+             status, created_at, proof_hash, proof_size)
+        SELECT id, listing_id, buyer_id, farmer_id, crop_title, quantity, price, payment_proof,
+               status, COALESCE(created_at, CURRENT_TIMESTAMP), proof_hash, proof_size
+        FROM purchase_requests_unpartitioned;
+        """,
+        "DROP TABLE purchase_requests_unpartitioned;",
+        "ALTER SEQUENCE purchase_requests_id_seq OWNED BY purchase_requests.id;",
+        "ALTER TABLE purchase_requests ADD PRIMARY KEY (id, created_at);",
+        "CREATE INDEX idx_purchase_requests_farmer_created ON purchase_requests (farmer_id, created_at);",
+        "CREATE INDEX idx_purchase_requests_buyer_created ON purchase_requests (buyer_id, created_at);",
+        "CREATE INDEX idx_purchase_requests_pending ON purchase_requests (listing_id, buyer_id) WHERE status = 'pending';",
+        """
+        CREATE TABLE purchase_requests_archive (
+            id INTEGER NOT NULL,
+            listing_id INTEGER NOT NULL,
+            buyer_id VARCHAR(100) NOT NULL,
+            farmer_id VARCHAR(100) NOT NULL,
+            crop_title VARCHAR(100) NOT NULL,
+            quantity VARCHAR(50) NOT NULL,
+            price DECIMAL(10,2),
+            payment_proof TEXT,
+            status VARCHAR(50),
+            created_at TIMESTAMP NOT NULL,
+            proof_hash VARCHAR(64),
+            proof_size INTEGER,
+            PRIMARY KEY (id, created_at)
+        ) PARTITION BY RANGE (created_at);
+        """,
+        "CREATE TABLE purchase_requests_archive_default PARTITION OF purchase_requests_archive DEFAULT;",
+        "CREATE INDEX idx_purchase_requests_archive_farmer ON purchase_requests_archive (farmer_id, created_at);",
+        "CREATE INDEX idx_purchase_requests_archive_buyer ON purchase_requests_archive (buyer_id, created_at);",
+        """
+        CREATE TRIGGER purchase_requests_change_event
+            AFTER INSERT OR DELETE OR UPDATE OF status ON purchase_requests
+            FOR EACH ROW EXECUTE PROCEDURE record_change_event();
+        """,
+        """
+        CREATE TRIGGER purchase_requests_spend
+            AFTER UPDATE ON purchase_requests REFERENCING OLD TABLE AS previous NEW TABLE AS updated
+            FOR EACH STATEMENT EXECUTE PROCEDURE purchase_requests_approved_spend();
+        """,
+        # Archived requests count towards spend in a rebuild
+        """
+        CREATE OR REPLACE FUNCTION add_buyer_spend(request_ids INTEGER[]) RETURNS void AS $$
+            INSERT INTO buyer_crop_spend (buyer_id, title, purchases, quantity, spend, market_value)
+            SELECT r.buyer_id, r.crop_title, COUNT(*), SUM(r.amount),
+                   COALESCE(SUM(r.amount * r.price) FILTER (WHERE r.price > 0), 0),
+                   COALESCE(SUM(r.amount * COALESCE(s.median, r.price)) FILTER (WHERE r.price > 0), 0)
+            FROM (
+                SELECT buyer_id, crop_title, parse_quantity_amount(quantity) AS amount, price
+                FROM purchase_requests WHERE id = ANY(request_ids)
+                UNION ALL
+                SELECT buyer_id, crop_title, parse_quantity_amount(quantity) AS amount, price
+                FROM purchase_requests_archive WHERE id = ANY(request_ids)
+            ) r
+            LEFT JOIN crop_price_stats s ON s.title = r.crop_title
+            GROUP BY r.buyer_id, r.crop_title
+            ORDER BY r.buyer_id, r.crop_title
+            ON CONFLICT (buyer_id, title) DO UPDATE SET
+                purchases = buyer_crop_spend.purchases + EXCLUDED.purchases,
+                quantity = buyer_crop_spend.quantity + EXCLUDED.quantity,
+                spend = buyer_crop_spend.spend + EXCLUDED.spend,
+                market_value = buyer_crop_spend.market_value + EXCLUDED.market_value;
+        $$ LANGUAGE sql;
+        """,
+    ]),
+    # Payment proof thumbnails and recompressed images, and the queue of
+    # proofs waiting for them (see proofs.py)
+    Migration(16, 'payment proof variants', [
+        """
+        CREATE TABLE IF NOT EXISTS proof_variants (
+            proof_hash VARCHAR(64) PRIMARY KEY,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            thumb_hash VARCHAR(64),
+            full_hash VARCHAR(64),
+            width INTEGER,
+            height INTEGER,
+            error TEXT,
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_proof_variants_due ON proof_variants (next_attempt_at) WHERE status = 'pending';",
+    ]),
+    # Revoked session tokens (see sessions.py). session_id NULL revokes every
+    # token of the user issued before revoked_at; rows are kept until the
+    # tokens they revoke would have expired anyway.
+    Migration(17, 'session revocations', [
+        """
+        CREATE TABLE IF NOT EXISTS session_revocations (
+            id BIGSERIAL PRIMARY KEY,
+            username VARCHAR(100) NOT NULL,
+            session_id VARCHAR(32),
+            revoked_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+            expires_at TIMESTAMPTZ NOT NULL
+        );
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_session_revocations_expires ON session_revocations (expires_at);",
+    ]),
+    # Commit-ordered resume tokens for the change feed (see events.py). The id
+    # is taken at insert time, so a transaction can commit its events after a
+    # higher id was already streamed. position is assigned by a deferred
+    # trigger at commit, under a lock held until the commit is visible: the
+    # positions of every committed event are gap-free in commit order.
+    # Existing rows keep their id as position so open streams resume as before.
+    Migration(18, 'commit ordered change event positions', [
+        "ALTER TABLE change_events ADD COLUMN IF NOT EXISTS position BIGINT;",
+        "CREATE SEQUENCE IF NOT EXISTS change_events_position_seq;",
+        "UPDATE change_events SET position = id WHERE position IS NULL;",
+        "SELECT setval('change_events_position_seq', GREATEST((SELECT MAX(id) FROM change_events), 1));",
+        "CREATE UNIQUE INDEX IF NOT EXISTS idx_change_events_position ON change_events (position);",
+        """
+        CREATE OR REPLACE FUNCTION assign_change_event_position() RETURNS trigger AS $$
+        BEGIN
+            -- Serializes only the commit tail of transactions that wrote events
+            PERFORM pg_advisory_xact_lock(hashtext('change_events_position'));
+            UPDATE change_events SET position = nextval('change_events_position_seq') WHERE id = NEW.id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        DROP TRIGGER IF EXISTS change_events_position ON change_events;
+        CREATE CONSTRAINT TRIGGER change_events_position
+            AFTER INSERT ON change_events
+            DEFERRABLE INITIALLY DEFERRED
+            FOR EACH ROW EXECUTE PROCEDURE assign_change_event_position();
+        """,
+    ]),
+    # Crop price statistics are recomputed in the background (see pricing.py)
+    # instead of by the listing write that changed them: the triggers only
+    # queue the crops they touched. Rows are appended, never updated, so
+    # concurrent writers to one crop don't wait for each other.
+    Migration(19, 'background crop price refresh', [
+        """
+        CREATE TABLE IF NOT EXISTS crop_price_dirty (
+            id BIGSERIAL PRIMARY KEY,
+            title VARCHAR(100) NOT NULL,
+            marked_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+        """,
+        """
+        CREATE OR REPLACE FUNCTION mark_crop_prices_dirty(titles VARCHAR[]) RETURNS void AS $$
+            INSERT INTO crop_price_dirty (title)
+            SELECT DISTINCT t FROM unnest(titles) t WHERE t IS NOT NULL;
+        $$ LANGUAGE sql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_inserted_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM mark_crop_prices_dirty(ARRAY(
+                SELECT title FROM inserted WHERE type = 'sell' AND price > 0));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_updated_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM mark_crop_prices_dirty(ARRAY(
+                SELECT t FROM updated n JOIN previous o ON o.id = n.id,
+                     LATERAL (VALUES (o.title), (n.title)) titles (t)
+                WHERE (n.type = 'sell' OR o.type = 'sell')
+                  AND (n.title, n.type, n.price, n.available_date)
+                      IS DISTINCT FROM (o.title, o.type, o.price, o.available_date)));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION listings_deleted_prices() RETURNS trigger AS $$
+        BEGIN
+            PERFORM mark_crop_prices_dirty(ARRAY(
+                SELECT title FROM removed WHERE type = 'sell' AND price > 0));
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+    ]),
+    # Produce categories match a donation by the (stemmed) words of its
+    # title, not by substring of its search text: "pineapple" is no apple,
+    # and the farmer's name plays no part. Every match is rescored.
+    Migration(20, 'donation matches by title words', [
+        """
+        CREATE OR REPLACE VIEW donation_match_candidates AS
+        SELECT ngo_id, listing_id,
+               round((LEAST(focus_score * 10, 1) * 0.6 + LEAST(past_claims, 10) / 10.0 * 0.4)::numeric, 2) AS score,
+               focus_score, past_claims, available_date
+        FROM (
+            SELECT p.ngo_id, l.id AS listing_id, l.available_date,
+                   ts_rank(to_tsvector('english', l.title || ' ' || l.type || ' ' || COALESCE(c.terms, '')),
+                           focus_tsquery(p.focus_area)) AS focus_score,
+                   COALESCE(h.claims, 0)::integer AS past_claims
+            FROM listings l
+            CROSS JOIN ngo_profiles p
+            LEFT JOIN LATERAL (
+                SELECT string_agg(terms, ' ') AS terms FROM produce_categories
+                WHERE to_tsvector('english', l.title) @@ plainto_tsquery('english', crop)
+            ) c ON true
+            LEFT JOIN LATERAL (
+                SELECT SUM(claimed_count) AS claims FROM ngo_monthly_stats s
+                WHERE s.ngo_id = p.ngo_id AND s.title = l.title
+            ) h ON true
+            WHERE l.type = 'donate' AND l.status = 'available'
+        ) m
+        WHERE focus_score > 0 OR past_claims > 0;
+        """,
+        rescore_matches,
+    ]),
+    # Partition maintenance moves purchase requests between partitions with
+    # DELETE ... INSERT (see partitions.py). Those rows didn't change, so the
+    # change feed skips them: partitions.moving_rows() sets
+    # harvesthub.moving_rows for the duration of a move. The trigger fires on
+    # the partition, whose name TG_TABLE_NAME carries, so the event kind is
+    # spelled out rather than taken from it.
+    Migration(21, 'no change events for moved rows', [
+        """
+        CREATE OR REPLACE FUNCTION record_change_event() RETURNS trigger AS $$
+        DECLARE
+            rec RECORD;
+            event_kind TEXT;
+            payload JSONB;
+            event_id BIGINT;
+        BEGIN
+            IF current_setting('harvesthub.moving_rows', true) = 'on' THEN
+                RETURN NULL;
+            END IF;
+            IF TG_OP = 'DELETE' THEN
+                rec := OLD;
+            ELSE
+                rec := NEW;
+            END IF;
+            IF TG_TABLE_NAME = 'listings' THEN
+                event_kind := 'listings';
+                payload := jsonb_build_object(
+                    'id', rec.id, 'title', rec.title, 'type', rec.type, 'status', rec.status,
+                    'farmer_id', rec.farmer_id, 'claimed_by', rec.claimed_by);
+            ELSE
+                event_kind := 'purchase_requests';
+                payload := jsonb_build_object(
+                    'id', rec.id, 'listing_id', rec.listing_id, 'status', rec.status,
+                    'farmer_id', rec.farmer_id, 'buyer_id', rec.buyer_id);
+            END IF;
+            INSERT INTO change_events (kind, op, payload)
+            VALUES (event_kind, lower(TG_OP), payload)
+            RETURNING id INTO event_id;
+            PERFORM pg_notify('harvesthub_events', event_id::text);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+
+def _ensure_version_table(cur):
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            description TEXT NOT NULL,
+            applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+        );
+    """)
+
+
+# Cheap startup check: (applied version, version this code expects).
+# A database that was never migrated reports version 0.
+def schema_status(conn):
+    cur = conn.cursor()
+    cur.execute("SELECT to_regclass('schema_version') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+        current = cur.fetchone()[0]
+    else:
+        current = 0
+    cur.close()
+    conn.rollback()
+    return current, LATEST_VERSION
+
+
+def _run_step(conn, step):
+    if callable(step):
+        step(conn)
+    else:
+        cur = conn.cursor()
+        cur.execute(step)
+        cur.close()
+
+
+def _apply(conn, migration):
+    for attempt in range(1, MIGRATION_RETRIES + 1):
+        try:
+            if migration.transactional:
+                conn.autocommit = False
+                cur = conn.cursor()
+                cur.execute("SET LOCAL lock_timeout = %s;", (MIGRATION_LOCK_TIMEOUT,))
+                for step in migration.steps:
+                    _run_step(conn, step)
+                cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                            (migration.version, migration.description))
+                conn.commit()
+                cur.close()
+            else:
+                conn.autocommit = True
+                cur = conn.cursor()
+                cur.execute("SET lock_timeout = %s;", (MIGRATION_LOCK_TIMEOUT,))
+                for step in migration.steps:
+                    _run_step(conn, step)
+                cur.execute("INSERT INTO schema_version (version, description) VALUES (%s, %s);",
+                            (migration.version, migration.description))
+                cur.execute("RESET lock_timeout;")
+                cur.close()
+            return
+        except errors.LockNotAvailable:
+            if not conn.autocommit:
+                conn.rollback()
+            if attempt == MIGRATION_RETRIES:
+                raise
+            print(f"  lock timeout, retrying ({attempt}/{MIGRATION_RETRIES})")
+            time.sleep(min(2 ** attempt, 30))
+
+
+# Apply every pending migration (up to `target`). Returns the versions applied.
+def migrate(conn, target=None):
+    conn.autocommit = True
+    cur = conn.cursor()
+    cur.execute("SELECT pg_advisory_lock(%s);", (MIGRATION_LOCK_ID,))
+    applied = []
+    try:
+        _ensure_version_table(cur)
+        cur.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version;")
+        current = cur.fetchone()[0]
+        for migration in MIGRATIONS:
+            if migration.version <= current or (target is not None and migration.version > target):
+                continue
+            print(f"Applying migration {migration.version}: {migration.description}")
+            _apply(conn, migration)
+            applied.append(migration.version)
+    finally:
+        conn.rollback()
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute("SELECT pg_advisory_unlock(%s);", (MIGRATION_LOCK_ID,))
+        cur.close()
+        conn.autocommit = False
+    return applied
@@ -0,0 +1,266 @@
+import json
+import os
+import re
+from contextlib import contextmanager
+from datetime import date
+
+from psycopg2 import errors
+
+import blobstore
+import events
+
+# purchase_requests is range partitioned by created_at month (migration 15):
+# purchase_requests_y2026m10 holds October 2026, and purchase_requests_default
+# catches anything outside the monthly partitions, so inserts never fail when
+# maintenance is late. The per-user lists read purchase_requests through the
+# (farmer_id, created_at) and (buyer_id, created_at) indexes of each partition.
+#
+# `python manage.py partitions` (run it daily, e.g. from cron):
+# - creates the partitions for the next PARTITION_PREMAKE_MONTHS months;
+# - archives every month older than ARCHIVE_AFTER_MONTHS: the partition is
+#   detached and attached to purchase_requests_archive, without copying its
+#   resolved requests. Its pending requests stay hot in the default partition.
+#   Payment proofs that no hot request uses any more move to cold storage
+#   (blobstore.BLOB_COLD_DIR).
+#
+# Archived requests keep counting towards buyer_crop_spend (see pricing.py).
+# The request lists show them with ?archived=1. Moving a request between
+# partitions is not a change to it: moves send no change events (migration 21).
+
+PARTITION_PREMAKE_MONTHS = int(os.environ.get('PARTITION_PREMAKE_MONTHS', 3))
+ARCHIVE_AFTER_MONTHS = int(os.environ.get('ARCHIVE_AFTER_MONTHS', 12))
+PARTITION_LOCK_TIMEOUT = os.environ.get('PARTITION_LOCK_TIMEOUT', '5s')
+
+HOT_TABLE = 'purchase_requests'
+ARCHIVE_TABLE = 'purchase_requests_archive'
+DEFAULT_PARTITION = 'purchase_requests_default'
+MONTH_RE = re.compile(r'_y(\d{4})m(\d{2})$')
+
+
+def month_start(day):
+    return date(day.year, day.month, 1)
+
+
+def add_months(month, months):
+    index = month.year * 12 + month.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def partition_name(month, table=HOT_TABLE):
+    return f"{table}_y{month.year}m{month.month:02d}"
+
+
+# The change feed trigger skips rows while this is on, until the end of the
+# move or of the transaction, whichever comes first
+@contextmanager
+def moving_rows(cur):
+    cur.execute("SELECT set_config('harvesthub.moving_rows', 'on', true);")
+    yield
+    cur.execute("SELECT set_config('harvesthub.moving_rows', 'off', true);")
+
+
+# Monthly partitions of a table: [(month, name)] in month order
+def monthly_partitions(cur, table):
+    cur.execute("""
+        SELECT c.relname FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = %s::regclass;
+    """, (table,))
+    found = []
+    for (name,) in cur.fetchall():
+        match = MONTH_RE.search(name)
+        if match:
+            found.append((date(int(match.group(1)), int(match.group(2)), 1), name))
+    return sorted(found)
+
+
+# Create and attach one month's partition inside the caller's transaction.
+# Rows of that month that landed in the default partition move into it.
+# ATTACH only takes a SHARE UPDATE EXCLUSIVE lock on purchase_requests, so
+# reads and writes keep flowing (CREATE TABLE ... PARTITION OF would block them).
+def create_partition(cur, month):
+    name = partition_name(month)
+    lower, upper = month.isoformat(), add_months(month, 1).isoformat()
+    cur.execute(f"CREATE TABLE {name} (LIKE {HOT_TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS);")
+    with moving_rows(cur):
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE created_at >= %s AND created_at < %s
+                RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved;
+        """, (lower, upper))
+    cur.execute(f"ALTER TABLE {HOT_TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{lower}') TO ('{upper}');")
+    return name
+
+
+# Create the missing monthly partitions from `oldest` (default: this month)
+# through PARTITION_PREMAKE_MONTHS ahead, one transaction each. Returns the
+# names created.
+def ensure_partitions(conn, oldest=None, commit=True):
+    cur = conn.cursor()
+    existing = {month for month, _ in monthly_partitions(cur, HOT_TABLE)}
+    this_month = month_start(date.today())
+    month = month_start(oldest or this_month)
+    created = []
+    while month <= add_months(this_month, PARTITION_PREMAKE_MONTHS):
+        if month not in existing:
+            if commit:
+                cur.execute("SET LOCAL lock_timeout = %s;", (PARTITION_LOCK_TIMEOUT,))
+            created.append(create_partition(cur, month))
+            if commit:
+                conn.commit()
+        month = add_months(month, 1)
+    cur.close()
+    return created
+
+
+# Pending requests of a detached month back into the default partition: no
+# partition covers the month any more, so they fit there
+def return_pending(cur, name):
+    with moving_rows(cur):
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM {name} WHERE status = 'pending' RETURNING *
+            )
+            INSERT INTO {DEFAULT_PARTITION} SELECT * FROM moved;
+        """)
+
+
+# Requests in the default partition created before `cutoff` and resolved
+# since, into the archive. Returns (count, their payment proof digests).
+def sweep_resolved(cur, cutoff):
+    with moving_rows(cur):
+        cur.execute(f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION}
+                WHERE created_at < %s AND status <> 'pending'
+                RETURNING *
+            ),
+            archived AS (
+                INSERT INTO {ARCHIVE_TABLE} SELECT * FROM moved RETURNING proof_hash
+            )
+            SELECT COUNT(*), ARRAY_AGG(DISTINCT proof_hash) FILTER (WHERE proof_hash <> '') FROM archived;
+        """, (cutoff.isoformat(),))
+        swept, digests = cur.fetchone()
+    return swept, set(digests or ())
+
+
+# Move one hot month out of purchase_requests. Returns False if a lock
+# wasn't available in time (the next run retries). The detach holds an ACCESS
+# EXCLUSIVE lock on purchase_requests, so this transaction does nothing slow.
+def _detach_partition(conn, month, name):
+    # Archived proofs are served from the blob store only
+    blobstore.migrate_legacy_proofs(conn, table=name)
+    cur = conn.cursor()
+    try:
+        cur.execute("SET LOCAL lock_timeout = %s;", (PARTITION_LOCK_TIMEOUT,))
+        cur.execute(f"ALTER TABLE {HOT_TABLE} DETACH PARTITION {name};")
+        # Older servers keep the cloned change feed trigger on a detached partition
+        cur.execute(f"DROP TRIGGER IF EXISTS purchase_requests_change_event ON {name};")
+        return_pending(cur, name)
+        cur.execute(f"ALTER TABLE {name} RENAME TO {partition_name(month, ARCHIVE_TABLE)};")
+        conn.commit()
+        return True
+    except errors.LockNotAvailable:
+        conn.rollback()
+        return False
+    finally:
+        cur.close()
+
+
+# Attach detached months to purchase_requests_archive. Validating the range
+# scans the month, but only locks the archive against schema changes.
+def _attach_archived(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT relname FROM pg_class
+        WHERE relname ~ %s AND relkind = 'r' AND NOT relispartition
+        ORDER BY relname;
+    """, (f'^{ARCHIVE_TABLE}_y[0-9]{{4}}m[0-9]{{2}}$',))
+    attached = []
+    for (name,) in cur.fetchall():
+        match = MONTH_RE.search(name)
+        month = date(int(match.group(1)), int(match.group(2)), 1)
+        cur.execute(f"""
+            ALTER TABLE {ARCHIVE_TABLE} ATTACH PARTITION {name}
+            FOR VALUES FROM ('{month.isoformat()}') TO ('{add_months(month, 1).isoformat()}');
+        """)
+        conn.commit()
+        attached.append(name)
+    cur.close()
+    return attached
+
+
+# Payment proofs of archived requests that no hot request uses, to cold storage
+def _cool_proofs(cur, digests):
+    if not digests:
+        return 0
+    cur.execute(f"""
+        SELECT unnest(%s::varchar[])
+        EXCEPT
+        SELECT proof_hash FROM {HOT_TABLE} WHERE proof_hash = ANY(%s);
+    """, (digests, digests))
+    cold = [digest for (digest,) in cur.fetchall()]
+    # Their recompressed full-size images go too; thumbnails stay hot for the archived lists
+    cur.execute("""
+        SELECT full_hash FROM proof_variants
+        WHERE proof_hash = ANY(%s) AND full_hash IS NOT NULL AND full_hash <> proof_hash;
+    """, (cold,))
+    cold += [digest for (digest,) in cur.fetchall()]
+    return sum(blobstore.move_to_cold(digest) for digest in cold)
+
+
+# Tell every process to drop its cached request lists (see app.invalidate_for_event)
+def _announce(cur, archived):
+    cur.execute("""
+        INSERT INTO change_events (kind, op, payload)
+        VALUES ('purchase_requests', 'archive', %s) RETURNING id;
+    """, (json.dumps({'partitions': archived}),))
+    cur.execute("SELECT pg_notify(%s, %s);", (events.EVENTS_CHANNEL, str(cur.fetchone()[0])))
+
+
+# Archive resolved requests created before the start of the month
+# `months` months ago. Returns a summary of what was done.
+def archive(conn, months=ARCHIVE_AFTER_MONTHS):
+    cutoff = add_months(month_start(date.today()), -months)
+    cur = conn.cursor()
+    skipped = []
+    for month, name in monthly_partitions(cur, HOT_TABLE):
+        if add_months(month, 1) > cutoff:
+            break
+        if not _detach_partition(conn, month, name):
+            skipped.append(name)
+    # Includes months a failed earlier run detached but didn't attach
+    archived = _attach_archived(conn)
+
+    # Pending requests parked in the default partition, resolved since
+    swept, digests = sweep_resolved(cur, cutoff)
+    for name in archived:
+        cur.execute(f"SELECT DISTINCT proof_hash FROM {name} WHERE proof_hash <> '';")
+        digests.update(digest for (digest,) in cur.fetchall())
+    if archived or swept:
+        _announce(cur, archived)
+    conn.commit()
+
+    cold = _cool_proofs(cur, sorted(digests))
+    conn.commit()
+    cur.close()
+    return {'archived': archived, 'skipped': skipped, 'swept': swept, 'cold_proofs': cold}
+
+
+# Row estimates per partition, hot and archived
+def report(conn):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT p.relname, c.relname, c.reltuples::bigint FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        JOIN pg_class p ON p.oid = i.inhparent
+        WHERE p.relname IN (%s, %s)
+        ORDER BY p.relname DESC, c.relname;
+    """, (HOT_TABLE, ARCHIVE_TABLE))
+    rows = cur.fetchall()
+    conn.rollback()
+    cur.close()
+    return rows
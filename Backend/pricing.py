@@ -0,0 +1,125 @@
+import os
+import threading
+import time
+
+import db
+
+# Crop price statistics and buyer spend, precomputed so buyer analytics is a
+# few primary-key reads however many listings there are.
+#
+# crop_price_stats holds one row per crop (listing title) over its priced sell
+# listings: count, min, p10, median, p90 and a 12-month trend of the monthly
+# median and min by available_date. Listing triggers (migration 19) queue a
+# crop in crop_price_dirty whenever a listing of it is added, repriced,
+# renamed or deleted; PriceRefresher recomputes the queued crops in the
+# background every PRICE_REFRESH_INTERVAL seconds, so the percentiles are
+# computed once per crop per interval rather than once per listing write.
+# Queue entries are claimed with SKIP LOCKED: every process may run one.
+#
+# buyer_crop_spend holds per buyer and crop what approved purchases cost and
+# what the same quantity was worth at the crop's median price when the
+# request was approved; savings are the difference. It is maintained by a
+# trigger on purchase_requests as requests become approved, and archiving
+# requests (see partitions.py) leaves it alone.
+
+PRICE_STATS_MAX_CROPS = 50     # market crops shown besides the ones the buyer bought
+PRICE_REFRESH_INTERVAL = float(os.environ.get('PRICE_REFRESH_INTERVAL', 30))   # seconds
+PRICE_REFRESH_BATCH = int(os.environ.get('PRICE_REFRESH_BATCH', 500))          # queue entries per transaction
+
+CLAIM_DIRTY_SQL = """
+    WITH claimed AS (
+        DELETE FROM crop_price_dirty WHERE id IN (
+            SELECT id FROM crop_price_dirty ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED)
+        RETURNING title
+    )
+    SELECT DISTINCT title FROM claimed;
+"""
+
+
+# Recompute every crop's price statistics and every buyer's spend. Historical
+# purchases are valued at the current median prices.
+def rebuild(conn, commit=True):
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE crop_price_stats, buyer_crop_spend IN EXCLUSIVE MODE;")
+    cur.execute("DELETE FROM crop_price_stats;")
+    cur.execute("""
+        SELECT refresh_crop_prices(ARRAY(
+            SELECT DISTINCT title FROM listings WHERE type = 'sell' AND price > 0), false);
+    """)
+    cur.execute("DELETE FROM buyer_crop_spend;")
+    cur.execute("SELECT add_buyer_spend(ARRAY(SELECT id FROM purchase_requests WHERE status = 'approved'));")
+    # Archived requests count too (purchase_requests_archive exists from migration 15 on)
+    cur.execute("SELECT to_regclass('purchase_requests_archive') IS NOT NULL;")
+    if cur.fetchone()[0]:
+        cur.execute("SELECT add_buyer_spend(ARRAY(SELECT id FROM purchase_requests_archive WHERE status = 'approved'));")
+    if commit:
+        conn.commit()
+    cur.close()
+
+
+# Recompute the crops queued by listing writes, a batch per transaction,
+# until the queue is empty. Returns the number of crops recomputed.
+def refresh_dirty(conn, batch_size=PRICE_REFRESH_BATCH):
+    refreshed = 0
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute(CLAIM_DIRTY_SQL, (batch_size,))
+            titles = [row[0] for row in cur.fetchall()]
+            if not titles:
+                conn.rollback()
+                return refreshed
+            cur.execute("SELECT refresh_crop_prices(%s::varchar[]);", (titles,))
+            conn.commit()
+            refreshed += len(titles)
+    finally:
+        cur.close()
+
+
+class PriceRefresher:
+    """Background thread draining crop_price_dirty every `interval` seconds."""
+
+    def __init__(self, interval):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopping = threading.Event()
+        self._refreshed = 0
+        self._errors = 0
+        self._last_run = None
+
+    def start(self):
+        with self._lock:
+            if self.interval <= 0 or (self._thread is not None and self._thread.is_alive()):
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='price-refresher', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            try:
+                with db.pool.connection() as conn:
+                    refreshed = refresh_dirty(conn)
+                with self._lock:
+                    self._refreshed += refreshed
+                    self._last_run = time.time()
+            except Exception as e:
+                with self._lock:
+                    self._errors += 1
+                print(f"Error refreshing crop prices: {e}")
+
+    def stats(self):
+        with self._lock:
+            return {
+                'interval_s': self.interval,
+                'refreshed': self._refreshed,
+                'errors': self._errors,
+                'last_run_age_s': round(time.time() - self._last_run, 1) if self._last_run else None,
+            }
+
+
+refresher = PriceRefresher(PRICE_REFRESH_INTERVAL)
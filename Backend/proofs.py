@@ -0,0 +1,318 @@
+import io
+import os
+import queue
+import threading
+
+import blobstore
+import db
+from blobstore import InvalidBlob
+
+# Pillow is optional: without it proofs are stored and served as uploaded,
+# and the thumbnail / full URLs redirect to the original
+try:
+    from PIL import Image, ImageOps, UnidentifiedImageError
+except ImportError:
+    Image = None
+
+# Each stored proof is decoded once, in the background, into a small
+# thumbnail for the request lists and a recompressed full-size image for
+# viewing, both stored in the blob store. proof_variants (migration 16) is the
+# durable queue: a row per proof, 'pending' until processed, then 'ready' or
+# 'failed'. A pending row is leased by pushing next_attempt_at forward, so a
+# worker that dies mid-way only delays it, and any process may pick it up.
+PROOF_WORKERS = int(os.environ.get('PROOF_WORKERS', 1))            # threads per process
+PROOF_QUEUE_SIZE = int(os.environ.get('PROOF_QUEUE_SIZE', 100))    # beyond this, new proofs wait for a sweep
+PROOF_SWEEP_INTERVAL = float(os.environ.get('PROOF_SWEEP_INTERVAL', 30))
+PROOF_LEASE = int(os.environ.get('PROOF_LEASE', 120))              # seconds a claimed proof is reserved
+PROOF_RETRIES = int(os.environ.get('PROOF_RETRIES', 5))
+PROOF_RETRY_BASE = int(os.environ.get('PROOF_RETRY_BASE', 30))     # seconds, doubled per attempt
+
+PROOF_MAX_SIDE = int(os.environ.get('PROOF_MAX_SIDE', 10000))            # uploads beyond this are rejected
+PROOF_MAX_PIXELS = int(os.environ.get('PROOF_MAX_PIXELS', 40_000_000))
+PROOF_FULL_SIDE = int(os.environ.get('PROOF_FULL_SIDE', 2048))           # the full variant is scaled down to this
+PROOF_THUMB_SIDE = int(os.environ.get('PROOF_THUMB_SIDE', 320))
+PROOF_FULL_QUALITY = int(os.environ.get('PROOF_FULL_QUALITY', 82))
+PROOF_THUMB_QUALITY = int(os.environ.get('PROOF_THUMB_QUALITY', 70))
+
+VARIANTS = ('thumb', 'full')
+
+
+class ProofRejected(Exception):
+    pass
+
+
+def _check_dimensions(width, height):
+    if max(width, height) > PROOF_MAX_SIDE or width * height > PROOF_MAX_PIXELS:
+        raise ProofRejected(f'Payment proof is too large ({width}x{height} pixels)')
+
+
+# Upload-time limits. Only the image header is read, not the pixels; what
+# isn't an image at all is left to blobstore.store_blob() to reject.
+def validate(data):
+    if Image is None or blobstore.sniff_image_type(data[:16]) is None:
+        return
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            width, height = image.size
+    except Image.DecompressionBombError:
+        raise InvalidBlob('Payment proof is too large')
+    except OSError:
+        raise InvalidBlob('Payment proof is not a readable image')
+    try:
+        _check_dimensions(width, height)
+    except ProofRejected as e:
+        raise InvalidBlob(str(e))
+
+
+def _encode(image, quality):
+    out = io.BytesIO()
+    image.save(out, 'JPEG', quality=quality, optimize=True, progressive=True)
+    return out.getvalue()
+
+
+# Decode once; returns (thumbnail, full, width, height) with full=None when
+# recompressing wouldn't make the original smaller
+def render(data):
+    with Image.open(io.BytesIO(data)) as image:
+        width, height = image.size
+        _check_dimensions(width, height)
+        # JPEGs decode straight at a reduced scale when they're much larger than needed
+        image.draft('RGB', (PROOF_FULL_SIDE, PROOF_FULL_SIDE))
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'L'):
+            # Flatten transparency onto white (screenshots of payment apps are often RGBA)
+            rgba = image.convert('RGBA')
+            image = Image.new('RGB', rgba.size, 'white')
+            image.paste(rgba, mask=rgba.getchannel('A'))
+
+        full = image.copy()
+        full.thumbnail((PROOF_FULL_SIDE, PROOF_FULL_SIDE), Image.LANCZOS)
+        full_bytes = _encode(full, PROOF_FULL_QUALITY)
+        image.thumbnail((PROOF_THUMB_SIDE, PROOF_THUMB_SIDE), Image.LANCZOS)
+        thumb_bytes = _encode(image, PROOF_THUMB_QUALITY)
+    if len(full_bytes) >= len(data) and max(width, height) <= PROOF_FULL_SIDE:
+        full_bytes = None
+    return thumb_bytes, full_bytes, width, height
+
+
+# Queue a stored proof for processing, inside the caller's transaction
+def enqueue(cur, proof_hash):
+    cur.execute("INSERT INTO proof_variants (proof_hash) VALUES (%s) ON CONFLICT DO NOTHING;", (proof_hash,))
+
+
+# Queue every proof of hot and archived requests that has no variants yet;
+# with retry_failed, failed ones start over. Returns the number queued.
+def backfill(conn, retry_failed=False):
+    cur = conn.cursor()
+    queued = 0
+    if retry_failed:
+        cur.execute("""
+            UPDATE proof_variants SET status = 'pending', attempts = 0, error = NULL, next_attempt_at = now()
+            WHERE status = 'failed';
+        """)
+        queued = cur.rowcount
+    cur.execute("""
+        INSERT INTO proof_variants (proof_hash)
+        SELECT proof_hash FROM purchase_requests WHERE proof_hash <> ''
+        UNION
+        SELECT proof_hash FROM purchase_requests_archive WHERE proof_hash <> ''
+        ON CONFLICT DO NOTHING;
+    """)
+    queued += cur.rowcount
+    conn.commit()
+    cur.close()
+    return queued
+
+
+# Pending proofs that are due, oldest first
+def due(conn, limit):
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT proof_hash FROM proof_variants
+        WHERE status = 'pending' AND next_attempt_at <= now()
+        ORDER BY next_attempt_at LIMIT %s;
+    """, (limit,))
+    digests = [row[0] for row in cur.fetchall()]
+    conn.commit()
+    cur.close()
+    return digests
+
+
+def _claim(cur, proof_hash):
+    cur.execute("""
+        UPDATE proof_variants
+        SET attempts = attempts + 1, next_attempt_at = now() + make_interval(secs => %s), updated_at = now()
+        WHERE proof_hash = %s AND status = 'pending' AND next_attempt_at <= now()
+        RETURNING attempts;
+    """, (PROOF_LEASE, proof_hash))
+    row = cur.fetchone()
+    return row[0] if row else None
+
+
+def _fail(cur, proof_hash, error):
+    cur.execute("""
+        UPDATE proof_variants SET status = 'failed', error = %s, updated_at = now()
+        WHERE proof_hash = %s;
+    """, (error, proof_hash))
+
+
+# Claim and process one proof. Returns 'ready', 'failed', 'retry' or None
+# when another worker has it (or it isn't due).
+def process(conn, proof_hash):
+    cur = conn.cursor()
+    attempts = _claim(cur, proof_hash)
+    conn.commit()
+    if attempts is None:
+        cur.close()
+        return None
+    try:
+        blob = blobstore.open_blob(proof_hash)
+        if blob is None:
+            _fail(cur, proof_hash, 'Proof not found in the blob store')
+            conn.commit()
+            return 'failed'
+        with open(blob[0], 'rb') as f:
+            data = f.read()
+        try:
+            thumb, full, width, height = render(data)
+        except (ProofRejected, UnidentifiedImageError, Image.DecompressionBombError, OSError, ValueError) as e:
+            # The image itself is the problem: retrying won't help
+            _fail(cur, proof_hash, str(e) or type(e).__name__)
+            conn.commit()
+            return 'failed'
+        thumb_hash = blobstore.store_blob(thumb)[0]
+        full_hash = blobstore.store_blob(full)[0] if full is not None else proof_hash
+        cur.execute("""
+            UPDATE proof_variants
+            SET status = 'ready', thumb_hash = %s, full_hash = %s, width = %s, height = %s,
+                error = NULL, updated_at = now()
+            WHERE proof_hash = %s;
+        """, (thumb_hash, full_hash, width, height, proof_hash))
+        conn.commit()
+        return 'ready'
+    except Exception as e:
+        conn.rollback()
+        print(f"Error processing proof {proof_hash} (attempt {attempts}): {e}")
+        if attempts >= PROOF_RETRIES:
+            _fail(cur, proof_hash, str(e))
+            conn.commit()
+            return 'failed'
+        cur.execute("""
+            UPDATE proof_variants SET next_attempt_at = now() + make_interval(secs => %s), error = %s
+            WHERE proof_hash = %s;
+        """, (PROOF_RETRY_BASE * 2 ** (attempts - 1), str(e), proof_hash))
+        conn.commit()
+        return 'retry'
+    finally:
+        cur.close()
+
+
+# Blob digest to serve for a proof variant: (digest, ready). Until the
+# variants exist (or without Pillow) that's the original.
+def variant_hash(cur, proof_hash, variant):
+    cur.execute(f"SELECT {variant}_hash FROM proof_variants WHERE proof_hash = %s AND status = 'ready';",
+                (proof_hash,))
+    row = cur.fetchone()
+    return (row[0], True) if row else (proof_hash, False)
+
+
+class ProofWorker:
+    """Background threads processing proofs of this process's uploads, plus
+    a sweeper feeding them due proofs from proof_variants (backfills,
+    retries, uploads that found the queue full, other processes' leftovers).
+
+    The queue is bounded: submit() never blocks a request, and the sweeper
+    only takes as many proofs as there is room for.
+    """
+
+    def __init__(self, threads, queue_size):
+        self.threads = threads
+        self.queue = queue.Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._stopping = threading.Event()
+        self._counts = {'ready': 0, 'failed': 0, 'retry': 0, 'deferred': 0}
+
+    @property
+    def enabled(self):
+        return Image is not None and self.threads > 0
+
+    def start(self):
+        with self._lock:
+            if not self.enabled or any(t.is_alive() for t in self._threads):
+                return
+            self._stopping.clear()
+            self._threads = [threading.Thread(target=self._sweep, name='proof-sweeper', daemon=True)]
+            self._threads += [threading.Thread(target=self._run, name=f'proof-worker-{i}', daemon=True)
+                              for i in range(self.threads)]
+            for thread in self._threads:
+                thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    # Returns False when the proof has to wait for a sweep instead
+    def submit(self, proof_hash):
+        if not self.enabled:
+            return False
+        try:
+            self.queue.put_nowait(proof_hash)
+            return True
+        except queue.Full:
+            with self._lock:
+                self._counts['deferred'] += 1
+            return False
+
+    def _run(self):
+        while not self._stopping.is_set():
+            try:
+                proof_hash = self.queue.get(timeout=1)
+            except queue.Empty:
+                continue
+            try:
+                with db.pool.connection() as conn:
+                    outcome = process(conn, proof_hash)
+                if outcome:
+                    with self._lock:
+                        self._counts[outcome] += 1
+            except Exception as e:
+                print(f"Proof worker error: {e}")
+
+    def _sweep(self):
+        while not self._stopping.wait(PROOF_SWEEP_INTERVAL):
+            room = self.queue.maxsize - self.queue.qsize()
+            if room <= 0:
+                continue
+            try:
+                with db.pool.connection() as conn:
+                    digests = due(conn, room)
+            except Exception as e:
+                print(f"Proof sweep error: {e}")
+                continue
+            for proof_hash in digests:
+                try:
+                    self.queue.put_nowait(proof_hash)
+                except queue.Full:
+                    break
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts, enabled=self.enabled, workers=self.threads,
+                        queue_depth=self.queue.qsize(), queue_size=self.queue.maxsize)
+
+
+worker = ProofWorker(PROOF_WORKERS, PROOF_QUEUE_SIZE)
+
+
+# Process due proofs in this process until none are left (manage.py).
+# Proofs waiting out a retry backoff, or leased by a server, are left alone.
+def drain(conn, batch_size=100):
+    counts = {'ready': 0, 'failed': 0, 'retry': 0}
+    while True:
+        digests = due(conn, batch_size)
+        if not digests:
+            return counts
+        for proof_hash in digests:
+            outcome = process(conn, proof_hash)
+            if outcome:
+                counts[outcome] += 1
@@ -0,0 +1,241 @@
+import os
+
+import matching
+import rollups
+
+DECISION_BATCH_MAX = int(os.environ.get('DECISION_BATCH_MAX', 500))
+HOLD_TTL = int(os.environ.get('HOLD_TTL', 120))            # seconds a buyer's reservation lasts
+BUSY_RETRY_AFTER = 1                                       # Retry-After for a listing locked right now
+
+_SOLD_STATE = ', '.join('l.' + column.strip() for column in rollups.STATE_COLUMNS.split(','))
+_APPROVED_STATE = ', '.join('s.' + column.strip() for column in rollups.STATE_COLUMNS.split(','))
+_NO_STATE = ', '.join('NULL' for _ in rollups.STATE_COLUMNS.split(','))
+
+# Approve, reject and auto-reject in one set-based statement. Per listing the
+# lowest approved request id wins; the listing is only sold if it is still
+# available (re-checked under its row lock), and every other pending request
+# for a sold listing is rejected. Returns (outcome, id, listing_id, farmer_id,
+# buyer_id, *sold listing state) rows; the state is only set for approvals.
+# A rejected buyer's hold on the listing is released.
+DECIDE_SQL = f"""
+    WITH chosen AS (
+        SELECT DISTINCT ON (listing_id) id, listing_id
+        FROM purchase_requests
+        WHERE id = ANY(%(approve)s) AND status = 'pending'
+        ORDER BY listing_id, id
+    ),
+    sold AS (
+        UPDATE listings l SET status = 'sold'
+        FROM chosen c
+        WHERE l.id = c.listing_id AND l.status = 'available'
+        RETURNING c.id AS request_id, l.id AS listing_id, {_SOLD_STATE}
+    ),
+    approved AS (
+        UPDATE purchase_requests pr SET status = 'approved'
+        FROM sold s
+        WHERE pr.id = s.request_id
+        RETURNING pr.id, pr.listing_id, pr.farmer_id, pr.buyer_id
+    ),
+    auto_rejected AS (
+        UPDATE purchase_requests pr SET status = 'rejected'
+        FROM sold s
+        WHERE pr.listing_id = s.listing_id AND pr.id <> s.request_id AND pr.status = 'pending'
+          AND NOT pr.id = ANY(%(reject)s)
+        RETURNING pr.id, pr.listing_id, pr.farmer_id, pr.buyer_id
+    ),
+    rejected AS (
+        UPDATE purchase_requests SET status = 'rejected'
+        WHERE id = ANY(%(reject)s) AND status = 'pending'
+        RETURNING id, listing_id, farmer_id, buyer_id
+    ),
+    released AS (
+        DELETE FROM listing_holds h
+        USING rejected r
+        WHERE h.listing_id = r.listing_id AND h.buyer_id = r.buyer_id
+    )
+    SELECT 'approved', a.id, a.listing_id, a.farmer_id, a.buyer_id, {_APPROVED_STATE}
+    FROM approved a JOIN sold s ON s.request_id = a.id
+    UNION ALL
+    SELECT 'auto_rejected', id, listing_id, farmer_id, buyer_id, {_NO_STATE} FROM auto_rejected
+    UNION ALL
+    SELECT 'rejected', id, listing_id, farmer_id, buyer_id, {_NO_STATE} FROM rejected;
+"""
+
+
+# Decide a batch of purchase requests inside the caller's transaction.
+# Only pending requests are decided; with farmer_id, requests of other farmers
+# are reported as not found. Returns (results, changed) where results is one
+# {'id', 'outcome'[, 'status']} per requested id, in request order, and changed
+# lists (listing_id, farmer_id, buyer_id, sold) for every row that was updated,
+# auto-rejected competitors included, so the caller can invalidate caches.
+def decide(cur, approve, reject, farmer_id=None):
+    requested = list(dict.fromkeys(approve + reject))
+    # Lock the requests up front, in id order, so concurrent batches can't interleave
+    cur.execute("""
+        SELECT id, status, farmer_id FROM purchase_requests
+        WHERE id = ANY(%s) ORDER BY id FOR UPDATE;
+    """, (requested,))
+    current = {row[0]: row for row in cur.fetchall()}
+    if farmer_id is not None:
+        current = {k: row for k, row in current.items() if row[2] == farmer_id}
+    pending = {k for k, row in current.items() if row[1] == 'pending'}
+
+    # Lock the listings being sold before deciding: a purchase holding one
+    # commits first, so DECIDE_SQL's snapshot sees (and auto-rejects) its
+    # request, and later purchases find the listing sold
+    approvable = [i for i in approve if i in pending]
+    if approvable:
+        cur.execute("""
+            SELECT l.id FROM listings l
+            WHERE l.id IN (SELECT listing_id FROM purchase_requests WHERE id = ANY(%s))
+            ORDER BY l.id FOR NO KEY UPDATE;
+        """, (approvable,))
+        cur.fetchall()
+
+    cur.execute(DECIDE_SQL, {
+        'approve': approvable,
+        'reject': [i for i in reject if i in pending],
+    })
+    outcomes = {}
+    changed = []
+    state_changes = []
+    for row in cur.fetchall():
+        outcome, request_id, listing_id, owner, buyer_id = row[:5]
+        outcomes[request_id] = outcome
+        changed.append((listing_id, owner, buyer_id, outcome == 'approved'))
+        if outcome == 'approved':
+            new = tuple(row[5:])
+            state_changes.append((new[:3] + ('available',) + new[4:], new))
+    rollups.apply_listing_changes(cur, state_changes)
+
+    results = []
+    for request_id in requested:
+        if request_id in outcomes:
+            results.append({'id': request_id, 'outcome': outcomes[request_id]})
+        elif request_id not in current:
+            results.append({'id': request_id, 'outcome': 'not_found'})
+        elif request_id not in pending:
+            results.append({'id': request_id, 'outcome': 'not_pending', 'status': current[request_id][1]})
+        else:
+            # An approval whose listing was already sold or withdrawn: left pending
+            results.append({'id': request_id, 'outcome': 'listing_unavailable'})
+    requested_ids = set(requested)
+    auto_rejected = [{'id': request_id, 'outcome': 'auto_rejected'}
+                     for request_id, outcome in outcomes.items()
+                     if outcome == 'auto_rejected' and request_id not in requested_ids]
+    return results + auto_rejected, changed
+
+
+# Lock an available listing without queueing behind other buyers or NGOs.
+# Returns (row of `columns`, busy): no row and busy=True means the listing is
+# available but another transaction holds its lock right now.
+def _lock_available(cur, listing_id, columns, extra_condition=''):
+    cur.execute(f"""
+        SELECT {columns} FROM listings
+        WHERE id = %s AND status = 'available' {extra_condition}
+        FOR NO KEY UPDATE SKIP LOCKED;
+    """, (listing_id,))
+    row = cur.fetchone()
+    if row is not None:
+        return row, False
+    cur.execute(f"SELECT 1 FROM listings WHERE id = %s AND status = 'available' {extra_condition};", (listing_id,))
+    return None, cur.fetchone() is not None
+
+
+# Reserve an available listing for a buyer for HOLD_TTL seconds, inside the
+# caller's transaction. Re-holding by the same buyer extends the hold; an
+# expired hold is taken over. Returns (outcome, retry_after): 'held',
+# 'reserved' (another buyer's hold is live), 'busy' or 'not_found'.
+def hold(cur, listing_id, buyer_id):
+    listing, busy = _lock_available(cur, listing_id, "id")
+    if listing is None:
+        return ('busy', BUSY_RETRY_AFTER) if busy else ('not_found', None)
+    return _take_hold(cur, listing_id, buyer_id)
+
+
+# Needs the listing's row lock, which serializes holds on that listing
+def _take_hold(cur, listing_id, buyer_id):
+    cur.execute("""
+        INSERT INTO listing_holds (listing_id, buyer_id, expires_at)
+        VALUES (%s, %s, now() + make_interval(secs => %s))
+        ON CONFLICT (listing_id) DO UPDATE
+            SET buyer_id = EXCLUDED.buyer_id, expires_at = EXCLUDED.expires_at
+            WHERE listing_holds.buyer_id = EXCLUDED.buyer_id OR listing_holds.expires_at <= now()
+        RETURNING 1;
+    """, (listing_id, buyer_id, HOLD_TTL))
+    if cur.fetchone():
+        return 'held', HOLD_TTL
+    cur.execute("""
+        SELECT CEIL(EXTRACT(EPOCH FROM expires_at - now())) FROM listing_holds WHERE listing_id = %s;
+    """, (listing_id,))
+    return 'reserved', max(int(cur.fetchone()[0]), 1)
+
+
+# Create a pending purchase request under the buyer's hold on the listing.
+# A buyer who already has a pending request for the listing gets that one
+# back instead of a duplicate. Returns (outcome, value):
+# ('created' | 'existing', (request_id, farmer_id)),
+# ('reserved' | 'busy', retry_after seconds) or ('not_found', None).
+def create_request(cur, listing_id, buyer_id, proof_hash, proof_size):
+    listing, busy = _lock_available(cur, listing_id, "farmer_id, title, quantity, price")
+    if listing is None:
+        return ('busy', BUSY_RETRY_AFTER) if busy else ('not_found', None)
+    farmer_id, crop_title, quantity, price = listing
+
+    cur.execute("""
+        SELECT id FROM purchase_requests
+        WHERE listing_id = %s AND buyer_id = %s AND status = 'pending'
+        ORDER BY id LIMIT 1;
+    """, (listing_id, buyer_id))
+    existing = cur.fetchone()
+    if existing:
+        return 'existing', (existing[0], farmer_id)
+
+    outcome, retry_after = _take_hold(cur, listing_id, buyer_id)
+    if outcome != 'held':
+        return outcome, retry_after
+    cur.execute("""
+        INSERT INTO purchase_requests
+        (listing_id, buyer_id, farmer_id, crop_title, quantity, price, proof_hash, proof_size, status)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, 'pending') RETURNING id;
+    """, (listing_id, buyer_id, farmer_id, crop_title, quantity, price, proof_hash, proof_size))
+    return 'created', (cur.fetchone()[0], farmer_id)
+
+
+# Delete expired holds; returns the number removed. Expired holds are also
+# taken over in place, so this only keeps the table small.
+def prune_holds(conn):
+    cur = conn.cursor()
+    cur.execute("DELETE FROM listing_holds WHERE expires_at <= now();")
+    removed = cur.rowcount
+    conn.commit()
+    cur.close()
+    return removed
+
+
+# Claim an available donation for an NGO. Racing claimers don't wait on each
+# other: the loser sees 'busy' or, once the winner committed, 'not_found'.
+# Repeating a claim the NGO already made is reported as 'already_claimed'.
+# Returns (outcome, farmer_id or None).
+def claim(cur, listing_id, ngo_id):
+    listing, busy = _lock_available(cur, listing_id, "farmer_id", "AND type = 'donate'")
+    if listing is None:
+        if busy:
+            return 'busy', None
+        cur.execute("""
+            SELECT farmer_id FROM listings
+            WHERE id = %s AND type = 'donate' AND status = 'claimed' AND claimed_by = %s;
+        """, (listing_id, ngo_id))
+        row = cur.fetchone()
+        return ('already_claimed', row[0]) if row else ('not_found', None)
+
+    cur.execute(f"""
+        UPDATE listings
+        SET status = 'claimed', claimed_by = %s
+        WHERE id = %s RETURNING {rollups.STATE_COLUMNS};
+    """, (ngo_id, listing_id))
+    claimed = cur.fetchone()
+    # The locked row was available and unclaimed
+    rollups.apply_listing_change(cur, claimed[:3] + ('available', None) + claimed[5:], claimed)
+    matching.record_claim(cur, ngo_id, claimed[1])
+    return 'claimed', claimed[0]
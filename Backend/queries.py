@@ -0,0 +1,498 @@
+import base64
+import json
+import math
+import re
+from datetime import date
+from decimal import Decimal
+
+# Read-side SQL and row -> JSON shaping shared by the Flask app (psycopg2) and
+# the asyncio server (asyncpg), so both serve byte-for-byte the same contracts.
+# SQL uses psycopg2 %s placeholders (and %% for a literal %); to_asyncpg()
+# rewrites them to $1..$n.
+
+LISTING_COLUMNS = "id, title, quantity, type, farmer_id, farmer_name, available_date, price, status, claimed_by"
+LISTINGS_PAGE_DEFAULT = 50
+LISTINGS_PAGE_MAX = 200
+SEARCH_MAX_CHARS = 100
+SEARCH_MAX_TERMS = 8
+
+# sort name -> (key expression, cursor cast, descending); id is always the tie-breaker
+LISTING_SORTS = {
+    'id': (None, None, True),
+    'new': ("COALESCE(available_date, DATE '1970-01-01')", 'date', True),
+    'price_asc': ("COALESCE(price, 0)", 'numeric', False),
+    'price_desc': ("COALESCE(price, 0)", 'numeric', True),
+    'relevance': ("score", 'float8', True),    # needs q; see ListingQuery
+}
+
+# Search relevance: full-text rank (title weighs more than farmer name, which
+# weighs more than type) plus trigram word similarity, which also rescues typos
+SEARCH_SCORE = ("(ts_rank_cd(search_vector, to_tsquery('simple', %s)) "
+                "+ word_similarity(%s, search_text))::float8")
+# Prefix matches on every word, or a close-enough fuzzy match (pg_trgm's
+# word_similarity_threshold); both served by GIN indexes
+SEARCH_MATCH = "(search_vector @@ to_tsquery('simple', %s) OR %s <%% search_text)"
+
+
+class InvalidQuery(ValueError):
+    pass
+
+
+_PLACEHOLDER_RE = re.compile(r'%[s%]')
+_WORD_RE = re.compile(r'\w+')
+
+
+def to_asyncpg(sql):
+    counter = iter(range(1, 1000))
+    return _PLACEHOLDER_RE.sub(lambda m: '%' if m.group() == '%%' else f'${next(counter)}', sql)
+
+
+# (tsquery text, fuzzy text) for a search string: every word becomes a
+# prefix term, so "tom fa" matches "Tomatoes" from farmer "Farooq".
+# The tsquery is None when the string has no words.
+def search_terms(q):
+    text = ' '.join(q.lower().split())[:SEARCH_MAX_CHARS]
+    words = _WORD_RE.findall(text)[:SEARCH_MAX_TERMS]
+    tsquery = ' & '.join(f'{word}:*' for word in words) if words else None
+    return tsquery, text
+
+
+def listing_to_dict(row):
+    return {
+        'id': row[0],
+        'title': row[1],
+        'quantity': row[2],
+        'type': row[3],
+        'farmer_id': row[4],
+        'farmer_name': row[5],
+        'available_date': row[6].isoformat() if row[6] else None,
+        'price': float(row[7]) if row[7] is not None else None,
+        'status': row[8],
+        'claimed_by': row[9]
+    }
+
+
+def encode_cursor(values):
+    raw = json.dumps(values, default=str, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    return json.loads(base64.urlsafe_b64decode(padded.encode('ascii')))
+
+
+# Cursors come back from clients: each value is checked here, in the type of
+# its cast, so a tampered cursor is a 400 rather than a database error. The
+# value is returned as text, which either driver accepts for a ::text cast.
+def cursor_id(value):
+    if not isinstance(value, int) or isinstance(value, bool):
+        raise TypeError('Cursor id must be an integer')
+    if not -2 ** 31 <= value < 2 ** 31:
+        raise ValueError('Cursor id is out of range')
+    return value
+
+
+def cursor_value(value, cast):
+    if not isinstance(value, (str, int, float)) or isinstance(value, bool):
+        raise TypeError('Unsupported cursor value')
+    if cast == 'date':
+        return date.fromisoformat(value).isoformat()
+    if cast == 'numeric':
+        number = Decimal(str(value))
+        # Far beyond any price or score, and within what the database can parse
+        if not number.is_finite() or number.adjusted() > 30:
+            raise ValueError('Cursor value is out of range')
+        return str(number)
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError('Cursor value must be finite')
+    return repr(number)
+
+
+class ListingQuery:
+    """A filtered, keyset-paginated listing query built from request args.
+
+    Query params: farmer_id, type (comma separated), status, claimed_by,
+    q (search over title, farmer name and type: prefix and typo tolerant),
+    sort (id|new|price_asc|price_desc|relevance), limit, cursor. With
+    paginate=False the query has no LIMIT and returns every row from the
+    cursor on, for streaming.
+    """
+
+    shape = staticmethod(listing_to_dict)
+
+    def __init__(self, args, default_sort='id', paginate=True):
+        sort = args.get('sort', default_sort)
+        if sort not in LISTING_SORTS:
+            raise InvalidQuery('Invalid sort')
+        if sort == 'relevance' and not args.get('q', '').strip():
+            raise InvalidQuery('Sorting by relevance needs a search term')
+        try:
+            self.limit = min(max(int(args.get('limit', LISTINGS_PAGE_DEFAULT)), 1), LISTINGS_PAGE_MAX)
+        except ValueError:
+            raise InvalidQuery('Invalid limit')
+
+        where = []
+        params = []
+        if args.get('farmer_id'):
+            where.append("farmer_id = %s")
+            params.append(args['farmer_id'])
+        if args.get('type'):
+            where.append("type = ANY(%s)")
+            params.append(args['type'].split(','))
+        if args.get('status'):
+            where.append("status = ANY(%s)")
+            params.append(args['status'].split(','))
+        if args.get('claimed_by'):
+            where.append("claimed_by = %s")
+            params.append(args['claimed_by'])
+        score_sql = None
+        if args.get('q', '').strip():
+            tsquery, text = search_terms(args['q'])
+            if tsquery:
+                where.append(SEARCH_MATCH)
+                params.extend([tsquery, text])
+                score_sql, score_params = SEARCH_SCORE, [tsquery, text]
+            else:
+                where.append("%s <%% search_text")
+                params.append(text)
+                score_sql, score_params = "word_similarity(%s, search_text)::float8", [text]
+
+        self.key, self.cast, descending = LISTING_SORTS[sort]
+        op = '<' if descending else '>'
+        direction = 'DESC' if descending else 'ASC'
+        cursor_where = []
+        if args.get('cursor'):
+            try:
+                values = decode_cursor(args['cursor'])
+                if not isinstance(values, list) or len(values) != (1 if self.key is None else 2):
+                    raise ValueError('Cursor must be a list of its sort values')
+                if self.key is None:
+                    cursor_where.append(f"id {op} %s")
+                    params.append(cursor_id(values[0]))
+                else:
+                    # Passed as text so either driver accepts it
+                    cursor_where.append(f"({self.key}, id) {op} (%s::text::{self.cast}, %s)")
+                    params.extend([cursor_value(values[0], self.cast), cursor_id(values[1])])
+            except (ValueError, TypeError, ArithmeticError):
+                raise InvalidQuery('Invalid cursor')
+
+        order = f"id {direction}" if self.key is None else f"{self.key} {direction}, id {direction}"
+        if sort == 'relevance':
+            # Score the matches once in a subquery; the cursor filters on the score
+            sql = (f"SELECT {LISTING_COLUMNS}, score FROM ("
+                   f"SELECT {LISTING_COLUMNS}, {score_sql} AS score FROM listings"
+                   f" WHERE {' AND '.join(where)}) ranked")
+            if cursor_where:
+                sql += " WHERE " + " AND ".join(cursor_where)
+            params = score_params + params
+        else:
+            where += cursor_where
+            sql = f"SELECT {LISTING_COLUMNS} FROM listings"
+            if where:
+                sql += " WHERE " + " AND ".join(where)
+        sql += f" ORDER BY {order}"
+        if paginate:
+            sql += " LIMIT %s"
+            params.append(self.limit + 1)
+        self.sql = sql + ";"
+        self.params = params
+
+    # (rows of this page, cursor of the next page or None) from the fetched rows
+    def page(self, rows):
+        if len(rows) <= self.limit:
+            return rows, None
+        last = rows[self.limit - 1]
+        if self.key is None:
+            return rows[:self.limit], encode_cursor([last[0]])
+        if self.cast == 'float8':
+            return rows[:self.limit], encode_cursor([last[10], last[0]])
+        sort_value = last[6] if self.cast == 'date' else last[7]
+        if sort_value is None:
+            sort_value = '1970-01-01' if self.cast == 'date' else 0
+        return rows[:self.limit], encode_cursor([sort_value, last[0]])
+
+
+LISTING_BY_ID_SQL = f"SELECT {LISTING_COLUMNS} FROM listings WHERE id = %s;"
+
+# One rollup row per month: a primary-key lookup, independent of listing count
+FARMER_ANALYTICS_SQL = """
+    SELECT month, listing_count, quantity, earnings, sell_count, barter_count, donate_count
+    FROM farmer_monthly_stats
+    WHERE farmer_id = %s AND listing_count > 0;
+"""
+
+
+def farmer_analytics(rows):
+    total_quantity = 0
+    total_earnings = 0
+    sell_count = 0
+    barter_count = 0
+    donate_count = 0
+    monthly_data = {}
+    for month, _, quantity, earnings, sells, barters, donates in rows:
+        total_quantity += float(quantity)
+        total_earnings += float(earnings)
+        sell_count += sells
+        barter_count += barters
+        donate_count += donates
+        if month != date.min:
+            monthly_data[month.strftime('%Y-%m')] = {'quantity': float(quantity), 'earnings': float(earnings)}
+    return {
+        'total_quantity': total_quantity,
+        'total_earnings': total_earnings,
+        'sell_count': sell_count,
+        'barter_count': barter_count,
+        'donate_count': donate_count,
+        'monthly_data': monthly_data
+    }
+
+
+BUYER_ANALYTICS_SQL = """
+    SELECT title, type, SUM(listing_count), SUM(priced_count), SUM(price_sum)
+    FROM crop_monthly_stats
+    WHERE type IN ('sell', 'barter') AND status = 'available'
+    GROUP BY title, type
+    HAVING SUM(listing_count) > 0;
+"""
+
+
+# What the buyer spent on approved purchases, per crop (see pricing.py)
+BUYER_SPEND_SQL = """
+    SELECT title, purchases, quantity, spend, market_value
+    FROM buyer_crop_spend
+    WHERE buyer_id = %s;
+"""
+
+# Price statistics of the crops the buyer bought plus the most listed crops
+CROP_PRICES_SQL = """
+    SELECT title, listing_count, min_price, p10, median, p90, trend
+    FROM crop_price_stats
+    WHERE title IN (SELECT title FROM buyer_crop_spend WHERE buyer_id = %s)
+    UNION
+    (SELECT title, listing_count, min_price, p10, median, p90, trend
+     FROM crop_price_stats
+     ORDER BY listing_count DESC, title
+     LIMIT %s);
+"""
+
+
+def buyer_analytics(rows, spend_rows, price_rows):
+    total_listings = 0
+    crop_types = {}
+    for title, type_, listing_count, priced_count, price_sum in rows:
+        total_listings += listing_count
+        if type_ == 'sell' and priced_count:
+            crop_types[title] = crop_types.get(title, 0) + priced_count
+
+    purchases = 0
+    total_spend = 0.0
+    total_savings = 0.0
+    spend_by_crop = {}
+    for title, count, quantity, spend, market_value in spend_rows:
+        purchases += count
+        total_spend += float(spend)
+        total_savings += float(market_value - spend)
+        spend_by_crop[title] = {
+            'purchases': count,
+            'quantity': float(quantity),
+            'spend': float(spend),
+            'savings': float(market_value - spend),
+        }
+
+    price_stats = {}
+    for title, listing_count, min_price, p10, median, p90, trend in price_rows:
+        price_stats[title] = {
+            'listings': listing_count,
+            'min': float(min_price),
+            'p10': float(p10),
+            'median': float(median),
+            'p90': float(p90),
+            'trend': trend,
+        }
+    return {
+        'total_listings': total_listings,
+        'crop_types': crop_types,
+        'purchases': purchases,
+        'total_spend': total_spend,
+        'total_savings': total_savings,
+        # Against each crop's median listing price when the purchase was approved
+        'avg_savings_per_item': total_savings / purchases if purchases else 0.0,
+        'spend_by_crop': spend_by_crop,
+        'price_stats': price_stats,
+    }
+
+
+NGO_CLAIMS_SQL = """
+    SELECT month, title, claimed_count, claimed_quantity
+    FROM ngo_monthly_stats
+    WHERE ngo_id = %s AND claimed_count > 0;
+"""
+
+NGO_AVAILABLE_SQL = """
+    SELECT COALESCE(SUM(listing_count), 0)
+    FROM crop_monthly_stats
+    WHERE type = 'donate' AND status = 'available';
+"""
+
+
+def ngo_analytics(rows, available_count):
+    claimed_count = 0
+    total_claimed_qty = 0
+    monthly_claims = {}
+    crop_types = {}
+    for month, title, count, quantity in rows:
+        claimed_count += count
+        total_claimed_qty += float(quantity)
+        crop_types[title] = crop_types.get(title, 0) + count
+        if month != date.min:
+            month_key = month.strftime('%Y-%m')
+            monthly_claims[month_key] = monthly_claims.get(month_key, 0) + float(quantity)
+    return {
+        'total_claimed_quantity': total_claimed_qty,
+        'claimed_count': claimed_count,
+        'available_count': int(available_count),
+        'monthly_claims': monthly_claims,
+        'crop_types': crop_types
+    }
+
+
+NGO_PROFILE_SQL = "SELECT org_name, contact, address, focus_area FROM ngo_profiles WHERE ngo_id = %s;"
+
+
+def ngo_profile(row):
+    return {
+        'org_name': row[0],
+        'contact': row[1],
+        'address': row[2],
+        'focus_area': row[3]
+    }
+
+
+RECOMMENDED_PAGE_DEFAULT = 20
+RECOMMENDED_PAGE_MAX = 100
+
+
+class RecommendationQuery:
+    """One page of an NGO's "recommended for you" donations.
+
+    Best match first; among equal scores the donation available soonest (the
+    one that spoils first) leads. Query params: limit, cursor. paginate as
+    for ListingQuery.
+    """
+
+    def __init__(self, ngo_id, args, paginate=True):
+        try:
+            self.limit = min(max(int(args.get('limit', RECOMMENDED_PAGE_DEFAULT)), 1), RECOMMENDED_PAGE_MAX)
+        except ValueError:
+            raise InvalidQuery('Invalid limit')
+        columns = ', '.join('l.' + column.strip() for column in LISTING_COLUMNS.split(','))
+        sql = f"""
+            SELECT {columns}, m.score, m.focus_score, m.past_claims
+            FROM donation_matches m
+            JOIN listings l ON l.id = m.listing_id AND l.status = 'available' AND l.type = 'donate'
+            WHERE m.ngo_id = %s"""
+        params = [ngo_id]
+        if args.get('cursor'):
+            try:
+                values = decode_cursor(args['cursor'])
+                if not isinstance(values, list) or len(values) != 3:
+                    raise ValueError('Cursor must be a list of its sort values')
+                score = cursor_value(values[0], 'numeric')
+                available = 'infinity' if values[1] == 'infinity' else cursor_value(values[1], 'date')
+                params.extend([score, score, available, cursor_id(values[2])])
+            except (ValueError, TypeError, ArithmeticError):
+                raise InvalidQuery('Invalid cursor')
+            sql += """
+              AND (m.score < %s::text::numeric OR (m.score = %s::text::numeric
+                   AND (COALESCE(m.available_date, DATE 'infinity'), m.listing_id) > (%s::text::date, %s)))"""
+        sql += """
+            ORDER BY m.score DESC, COALESCE(m.available_date, DATE 'infinity'), m.listing_id"""
+        if paginate:
+            sql += " LIMIT %s"
+            params.append(self.limit + 1)
+        self.sql = sql + ";"
+        self.params = params
+
+    # (rows of this page, cursor of the next page or None) from the fetched rows
+    def page(self, rows):
+        if len(rows) <= self.limit:
+            return rows, None
+        last = rows[self.limit - 1]
+        available = last[6].isoformat() if last[6] else 'infinity'
+        return rows[:self.limit], encode_cursor([str(last[10]), available, last[0]])
+
+    @staticmethod
+    def shape(row):
+        return recommendation(row)
+
+
+def recommendation(row):
+    item = listing_to_dict(row)
+    item['match_score'] = float(row[10])
+    item['matches_focus'] = row[11] > 0
+    item['past_claims'] = row[12]
+    return item
+
+
+def proof_url(request_id, proof_hash, has_inline_proof):
+    if proof_hash:
+        return f'/api/proofs/{proof_hash}'
+    if has_inline_proof:
+        return f'/api/purchase-request/{request_id}/proof'
+    return None
+
+
+# Recent requests; archived ones (see partitions.py) come from the *_ARCHIVED_* variants
+_FARMER_REQUESTS = """
+    SELECT id, listing_id, buyer_id, crop_title, quantity, price,
+           proof_hash, proof_size, payment_proof IS NOT NULL, status, created_at
+    FROM {table}
+    WHERE farmer_id = %s
+    ORDER BY created_at DESC;
+"""
+FARMER_REQUESTS_SQL = _FARMER_REQUESTS.format(table='purchase_requests')
+FARMER_ARCHIVED_REQUESTS_SQL = _FARMER_REQUESTS.format(table='purchase_requests_archive')
+
+
+def farmer_request(row):
+    return {
+        'id': row[0],
+        'listing_id': row[1],
+        'buyer_id': row[2],
+        'crop_title': row[3],
+        'quantity': row[4],
+        'price': float(row[5]) if row[5] is not None else None,
+        'payment_proof_url': proof_url(row[0], row[6], row[8]),
+        # Small preview, and the recompressed image to open on click (see proofs.py)
+        'payment_proof_thumb_url': f'/api/proofs/{row[6]}/thumb' if row[6] else None,
+        'payment_proof_full_url': f'/api/proofs/{row[6]}/full' if row[6] else None,
+        'payment_proof_size': row[7],
+        'status': row[9],
+        'created_at': row[10].isoformat() if row[10] else None
+    }
+
+
+_BUYER_REQUESTS = """
+    SELECT id, listing_id, farmer_id, crop_title, quantity, price,
+           status, created_at
+    FROM {table}
+    WHERE buyer_id = %s
+    ORDER BY created_at DESC;
+"""
+BUYER_REQUESTS_SQL = _BUYER_REQUESTS.format(table='purchase_requests')
+BUYER_ARCHIVED_REQUESTS_SQL = _BUYER_REQUESTS.format(table='purchase_requests_archive')
+
+
+def buyer_request(row):
+    return {
+        'id': row[0],
+        'listing_id': row[1],
+        'farmer_id': row[2],
+        'crop_title': row[3],
+        'quantity': row[4],
+        'price': float(row[5]) if row[5] is not None else None,
+        'status': row[6],
+        'created_at': row[7].isoformat() if row[7] else None
+    }
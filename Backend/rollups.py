@@ -0,0 +1,144 @@
+from psycopg2.extras import execute_values
+
+# Listing columns the rollups depend on, in the order apply_listing_change expects
+STATE_COLUMNS = "farmer_id, title, type, status, claimed_by, available_date, price, quantity_amount"
+
+# Listings without an available_date land in the '-infinity' month: they count
+# towards totals but never show up as a monthly bucket
+MONTH_EXPR = "COALESCE(date_trunc('month', available_date)::date, '-infinity'::date)"
+
+DELTA_TEMPLATE = "(%s::int, %s::varchar, %s::varchar, %s::varchar, %s::varchar, %s::varchar, %s::date, %s::numeric, %s::numeric)"
+DELTA_COLUMNS = "sign, " + STATE_COLUMNS
+
+# Each rollup is one aggregate over a `src` relation shaped like DELTA_COLUMNS;
+# sign is +1 for a row entering the rollup and -1 for a row leaving it. Output
+# is ordered by key so concurrent writers lock rollup rows in the same order.
+ROLLUPS = {
+    'farmer_monthly_stats': {
+        'keys': "farmer_id, month",
+        'values': "listing_count, quantity, earnings, sell_count, barter_count, donate_count",
+        'select': f"""
+            SELECT farmer_id, {MONTH_EXPR},
+                   SUM(sign),
+                   COALESCE(SUM(sign * quantity_amount), 0),
+                   COALESCE(SUM(sign * price * quantity_amount) FILTER (WHERE type = 'sell' AND price <> 0), 0),
+                   COALESCE(SUM(sign) FILTER (WHERE type = 'sell' AND price <> 0), 0),
+                   COALESCE(SUM(sign) FILTER (WHERE type = 'barter'), 0),
+                   COALESCE(SUM(sign) FILTER (WHERE type = 'donate'), 0)
+            FROM src
+            GROUP BY 1, 2
+            ORDER BY 1, 2
+        """,
+    },
+    'ngo_monthly_stats': {
+        'keys': "ngo_id, month, title",
+        'values': "claimed_count, claimed_quantity",
+        'select': f"""
+            SELECT claimed_by, {MONTH_EXPR}, title,
+                   SUM(sign),
+                   COALESCE(SUM(sign * quantity_amount), 0)
+            FROM src
+            WHERE type = 'donate' AND claimed_by IS NOT NULL
+            GROUP BY 1, 2, 3
+            ORDER BY 1, 2, 3
+        """,
+    },
+    'crop_monthly_stats': {
+        'keys': "title, month, type, status",
+        'values': "listing_count, priced_count, price_sum, quantity",
+        'select': f"""
+            SELECT title, {MONTH_EXPR}, type, COALESCE(status, ''),
+                   SUM(sign),
+                   COALESCE(SUM(sign) FILTER (WHERE price <> 0), 0),
+                   COALESCE(SUM(sign * price) FILTER (WHERE price <> 0), 0),
+                   COALESCE(SUM(sign * quantity_amount), 0)
+            FROM src
+            GROUP BY 1, 2, 3, 4
+            ORDER BY 1, 2, 3, 4
+        """,
+    },
+}
+
+
+def _upsert_sql(table, spec):
+    values = [v.strip() for v in spec['values'].split(',')]
+    updates = ", ".join(f"{v} = {table}.{v} + EXCLUDED.{v}" for v in values)
+    return f"""
+        WITH src ({DELTA_COLUMNS}) AS (VALUES %s)
+        INSERT INTO {table} ({spec['keys']}, {spec['values']})
+        {spec['select']}
+        ON CONFLICT ({spec['keys']}) DO UPDATE SET {updates};
+    """
+
+
+UPSERT_SQL = {table: _upsert_sql(table, spec) for table, spec in ROLLUPS.items()}
+
+
+def fetch_listing_state(cur, listing_id):
+    cur.execute(f"SELECT {STATE_COLUMNS} FROM listings WHERE id = %s FOR UPDATE;", (listing_id,))
+    return cur.fetchone()
+
+
+# Apply listing state transitions to every rollup inside the caller's
+# transaction. `changes` is a list of (old_state, new_state) pairs where either
+# side may be None (insert / delete); states are tuples in STATE_COLUMNS order.
+def apply_listing_changes(cur, changes):
+    deltas = []
+    for old, new in changes:
+        if old == new:
+            continue
+        if old is not None:
+            deltas.append((-1,) + tuple(old))
+        if new is not None:
+            deltas.append((1,) + tuple(new))
+    if not deltas:
+        return
+    for table in ROLLUPS:
+        execute_values(cur, UPSERT_SQL[table], deltas, template=DELTA_TEMPLATE)
+
+
+def apply_listing_change(cur, old, new):
+    apply_listing_changes(cur, [(old, new)])
+
+
+# Recompute every rollup from the listings table. Listing writes are blocked
+# (reads are not) until the rebuild commits, so no delta can be lost or doubled.
+# With commit=False the caller owns the transaction (e.g. a migration).
+def rebuild(conn, commit=True):
+    cur = conn.cursor()
+    cur.execute("LOCK TABLE listings IN SHARE MODE;")
+    for table, spec in ROLLUPS.items():
+        cur.execute(f"LOCK TABLE {table} IN EXCLUSIVE MODE;")
+        cur.execute(f"DELETE FROM {table};")
+        cur.execute(f"""
+            WITH src ({DELTA_COLUMNS}) AS (SELECT 1, {STATE_COLUMNS} FROM listings)
+            INSERT INTO {table} ({spec['keys']}, {spec['values']})
+            {spec['select']};
+        """)
+    if commit:
+        conn.commit()
+    cur.close()
+
+
+# Compare each rollup with a fresh aggregate of listings. Rows whose counters
+# have all dropped to zero are equivalent to missing rows. Returns
+# {table: number of mismatched keys}.
+def verify(conn):
+    mismatches = {}
+    cur = conn.cursor()
+    for table, spec in ROLLUPS.items():
+        nonzero = " OR ".join(f"{v.strip()} <> 0" for v in spec['values'].split(','))
+        cur.execute(f"""
+            WITH src ({DELTA_COLUMNS}) AS (SELECT 1, {STATE_COLUMNS} FROM listings),
+            expected ({spec['keys']}, {spec['values']}) AS ({spec['select']}),
+            actual AS (SELECT {spec['keys']}, {spec['values']} FROM {table} WHERE {nonzero})
+            SELECT COUNT(*) FROM (
+                (SELECT * FROM expected EXCEPT SELECT * FROM actual)
+                UNION ALL
+                (SELECT * FROM actual EXCEPT SELECT * FROM expected)
+            ) diff;
+        """)
+        mismatches[table] = cur.fetchone()[0]
+    conn.rollback()
+    cur.close()
+    return mismatches
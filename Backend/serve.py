@@ -0,0 +1,130 @@
+"""Production serving mode: `python serve.py`.
+
+Runs app.py under gunicorn: the app is imported once in the master and
+forked into SERVER_WORKERS processes of SERVER_THREADS threads each, which
+share its memory copy-on-write. Each worker opens its own database pool,
+event broker and hashing pool after the fork. Open event streams hold a
+thread each; for thousands of dashboards use the asyncio mode (aio.py).
+
+Signals (to the master): HUP replaces every worker with a fresh one and
+gracefully stops the old ones; USR2 then WINCH/TERM to the old master
+upgrades to new code without dropping connections (the app is preloaded, so
+HUP alone keeps the old code); TERM shuts down gracefully; QUIT/INT stop
+immediately. A graceful stop flips /api/health/ready to 503,
+ends event streams (clients reconnect to another worker), finishes in-flight
+requests for up to SERVER_GRACEFUL_TIMEOUT seconds and then closes the
+worker's pools.
+"""
+import os
+import signal
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError as e:
+    raise ImportError(f"Production mode needs gunicorn installed ({e})")
+
+CPUS = os.cpu_count() or 1
+SERVER_HOST = os.environ.get('SERVER_HOST', '127.0.0.1')
+SERVER_PORT = int(os.environ.get('SERVER_PORT', 5000))
+SERVER_WORKERS = int(os.environ.get('SERVER_WORKERS', CPUS * 2 + 1))
+SERVER_THREADS = int(os.environ.get('SERVER_THREADS', 8))             # per worker; keep DB_POOL_MAX >= this
+SERVER_BACKLOG = int(os.environ.get('SERVER_BACKLOG', 2048))
+SERVER_KEEPALIVE = int(os.environ.get('SERVER_KEEPALIVE', 5))          # seconds an idle keep-alive connection stays open
+SERVER_TIMEOUT = int(os.environ.get('SERVER_TIMEOUT', 30))             # silent workers are killed and replaced after this
+SERVER_GRACEFUL_TIMEOUT = int(os.environ.get('SERVER_GRACEFUL_TIMEOUT', 30))  # drain time on reload/shutdown
+SERVER_MAX_REQUESTS = int(os.environ.get('SERVER_MAX_REQUESTS', 10000))  # recycle workers to bound memory growth
+SERVER_STATEMENT_TIMEOUT_MS = int(os.environ.get('SERVER_STATEMENT_TIMEOUT_MS', 30000))  # per-query cap, 0 = none
+
+# The master only imports the app; per-process startup happens in post_fork
+os.environ['SERVER_PREFORK'] = '1'
+# One bcrypt process per core across all workers, not per worker
+os.environ.setdefault('HASH_WORKERS', str(max(CPUS // SERVER_WORKERS, 1)))
+
+# Imported after the environment above is set
+import app as app_module
+import assets
+import db
+import events
+import hashing
+import pricing
+import proofs
+import sessions
+
+
+def when_ready(server):
+    # Runs in the master before the first fork: workers must not inherit its
+    # connections (the schema check opened one), but do share the static files
+    for pool in db.router.pools():
+        pool.closeall()
+    assets.store.load()
+
+
+def post_fork(server, worker):
+    for pool in db.router.pools():
+        pool.after_fork()
+        if SERVER_STATEMENT_TIMEOUT_MS:
+            pool.connect_kwargs['options'] = f'-c statement_timeout={SERVER_STATEMENT_TIMEOUT_MS}'
+    app_module.start_process()
+
+
+def post_worker_init(worker):
+    # Wraps gunicorn's graceful-stop handler, which is installed by now
+    graceful_stop = signal.getsignal(signal.SIGTERM)
+
+    def drain(signum, frame):
+        app_module.draining.set()
+        events.broker.close_streams()
+        graceful_stop(signum, frame)
+    signal.signal(signal.SIGTERM, drain)
+
+
+def worker_exit(server, worker):
+    # In-flight requests are done; release the worker's resources
+    events.broker.stop()
+    sessions.cache.stop()
+    proofs.worker.stop()
+    pricing.refresher.stop()
+    hashing.hash_pool.shutdown()
+    for pool in db.router.pools():
+        pool.closeall()
+
+
+class Server(BaseApplication):
+    def __init__(self, application, options):
+        self.application = application
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        return self.application
+
+
+def options():
+    return {
+        'bind': f'{SERVER_HOST}:{SERVER_PORT}',
+        'workers': SERVER_WORKERS,
+        'worker_class': 'gthread',
+        'threads': SERVER_THREADS,
+        'backlog': SERVER_BACKLOG,
+        'keepalive': SERVER_KEEPALIVE,
+        'timeout': SERVER_TIMEOUT,
+        'graceful_timeout': SERVER_GRACEFUL_TIMEOUT,
+        'max_requests': SERVER_MAX_REQUESTS,
+        'max_requests_jitter': SERVER_MAX_REQUESTS // 10,
+        'preload_app': True,
+        'when_ready': when_ready,
+        'post_fork': post_fork,
+        'post_worker_init': post_worker_init,
+        'worker_exit': worker_exit,
+    }
+
+
+if __name__ == '__main__':
+    if db.DB_POOL_MAX < SERVER_THREADS:
+        print(f"DB_POOL_MAX ({db.DB_POOL_MAX}) is below SERVER_THREADS ({SERVER_THREADS}): "
+              f"requests will queue for connections")
+    Server(app_module.app, options()).run()
@@ -0,0 +1,315 @@
+import base64
+import binascii
+import hashlib
+import hmac
+import json
+import os
+import secrets
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from functools import wraps
+
+from flask import g, jsonify, request
+
+import db
+import events
+
+# Login issues a signed, expiring token carrying the username and role:
+#   v1.<base64url JSON {"sub", "role", "sid", "iat", "exp"}>.<base64url HMAC-SHA256>
+# Clients send it as `Authorization: Bearer <token>` (EventSource and <img>
+# can't set headers, so the few views that serve them also take ?token=).
+# Checking a token is a signature check, never a database lookup, and the
+# principals of recently seen tokens are kept in a small LRU so repeat
+# requests skip even that.
+#
+# Logging out (and `python manage.py revoke-sessions`) stores a revocation in
+# session_revocations (migration 17) and announces it as a change event, so
+# every process stops accepting the token as soon as the NOTIFY arrives. Each
+# process also reloads the revocations every SESSION_REVOCATION_REFRESH
+# seconds, in case its event listener was reconnecting at the time.
+SESSION_SECRET = os.environ.get('SESSION_SECRET', '')
+SESSION_TTL = int(os.environ.get('SESSION_TTL', 12 * 3600))                   # seconds
+SESSION_CACHE_SIZE = int(os.environ.get('SESSION_CACHE_SIZE', 10000))       # verified tokens kept per process
+SESSION_REVOCATION_REFRESH = float(os.environ.get('SESSION_REVOCATION_REFRESH', 60))
+
+TOKEN_VERSION = 'v1'
+
+if not SESSION_SECRET:
+    # Workers forked by serve.py share it; separate servers (and restarts) don't
+    print("SESSION_SECRET is not set: using a random key, sessions end when the server restarts")
+    SESSION_SECRET = secrets.token_hex(32)
+_key = SESSION_SECRET.encode('utf-8')
+
+Principal = namedtuple('Principal', 'username role session_id issued_at expires_at')
+
+
+class InvalidToken(ValueError):
+    pass
+
+
+def _b64encode(raw):
+    return base64.urlsafe_b64encode(raw).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(text):
+    return base64.urlsafe_b64decode(text + '=' * (-len(text) % 4))
+
+
+def _sign(signed):
+    return hmac.new(_key, signed.encode('ascii'), hashlib.sha256).digest()
+
+
+# A new session for a user who just proved their password: (token, principal)
+def issue(username, role):
+    now = time.time()
+    principal = Principal(username, role, secrets.token_urlsafe(12), round(now, 3), int(now + SESSION_TTL))
+    claims = {'sub': username, 'role': role, 'sid': principal.session_id,
+              'iat': principal.issued_at, 'exp': principal.expires_at}
+    signed = f"{TOKEN_VERSION}.{_b64encode(json.dumps(claims, separators=(',', ':')).encode('utf-8'))}"
+    return f'{signed}.{_b64encode(_sign(signed))}', principal
+
+
+# Check a token's signature and read its claims; expiry and revocation are
+# checked by SessionCache.verify()
+def decode(token):
+    try:
+        version, payload, signature = token.split('.')
+        if version != TOKEN_VERSION:
+            raise InvalidToken('Unsupported session token')
+        if not hmac.compare_digest(_sign(f'{version}.{payload}'), _b64decode(signature)):
+            raise InvalidToken('Bad session token signature')
+        claims = json.loads(_b64decode(payload))
+        return Principal(claims['sub'], claims['role'], claims['sid'], claims['iat'], claims['exp'])
+    except InvalidToken:
+        raise
+    except (binascii.Error, ValueError, KeyError, TypeError):
+        raise InvalidToken('Malformed session token')
+
+
+class SessionCache:
+    """Principals of verified tokens (LRU) and the revocations in force.
+
+    Revocations are only ever added, so reloading them from the database
+    merges with what events delivered meanwhile; entries are dropped once the
+    tokens they revoke would have expired anyway.
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._principals = OrderedDict()
+        self._revoked_sessions = {}     # session id -> expires_at
+        self._revoked_users = {}        # username -> (tokens issued before this are revoked, expires_at)
+        self._thread = None
+        self._stopping = threading.Event()
+        self._loaded_at = None
+        self.hits = 0
+        self.misses = 0
+        self.rejected = 0
+        self.expired = 0
+        self.revoked = 0
+
+    def _is_revoked(self, principal):
+        if principal.session_id in self._revoked_sessions:
+            return True
+        before, _ = self._revoked_users.get(principal.username, (0, 0))
+        return principal.issued_at < before
+
+    # The principal of a valid token, or None
+    def verify(self, token):
+        with self._lock:
+            principal = self._principals.get(token)
+            if principal is not None:
+                self._principals.move_to_end(token)
+                self.hits += 1
+        if principal is None:
+            try:
+                principal = decode(token)
+            except InvalidToken:
+                with self._lock:
+                    self.rejected += 1
+                return None
+        with self._lock:
+            if principal.expires_at <= time.time():
+                self.expired += 1
+            elif self._is_revoked(principal):
+                self.revoked += 1
+            else:
+                if token not in self._principals:
+                    self.misses += 1
+                    self._principals[token] = principal
+                    if len(self._principals) > self.max_entries:
+                        self._principals.popitem(last=False)
+                return principal
+            self._principals.pop(token, None)
+            return None
+
+    def _add(self, username, session_id, revoked_at, expires_at):
+        if session_id:
+            self._revoked_sessions[session_id] = expires_at
+        else:
+            before, until = self._revoked_users.get(username, (0, 0))
+            self._revoked_users[username] = (max(before, revoked_at), max(until, expires_at))
+
+    def add(self, username, session_id, revoked_at, expires_at):
+        with self._lock:
+            self._add(username, session_id, revoked_at, expires_at)
+
+    # events.broker listener: revocations made by any process
+    def apply_event(self, event):
+        if event['kind'] != 'sessions':
+            return
+        payload = event['payload']
+        self.add(payload['username'], payload.get('session_id'), payload['revoked_at'], payload['expires_at'])
+
+    def refresh(self, conn):
+        cur = conn.cursor()
+        cur.execute("""
+            SELECT username, session_id, EXTRACT(EPOCH FROM revoked_at), EXTRACT(EPOCH FROM expires_at)
+            FROM session_revocations WHERE expires_at > now();
+        """)
+        rows = cur.fetchall()
+        cur.close()
+        conn.rollback()
+        now = time.time()
+        with self._lock:
+            self._revoked_sessions = {k: v for k, v in self._revoked_sessions.items() if v > now}
+            self._revoked_users = {k: v for k, v in self._revoked_users.items() if v[1] > now}
+            for username, session_id, revoked_at, expires_at in rows:
+                self._add(username, session_id, float(revoked_at), float(expires_at))
+            self._loaded_at = now
+
+    def _load(self):
+        try:
+            with db.pool.connection() as conn:
+                self.refresh(conn)
+        except Exception as e:
+            print(f"Error loading session revocations: {e}")
+
+    # Load the revocations now, then keep reloading them in the background
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name='session-revocations', daemon=True)
+        self._load()
+        self._thread.start()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _run(self):
+        while not self._stopping.wait(SESSION_REVOCATION_REFRESH):
+            self._load()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'entries': len(self._principals),
+                'max_entries': self.max_entries,
+                'hits': self.hits,
+                'misses': self.misses,
+                'rejected': self.rejected,
+                'expired': self.expired,
+                'revoked': self.revoked,
+                'revoked_sessions': len(self._revoked_sessions),
+                'revoked_users': len(self._revoked_users),
+                'revocations_age_s': round(time.time() - self._loaded_at, 1) if self._loaded_at else None,
+            }
+
+
+cache = SessionCache(SESSION_CACHE_SIZE)
+events.broker.add_listener(cache.apply_event)
+
+
+# Revoke one session, or every session of the user issued so far
+# (session_id=None). Commits; takes effect in this process at once and in
+# the others when the change event arrives.
+def revoke(conn, username, session_id=None, expires_at=None):
+    revoked_at = time.time()
+    expires_at = expires_at or revoked_at + SESSION_TTL
+    payload = {'username': username, 'session_id': session_id, 'revoked_at': revoked_at, 'expires_at': expires_at}
+    cur = conn.cursor()
+    cur.execute("DELETE FROM session_revocations WHERE expires_at < now();")
+    cur.execute("""
+        INSERT INTO session_revocations (username, session_id, revoked_at, expires_at)
+        VALUES (%s, %s, to_timestamp(%s), to_timestamp(%s));
+    """, (username, session_id, revoked_at, expires_at))
+    cur.execute("""
+        INSERT INTO change_events (kind, op, payload)
+        VALUES ('sessions', 'revoke', %s) RETURNING id;
+    """, (json.dumps(payload),))
+    cur.execute("SELECT pg_notify(%s, %s);", (events.EVENTS_CHANNEL, str(cur.fetchone()[0])))
+    conn.commit()
+    cur.close()
+    cache.add(username, session_id, revoked_at, expires_at)
+
+
+def bearer_token(headers):
+    scheme, _, token = headers.get('Authorization', '').partition(' ')
+    token = token.strip()
+    return token if scheme.lower() == 'bearer' and token else None
+
+
+# A field the client claims to act for, from the JSON or form body or the query string
+def claimed(field):
+    data = request.get_json(silent=True) if request.is_json else request.form
+    return (data or {}).get(field) or request.args.get(field)
+
+
+# None when `principal` may call a view limited to `roles` on behalf of
+# `owner` (None: whoever is signed in); otherwise (status, message)
+def check(principal, roles=(), owner=None):
+    if principal is None:
+        return 401, 'Login required'
+    if roles and principal.role not in roles:
+        return 403, 'Not allowed for your role'
+    if owner is not None and str(owner) != principal.username:
+        return 403, 'Not allowed to act for another user'
+    return None
+
+
+def denied_response(status, message):
+    response = jsonify({'error': message})
+    if status == 401:
+        response.headers['WWW-Authenticate'] = 'Bearer'
+    return response, status
+
+
+def current_user():
+    return g.principal.username
+
+
+# Limit a view to signed-in users with one of `roles` (any role if none are
+# given). `owner` maps the view kwargs to the user the request claims to act
+# for, e.g. lambda farmer_id: farmer_id; it must be the signed-in user. Goes
+# above @cached so a cached response is never served to someone else.
+def login_required(*roles, owner=None, query_token=False):
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            principal = g.principal
+            if principal is None and query_token and request.args.get('token'):
+                principal = g.principal = cache.verify(request.args['token'])
+            claimed_owner = owner(*args, **kwargs) if owner is not None and principal is not None else None
+            denied = check(principal, roles, claimed_owner)
+            if denied:
+                return denied_response(*denied)
+            return view(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    # A token that doesn't verify is refused outright, even on public
+    # routes, so clients notice and log in again
+    @app.before_request
+    def load_principal():
+        g.principal = None
+        token = bearer_token(request.headers)
+        if token is not None:
+            g.principal = cache.verify(token)
+            if g.principal is None:
+                return denied_response(401, 'Session expired, please log in again')
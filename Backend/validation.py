@@ -0,0 +1,82 @@
+import re
+from datetime import date
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+LISTING_TYPES = ('sell', 'barter', 'donate')
+QUANTITY_RE = re.compile(r'^\s*(\d+(?:\.\d+)?)\s*(.*?)\s*$')
+# Column limits of listings: VARCHAR(100) ids and names, NUMERIC(12,3)
+# quantity_amount, DECIMAL(10,2) price
+NAME_MAX_LENGTH = 100
+QUANTITY_AMOUNT_LIMIT = 1e9
+PRICE_STEP = Decimal('0.01')
+PRICE_LIMIT = Decimal('1e8')
+
+
+# Split a free-text quantity into (amount, unit); unparseable amounts count as 0.
+# Raises ValueError for an amount too large for quantity_amount.
+def parse_quantity(quantity):
+    match = QUANTITY_RE.match(str(quantity))
+    if not match:
+        return 0, None
+    amount = float(match.group(1))
+    if round(amount, 3) >= QUANTITY_AMOUNT_LIMIT:
+        raise ValueError('quantity amount is out of range')
+    return amount, (match.group(2)[:20] or None)
+
+
+# Validate one listing record (e.g. a CSV / NDJSON row) and return the column
+# values in LISTING_INSERT_COLUMNS order. Raises ValueError with a readable message.
+LISTING_INSERT_COLUMNS = ('title', 'quantity', 'quantity_amount', 'quantity_unit', 'type',
+                          'farmer_id', 'farmer_name', 'available_date', 'price')
+
+
+def validate_listing(record, defaults=None):
+    record = dict(defaults or {}, **{k: v for k, v in record.items() if v not in (None, '')})
+    missing = [f for f in ('title', 'quantity', 'type', 'farmer_id', 'farmer_name') if not record.get(f)]
+    if missing:
+        raise ValueError(f"Missing required fields: {', '.join(missing)}")
+
+    title = str(record['title']).strip()
+    quantity = str(record['quantity']).strip()
+    if len(title) > 100:
+        raise ValueError('title is longer than 100 characters')
+    if len(quantity) > 50:
+        raise ValueError('quantity is longer than 50 characters')
+    farmer_id = str(record['farmer_id'])
+    farmer_name = str(record['farmer_name'])
+    if len(farmer_id) > NAME_MAX_LENGTH:
+        raise ValueError(f'farmer_id is longer than {NAME_MAX_LENGTH} characters')
+    if len(farmer_name) > NAME_MAX_LENGTH:
+        raise ValueError(f'farmer_name is longer than {NAME_MAX_LENGTH} characters')
+    type_ = str(record['type']).strip().lower()
+    if type_ not in LISTING_TYPES:
+        raise ValueError(f"type must be one of {', '.join(LISTING_TYPES)}")
+
+    available_date = record.get('available_date')
+    if available_date:
+        try:
+            available_date = date.fromisoformat(str(available_date).strip())
+        except ValueError:
+            raise ValueError('available_date must be YYYY-MM-DD')
+
+    price = record.get('price')
+    if price not in (None, ''):
+        try:
+            price = Decimal(str(price).strip())
+        except InvalidOperation:
+            raise ValueError('price must be a number')
+        if not price.is_finite():
+            raise ValueError('price must be a number')
+        # Compare what the column will store: 99999999.999 rounds up to 1e8
+        try:
+            price = price.quantize(PRICE_STEP, rounding=ROUND_HALF_UP)
+        except InvalidOperation:
+            raise ValueError('price is out of range')
+        if price < 0 or price >= PRICE_LIMIT:
+            raise ValueError('price is out of range')
+    else:
+        price = None
+
+    quantity_amount, quantity_unit = parse_quantity(quantity)
+    return (title, quantity, quantity_amount, quantity_unit, type_,
+            farmer_id, farmer_name, available_date or None, price)
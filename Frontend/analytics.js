@@ -9,10 +9,7 @@ if (!activeUser) {
 // Logout handler
 const logoutBtn = document.getElementById("logoutBtn");
 if (logoutBtn) {
-    logoutBtn.addEventListener("click", () => {
-        localStorage.removeItem("activeUser");
-        window.location.href = "login.html";
-    });
+    logoutBtn.addEventListener("click", logout);
 }
 
 // Fetch and render analytics
@@ -116,7 +113,9 @@ function renderFarmerAnalytics(data) {
 function renderBuyerAnalytics(data) {
     document.getElementById('summary').innerHTML = `
         <strong>${data.total_listings}</strong> listings available. 
-        Average savings: <strong>Rs. ${data.avg_savings_per_item.toFixed(2)}</strong> per item.
+        You spent <strong>Rs. ${data.total_spend.toFixed(2)}</strong> on ${data.purchases} purchases and saved
+        <strong>Rs. ${data.total_savings.toFixed(2)}</strong> against median market prices
+        (<strong>Rs. ${data.avg_savings_per_item.toFixed(2)}</strong> per purchase).
     `;
     
     // Chart 1: Available crop types (Horizontal bar)
@@ -148,35 +147,43 @@ function renderBuyerAnalytics(data) {
         displayModeBar: false
     });
     
-    // Chart 2: Savings potential (Gauge)
-    const gaugeData = [{
-        type: "indicator",
-        mode: "gauge+number+delta",
-        value: data.avg_savings_per_item,
-        title: { text: "Avg Savings per Item (Rs.)" },
-        delta: { reference: 100 },
-        gauge: {
-            axis: { range: [null, 200] },
-            bar: { color: "#4caf50" },
-            steps: [
-                { range: [0, 50], color: "#c8e6c9" },
-                { range: [50, 100], color: "#81c784" },
-                { range: [100, 200], color: "#66bb6a" }
-            ],
-            threshold: {
-                line: { color: "red", width: 4 },
-                thickness: 0.75,
-                value: 150
-            }
-        }
+    // Chart 2: Market prices of the crops (median with the p10-p90 range)
+    const priced = Object.keys(data.price_stats)
+        .sort((a, b) => data.price_stats[b].listings - data.price_stats[a].listings)
+        .slice(0, 15);
+    const medians = priced.map(c => data.price_stats[c].median);
+    
+    const priceData = [{
+        x: priced,
+        y: medians,
+        type: 'scatter',
+        mode: 'markers',
+        marker: {
+            size: 10,
+            color: priced.map(c => c in data.spend_by_crop ? '#ff9800' : '#4caf50')
+        },
+        error_y: {
+            type: 'data',
+            symmetric: false,
+            array: priced.map(c => data.price_stats[c].p90 - data.price_stats[c].median),
+            arrayminus: priced.map(c => data.price_stats[c].median - data.price_stats[c].p10),
+            color: '#388e3c'
+        },
+        customdata: priced.map(c => [data.price_stats[c].p10, data.price_stats[c].p90, data.price_stats[c].listings]),
+        hovertemplate: '<b>%{x}</b><br>Median: Rs. %{y:.2f}<br>' +
+            'Typical: Rs. %{customdata[0]:.2f} - %{customdata[1]:.2f}<br>' +
+            'Listings: %{customdata[2]}<extra></extra>'
     }];
     
-    const gaugeLayout = {
+    const priceLayout = {
+        title: 'Market Prices (crops you bought in orange)',
+        xaxis: { title: 'Crop' },
+        yaxis: { title: 'Price (Rs.)' },
         height: 380,
-        margin: { t: 20, b: 20, l: 20, r: 20 }
+        margin: { t: 40, b: 80, l: 60, r: 20 }
     };
     
-    Plotly.newPlot('secondary-chart', gaugeData, gaugeLayout, {
+    Plotly.newPlot('secondary-chart', priceData, priceLayout, {
         responsive: true,
         displayModeBar: false
     });
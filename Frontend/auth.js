@@ -54,7 +54,9 @@ if (document.getElementById("loginForm")) {
       if (response.ok) {
         localStorage.setItem("activeUser", JSON.stringify({
           username: result.username,
-          role: result.role
+          role: result.role,
+          token: result.token,
+          expiresAt: result.expires_at
         }));
         if (result.role === "farmer") {
           window.location.href = "farmer.html";
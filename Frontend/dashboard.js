@@ -14,31 +14,100 @@ if (!activeUser || (activeUser.role !== "ngo" && role === "ngo") || (activeUser.
 // Logout
 const logoutBtn = document.getElementById("logoutBtn");
 if (logoutBtn) {
-    logoutBtn.addEventListener("click", () => {
-        localStorage.removeItem("activeUser");
-        window.location.href = "login.html";
-    });
+    logoutBtn.addEventListener("click", logout);
 }
 
-// Fetch listings from API
-async function fetchListings() {
+// Fetch one page of listings from API; filtering happens server-side.
+// Queries with a search term go to the ranked search endpoint.
+async function fetchListings(params = {}) {
     try {
-        console.log('Fetching listings...');
-        const response = await fetch('http://localhost:5000/api/listings');
+        const query = new URLSearchParams(params).toString();
+        console.log('Fetching listings...', query);
+        const path = params.q ? 'listings/search' : 'listings';
+        const response = await fetch(`http://localhost:5000/api/${path}?${query}`);
         if (!response.ok) {
             throw new Error(`HTTP error! Status: ${response.status}`);
         }
         const listings = await response.json();
-        console.log('Listings fetched:', listings);
-        listings.forEach((listing, index) => {
-            console.log(`Listing ${index}: id = ${listing.id}, title = ${listing.title}, price = ${listing.price}, type = ${typeof listing.price}, status = ${listing.status}`);
-        });
-        return listings;
+        console.log('Listings fetched:', listings.length);
+        return { listings, nextCursor: response.headers.get('X-Next-Cursor') };
     } catch (error) {
         console.error('Error fetching listings:', error);
         alert('Failed to fetch listings. Check console for details.');
-        return [];
+        return { listings: [], nextCursor: null };
+    }
+}
+
+// Build the server-side query for the current role and sidebar controls.
+// Returns null when the selected filters cannot match anything for this role.
+function listingQuery() {
+    if (role === "farmer") {
+        return { farmer_id: activeUser.username, limit: 200 };
+    }
+
+    const allowedTypes = role === "ngo" ? ["donate"] : ["sell", "barter"];
+    const params = { type: allowedTypes.join(","), status: "available" };
+
+    const searchInput = document.getElementById("search");
+    const filterType = document.getElementById("filterType");
+    const sortBy = document.getElementById("sortBy");
+
+    if (searchInput && searchInput.value.trim()) {
+        params.q = searchInput.value.trim();
+    }
+    if (filterType && filterType.value !== "all") {
+        if (!allowedTypes.includes(filterType.value)) return null;
+        params.type = filterType.value;
+    }
+    if (sortBy && sortBy.value) {
+        params.sort = { new: "new", priceAsc: "price_asc", priceDesc: "price_desc" }[sortBy.value] || "id";
+        // "Best match" only ranks when there is something to match
+        if (sortBy.value === "relevance") params.sort = params.q ? "relevance" : "new";
     }
+    return params;
+}
+
+// Render a single listing card for buyer/NGO dashboards
+function renderListingCard(it, container) {
+    const element = document.createElement("div");
+    element.className = "listing";
+    let html = `
+        <div class="listing-info">
+            <h3>${it.title}</h3>
+            <p><strong>Qty:</strong> ${it.quantity}</p>
+            <p><strong>Type:</strong> ${it.type}</p>
+            <p><strong>Available:</strong> ${it.available_date || "Not specified"}</p>
+            <p><strong>Price:</strong> ${typeof it.price === 'number' && !isNaN(it.price) ? `Rs. ${it.price.toFixed(2)}` : "N/A"}</p>
+            <p><strong>Farmer:</strong> ${it.farmer_name || "Unknown"}</p>
+        </div>
+    `;
+
+    element.innerHTML = html;
+
+    if (role === "buyer" && (it.type === "sell" || it.type === "barter")) {
+        const btn = document.createElement("button");
+        btn.textContent = it.type === "sell" ? "Buy Now" : "Offer/Barter";
+        btn.className = "small";
+        btn.addEventListener("click", () => {
+            if (it.type === "sell") {
+                // Redirect to payment page
+                window.location.href = `payment.html?listing=${it.id}`;
+            } else {
+                alert(`Barter request sent to farmer: ${it.farmer_name}`);
+            }
+        });
+        element.appendChild(btn);
+    }
+
+    if (role === "ngo" && it.type === "donate") {
+        const btn = document.createElement("button");
+        btn.textContent = "Claim Donation";
+        btn.className = "small";
+        btn.addEventListener("click", () => claimDonation(it.id));
+        element.appendChild(btn);
+    }
+
+    container.appendChild(element);
 }
 
 // Render Listings
@@ -60,111 +129,58 @@ async function renderListings() {
         [sellContainer, barterContainer, availableDonateContainer, claimedDonateContainer].forEach(cont => cont.innerHTML = "");
     }
 
-    const listings = await fetchListings();
-    let filtered = listings;
-
-    console.log('Total listings before filtering:', filtered.length);
+    const params = listingQuery();
 
-    if (role === "farmer") {
-        filtered = filtered.filter((l) => l.farmer_id === activeUser.username);
-        console.log('Farmer listings after filtering:', filtered.length);
-    } else if (role === "buyer") {
-        filtered = filtered.filter((l) => (l.type === "sell" || l.type === "barter") && l.status === "available");
-        console.log('Buyer listings after filtering:', filtered.length);
-    } else if (role === "ngo") {
-        filtered = filtered.filter((l) => l.type === "donate" && l.status === "available");
-        console.log('NGO listings after filtering:', filtered.length);
-    }
-
-    // Apply search, filter, and sort for non-farmer roles
+    // Buyer and NGO dashboards show one page at a time with a "Load more" button
     if (role !== "farmer") {
-        const searchInput = document.getElementById("search");
-        const filterType = document.getElementById("filterType");
-        const sortBy = document.getElementById("sortBy");
-
-        if (searchInput && searchInput.value) {
-            const searchTerm = searchInput.value.toLowerCase();
-            filtered = filtered.filter((l) => l.title.toLowerCase().includes(searchTerm));
-            console.log('After search filter:', filtered.length);
+        const container = document.getElementById("listings");
+        if (!container) {
+            console.error('Container #listings not found!');
+            return;
         }
+        container.innerHTML = "";
 
-        if (filterType && filterType.value !== "all") {
-            filtered = filtered.filter((l) => l.type === filterType.value);
-            console.log('After type filter:', filtered.length);
+        const emptyMessage = `<div class="muted" style="grid-column: 1 / -1; text-align: center; padding: 20px;">No listings available.</div>`;
+        if (params === null) {
+            container.innerHTML = emptyMessage;
+            return;
         }
 
-        if (sortBy && sortBy.value) {
-            filtered = filtered.sort((a, b) => {
-                if (sortBy.value === "new") {
-                    return new Date(b.available_date) - new Date(a.available_date);
-                } else if (sortBy.value === "priceAsc") {
-                    return (a.price || 0) - (b.price || 0);
-                } else if (sortBy.value === "priceDesc") {
-                    return (b.price || 0) - (a.price || 0);
-                }
-                return 0;
-            });
-        }
+        const loadPage = async (cursor) => {
+            const page = await fetchListings(cursor ? { ...params, cursor } : params);
+            const moreBtn = document.getElementById("loadMoreListings");
+            if (moreBtn) moreBtn.remove();
 
-        const container = document.getElementById("listings");
-        if (container) {
-            container.innerHTML = "";
-            console.log('Rendering', filtered.length, 'listings in container');
-            
-            if (filtered.length === 0) {
-                container.innerHTML = `<div class="muted" style="grid-column: 1 / -1; text-align: center; padding: 20px;">No listings available.</div>`;
+            if (!cursor && page.listings.length === 0) {
+                container.innerHTML = emptyMessage;
                 return;
             }
-            
-            filtered.forEach((it) => {
-                console.log('Rendering listing:', it.title);
-                const element = document.createElement("div");
-                element.className = "listing";
-                let html = `
-                    <div class="listing-info">
-                        <h3>${it.title}</h3>
-                        <p><strong>Qty:</strong> ${it.quantity}</p>
-                        <p><strong>Type:</strong> ${it.type}</p>
-                        <p><strong>Available:</strong> ${it.available_date || "Not specified"}</p>
-                        <p><strong>Price:</strong> ${typeof it.price === 'number' && !isNaN(it.price) ? `Rs. ${it.price.toFixed(2)}` : "N/A"}</p>
-                        <p><strong>Farmer:</strong> ${it.farmer_name || "Unknown"}</p>
-                    </div>
-                `;
-
-                element.innerHTML = html;
-
-        if (role === "buyer" && (it.type === "sell" || it.type === "barter")) {
-    const btn = document.createElement("button");
-    btn.textContent = it.type === "sell" ? "Buy Now" : "Offer/Barter";
-    btn.className = "small";
-    btn.addEventListener("click", () => {
-        if (it.type === "sell") {
-            // Redirect to payment page
-            window.location.href = `payment.html?listing=${it.id}`;
-        } else {
-            alert(`Barter request sent to farmer: ${it.farmer_name}`);
-        }
-    });
-    element.appendChild(btn);
-}
-
-                if (role === "ngo" && it.type === "donate") {
-                    const btn = document.createElement("button");
-                    btn.textContent = "Claim Donation";
-                    btn.className = "small";
-                    btn.addEventListener("click", () => claimDonation(it.id));
-                    element.appendChild(btn);
-                }
-
-                container.appendChild(element);
-            });
-            console.log('Finished rendering all listings');
-        } else {
-            console.error('Container #listings not found!');
-        }
+            page.listings.forEach((it) => renderListingCard(it, container));
+
+            if (page.nextCursor) {
+                const btn = document.createElement("button");
+                btn.id = "loadMoreListings";
+                btn.className = "small";
+                btn.style.gridColumn = "1 / -1";
+                btn.textContent = "Load more";
+                btn.addEventListener("click", () => loadPage(page.nextCursor));
+                container.appendChild(btn);
+            }
+        };
+        await loadPage(null);
         return;
     }
 
+    // Farmers manage all of their own listings, so fetch every page
+    let filtered = [];
+    let cursor = null;
+    do {
+        const page = await fetchListings(cursor ? { ...params, cursor } : params);
+        filtered = filtered.concat(page.listings);
+        cursor = page.nextCursor;
+    } while (cursor);
+    console.log('Farmer listings:', filtered.length);
+
     // Farmer-specific rendering
     if (filtered.length === 0) {
         sellContainer.innerHTML = `<li class="muted">No sell listings.</li>`;
@@ -250,13 +266,14 @@ async function claimDonation(id) {
     try {
         const response = await fetch(`http://localhost:5000/api/claim/${id}`, {
             method: 'POST',
-            headers: { 'Content-Type': 'application/json' },
+            headers: { 'Content-Type': 'application/json', 'Idempotency-Key': crypto.randomUUID() },
             body: JSON.stringify({ claimed_by: activeUser.username })
         });
         const result = await response.json();
         if (response.ok) {
             alert('Donation claimed! Confirmation sent to farmer.');
             renderListings();
+            renderRecommended();
         } else {
             alert('Error: ' + result.error);
         }
@@ -536,6 +553,33 @@ if (profileForm && role === "ngo_profile") {
     });
 }
 
+// "Recommended for you" donations for the NGO dashboard, ranked server-side
+async function renderRecommended() {
+    const card = document.getElementById("recommendedCard");
+    const container = document.getElementById("recommended");
+    if (!card || !container) return;
+    try {
+        const query = new URLSearchParams({ ngo_id: activeUser.username, limit: 6 }).toString();
+        const response = await fetch(`http://localhost:5000/api/ngo/recommended?${query}`);
+        if (!response.ok) throw new Error(`HTTP error! Status: ${response.status}`);
+        const items = await response.json();
+        container.innerHTML = "";
+        card.style.display = items.length ? "" : "none";
+        items.forEach((it) => {
+            renderListingCard(it, container);
+            const reasons = [];
+            if (it.matches_focus) reasons.push("Matches your focus area");
+            if (it.past_claims) reasons.push(`You've claimed ${it.title} ${it.past_claims}×`);
+            const note = document.createElement("p");
+            note.className = "muted";
+            note.textContent = reasons.join(" · ");
+            container.lastElementChild.querySelector(".listing-info").appendChild(note);
+        });
+    } catch (error) {
+        console.error('Error fetching recommendations:', error);
+    }
+}
+
 // Add filter and sort listeners for non-farmer roles
 function setupFilters() {
     if (role === "ngo_profile") return;
@@ -544,7 +588,12 @@ function setupFilters() {
     const sortBy = document.getElementById("sortBy");
 
     if (searchInput) {
-        searchInput.addEventListener("input", renderListings);
+        // Debounce so typing issues one server-side search, not one per keystroke
+        let searchTimer = null;
+        searchInput.addEventListener("input", () => {
+            clearTimeout(searchTimer);
+            searchTimer = setTimeout(renderListings, 250);
+        });
     }
     if (filterType) {
         filterType.addEventListener("change", renderListings);
@@ -578,6 +627,14 @@ document.addEventListener('DOMContentLoaded', () => {
     } else if (role === "buyer" || role === "ngo") {
         setupFilters();
         renderListings();
+        if (role === "ngo") renderRecommended();
+    }
+    // Re-render when the server pushes a relevant listing change (new listing, claim, sale)
+    if ((role === "farmer" || role === "buyer" || role === "ngo") && typeof subscribeToChanges === "function") {
+        subscribeToChanges(() => {
+            renderListings();
+            if (role === "ngo") renderRecommended();
+        }, ["listings"]);
     } else if (role === "ngo_profile") {
         renderNgoProfile();
     }
@@ -0,0 +1,21 @@
+// events.js — live updates pushed by the server (/api/events, Server-Sent Events)
+
+// Calls onChange whenever a listing or purchase request relevant to the
+// logged-in user changes. Bursts are coalesced; the browser reconnects on its
+// own and resumes from the last event it saw. Returns null when unsupported.
+function subscribeToChanges(onChange, kinds = ["listings", "purchase_requests"]) {
+    const user = JSON.parse(localStorage.getItem("activeUser"));
+    if (!user || !user.token || typeof EventSource === "undefined") return null;
+
+    // EventSource can't send the Authorization header: the token goes in the URL
+    const source = new EventSource(withSessionToken("http://localhost:5000/api/events"));
+
+    let timer = null;
+    const trigger = (event) => {
+        clearTimeout(timer);
+        timer = setTimeout(() => onChange(event), 300);
+    };
+    kinds.concat("reset").forEach((kind) => source.addEventListener(kind, trigger));
+    window.addEventListener("beforeunload", () => source.close());
+    return source;
+}
@@ -0,0 +1,45 @@
+// session.js — the signed-in user's session token (issued by /api/login)
+
+const API_ORIGIN = "http://localhost:5000";
+
+function sessionToken() {
+  const user = JSON.parse(localStorage.getItem("activeUser"));
+  return user && user.token ? user.token : null;
+}
+
+// For URLs the browser loads itself (EventSource, <img>), which can't send headers
+function withSessionToken(url) {
+  const token = sessionToken();
+  if (!token) return url;
+  return url + (url.includes("?") ? "&" : "?") + "token=" + encodeURIComponent(token);
+}
+
+// Every API call carries the token; an expired or revoked session sends the
+// user back to the login page
+const plainFetch = window.fetch.bind(window);
+window.fetch = async function (input, init = {}) {
+  const url = typeof input === "string" ? input : input.url;
+  if (!url.startsWith(API_ORIGIN + "/api/")) {
+    return plainFetch(input, init);
+  }
+  const headers = new Headers(init.headers || (typeof input === "string" ? {} : input.headers));
+  const token = sessionToken();
+  if (token) headers.set("Authorization", "Bearer " + token);
+  const response = await plainFetch(input, { ...init, headers });
+  if (response.status === 401 && !url.endsWith("/api/login") && !url.endsWith("/api/logout")) {
+    localStorage.removeItem("activeUser");
+    alert("⚠️ Your session has expired. Please login again.");
+    window.location.href = "login.html";
+  }
+  return response;
+};
+
+async function logout() {
+  try {
+    await fetch(`${API_ORIGIN}/api/logout`, { method: "POST" });
+  } catch (error) {
+    console.error("Error logging out:", error);
+  }
+  localStorage.removeItem("activeUser");
+  window.location.href = "login.html";
+}